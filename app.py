@@ -1,40 +1,140 @@
 from fastapi import FastAPI, Request, Response, HTTPException, status, Depends
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel, EmailStr
 from contextlib import asynccontextmanager
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy_utils import database_exists, create_database
 from sqlalchemy.exc import OperationalError
 from sqlalchemy import and_
 from models.user import User, Base, Image, Verification
-from schemas.user_schema import UserSchema, UserRequestBodyModel, UserUpdateRequestBodyModel
+from models.outbox import OutboxMessage
+from schemas.user_schema import UserSchema, UserRequestBodyModel, UserUpdateRequestBodyModel, AuthenticatedUser
+from schemas.user_schema import PresignedUploadRequestBodyModel, UploadCompleteRequestBodyModel
 from database import get_database_connection, get_database_session, get_engine, DB_CONNECTION_STRING
-from datetime import datetime, timedelta
-from zoneinfo import ZoneInfo
+from database import get_async_database_session, dispose_async_engine, DatabaseHealthMonitor, async_session, get_async_engine
+from services import queries
+from services.hashing import PasswordHasher, HashingQueueFullError
+from services.auth_cache import CredentialCache
+from services.notifications import OutboxDispatcher, SnsPublisher, OUTBOX_DISPATCHER_ENABLED
+from services.aws import ClientRegistry
+from services.metrics import BufferedStatsClient, route_name, status_class
+from services.tracing import span, traced, start_request, log_request
+from services.profiling import QueryProfiler, QUERY_DEBUG_ENDPOINT_ENABLED
+from services.serialization import FastJSONResponse, serialize_user, serialize_image, dumps
+from services.etag import make_etag, etag_matches
+from services.rate_limit import AdmissionController
+from services.concurrency import ConcurrencyLimiter, LoadShedError
+from services.deadline import DeadlineExceededError, DEADLINE_HEADER, bounded, remaining, start_deadline, timeout_for
+from services.circuit_breaker import CircuitBreaker, CircuitBreakers, CircuitOpenError, GuardedSessionFactory, is_database_failure, is_aws_failure
+from services.circuit_breaker import start_request as start_circuit_request, CIRCUIT_DEBUG_ENDPOINT_ENABLED
+from services.verification import build_verification, VerificationSweeper, VERIFICATION_SWEEPER_ENABLED
+from services.bulk_import import UserImporter
+from services.export import UserExporter, InvalidCursorError, parse_includes, EXPORT_PAGE_SIZE
+from services.image_processing import ImagePipeline, InvalidImageError, validate_image_stream, IMAGE_PIPELINE_ENABLED
+from services.storage import stream_to_s3, create_presigned_upload, head_uploaded_object, UploadTooLargeError, UPLOAD_MAX_SIZE, UPLOAD_URL_EXPIRES_IN, ALLOWED_CONTENT_TYPES
+from datetime import datetime, timezone
 import os
 import uvicorn
 import json
 import logging
-import bcrypt
 import boto3
 from botocore.exceptions import ClientError
 import uuid
-import statsd
 import time
+import asyncio
+import functools
+import hmac
+import math
+import tempfile
 
 session = boto3.Session()
 
 # the main entrypoint to use FastAPI.
-app = FastAPI()
-
-# initialize statsd client
-statsd_client = statsd.StatsClient('localhost', 8125)
+app = FastAPI(default_response_class=FastJSONResponse)
+
+# initialize statsd client, metrics are aggregated in memory and flushed in batches
+statsd_client = BufferedStatsClient()
+
+# circuit breakers of the dependencies, while a circuit is open the calls fail right away instead of waiting on
+# a failing dependency, and the routes depending on it are answered with 503 before any work starts
+circuit_breakers = CircuitBreakers(
+    [
+        CircuitBreaker("db", is_failure=is_database_failure, statsd_client=statsd_client),
+        CircuitBreaker("s3", is_failure=is_aws_failure, statsd_client=statsd_client),
+        CircuitBreaker("sns", is_failure=is_aws_failure, statsd_client=statsd_client),
+    ],
+    route_dependencies=(
+        ("/v2/user/self/pic", ("POST", "DELETE"), ("db", "s3")),
+        ("/v2/user", None, ("db",)),
+        ("/v2/admin", None, ("db",)),
+    )
+)
+
+# boto3 clients are built once per process and shared by the handlers and executors
+aws_clients = ClientRegistry(session, breakers={"s3": circuit_breakers["s3"], "sns": circuit_breakers["sns"]})
+
+# sessions opened outside of the request dependency (background jobs, import and export), refused while the database circuit is open
+guarded_session = GuardedSessionFactory(async_session, circuit_breakers["db"])
+
+# bcrypt runs in a process pool, off the event loop
+password_hasher = PasswordHasher(statsd_client=statsd_client)
+
+# database status kept in memory by a background heartbeat
+database_monitor = DatabaseHealthMonitor(statsd_client=statsd_client)
+
+# verification emails are drained from the outbox in the background
+outbox_dispatcher = OutboxDispatcher(
+    publisher=SnsPublisher(lambda: aws_clients.get('sns', region_name='us-east-1')),
+    session_factory=guarded_session,
+    statsd_client=statsd_client
+)
+
+# resized profile picture variants are rendered in the background after an upload
+image_pipeline = ImagePipeline(
+    s3_factory=lambda: aws_clients.get('s3'),
+    session_factory=guarded_session,
+    statsd_client=statsd_client
+)
+
+# opt-in statement profiler, per route query counts, slow queries and N+1 patterns
+query_profiler = QueryProfiler(statsd_client=statsd_client)
+
+# recently verified Basic auth credentials, skips the user lookup and bcrypt on a hit
+credential_cache = CredentialCache(statsd_client=statsd_client)
+
+# used and expired verifications are moved to the archive table in the background
+verification_sweeper = VerificationSweeper(session_factory=guarded_session, statsd_client=statsd_client)
+
+# per IP and per account rate limits, checked before the database and bcrypt
+admission = AdmissionController(statsd_client=statsd_client)
+
+# in flight requests capped per route group, the excess waits in a bounded queue or is shed
+concurrency_limiter = ConcurrencyLimiter(statsd_client=statsd_client)
 
 # setting up the logger 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# server settings used by the launcher at the bottom of this file
+SERVER_HOST = os.getenv("APP_SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("APP_SERVER_PORT", 8000))
+SERVER_WORKERS = int(os.getenv("APP_SERVER_WORKERS", os.cpu_count() or 1))
+SERVER_LOOP = os.getenv("APP_SERVER_LOOP", "uvloop")
+SERVER_HTTP = os.getenv("APP_SERVER_HTTP", "httptools")
+# above the 60 seconds idle timeout of the load balancer, so the app never closes a connection the balancer reuses
+SERVER_KEEP_ALIVE_TIMEOUT = int(os.getenv("APP_SERVER_KEEP_ALIVE_TIMEOUT", 65))
+SERVER_BACKLOG = int(os.getenv("APP_SERVER_BACKLOG", 2048))
+# per worker, requests above it get a 503 from uvicorn, unset means no limit
+SERVER_LIMIT_CONCURRENCY = int(os.getenv("APP_SERVER_LIMIT_CONCURRENCY")) if os.getenv("APP_SERVER_LIMIT_CONCURRENCY") else None
+SERVER_GRACEFUL_SHUTDOWN_TIMEOUT = int(os.getenv("APP_SERVER_GRACEFUL_SHUTDOWN_TIMEOUT", 30))
+SERVER_RELOAD = os.getenv("APP_SERVER_RELOAD", "false").lower() == "true"
+# set by the launcher once the schema exists, the workers then skip it on startup
+SCHEMA_INITIALIZED = os.getenv("APP_SCHEMA_INITIALIZED", "false").lower() == "true"
+# shared secret of the admin endpoints, sent as X-Admin-Token, unset disables them
+ADMIN_TOKEN = os.getenv("APP_ADMIN_TOKEN")
+
 
 def init_database():
     try:
@@ -55,16 +155,35 @@ Handle events on startup
 async def startup():
     logger.info("Startup!!")
 
-    try:
-        engine = get_engine()
-        if not database_exists(engine.url):
-            create_database(engine.url)
-            logger.info('Database created successfully!!')
-        
-        User.metadata.create_all(bind=get_engine())
-        logger.info("Database tables created successfully!!")
-    except OperationalError as e:
-        logger.error(f"Database connection error during startup: {e}")
+    # the launcher already did this once before starting the workers
+    if not SCHEMA_INITIALIZED:
+        init_database()
+
+    statsd_client.start()
+    query_profiler.attach(get_engine())
+    query_profiler.attach(get_async_engine().sync_engine)
+    await database_monitor.start()
+
+    if OUTBOX_DISPATCHER_ENABLED:
+        outbox_dispatcher.start()
+
+    if VERIFICATION_SWEEPER_ENABLED:
+        verification_sweeper.start()
+
+'''
+Handle events on shutdown
+'''
+@app.on_event('shutdown')
+async def shutdown():
+    logger.info("Shutdown!!")
+    await database_monitor.stop()
+    query_profiler.detach()
+    await outbox_dispatcher.stop()
+    await verification_sweeper.stop()
+    await image_pipeline.stop()
+    await dispose_async_engine()
+    password_hasher.shutdown()
+    await statsd_client.stop()
 
 '''
 Handle lifespan events like startup and shutdown
@@ -100,40 +219,173 @@ HEADERS = {
         "X-Content-Type-Options": 'nosniff'
     }
 
-# middleware to track API calls and timing
+# the profile may be stored by the client, as long as it is revalidated with its ETag
+PROFILE_HEADERS = {
+        "Cache-Control": 'private, no-cache',
+        "X-Content-Type-Options": 'nosniff'
+    }
+
+# middleware to cap the requests in flight per route group, declared first so the rate limits reject before a request
+# takes a slot, requests which cannot get one in time are shed before any work started.
+# A plain ASGI middleware, the slot is released once the whole body was sent, streamed exports included
+class LimitConcurrency:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        group = concurrency_limiter.group_for(scope["path"]) if scope["type"] == "http" else None
+        if group is None:
+            return await self.app(scope, receive, send)
+
+        try:
+            # a request never queues past its deadline
+            await concurrency_limiter.acquire(group, timeout=remaining())
+        except LoadShedError:
+            response = Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers={**HEADERS, "Retry-After": "1"})
+            return await response(scope, receive, send)
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            group.release()
+
+app.add_middleware(LimitConcurrency)
+
+# middleware to fail fast while a dependency of the route is down, declared around the concurrency limiter so these
+# requests never take a slot, a call turned away by an open circuit inside the handler also ends with 503
 @app.middleware('http')
-async def add_process_time_header(request: Request, call_next):
-    start_time = time.time()
-    response = await call_next(request)
-    process_time = time.time() - start_time
-    # process time in milliseconds
-    statsd_client.timing(f'api.{request.url.path}.time', process_time)
-    statsd_client.incr(f'api.{request.url.path}.count')
+async def fail_fast(request: Request, call_next):
+    retry_after, _ = circuit_breakers.retry_after(request.method, request.scope["path"])
+    if retry_after:
+        return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers={**HEADERS, "Retry-After": str(math.ceil(retry_after))})
+
+    rejections = start_circuit_request()
+    try:
+        response = await call_next(request)
+    except CircuitOpenError:
+        response = None
+
+    if rejections:
+        return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers={**HEADERS, "Retry-After": "1"})
+    return response
+
+# middleware to bound every request by its deadline, the calls to the database and S3 get what is left of it
+# and a request which ran out of time is answered with 504, even if the handler turned the timeout into another error
+@app.middleware('http')
+async def enforce_deadline(request: Request, call_next):
+    deadline = start_deadline(timeout_for(request.scope["path"], request.headers.get(DEADLINE_HEADER)))
+    if deadline is None:
+        return await call_next(request)
+
+    try:
+        response = await call_next(request)
+    except DeadlineExceededError:
+        response = None
+
+    if deadline.exceeded:
+        logger.info(f"{request.scope['path']}: deadline exceeded waiting on {deadline.exceeded}...")
+        statsd_client.incr('deadline.exceeded', tags={"dependency": deadline.exceeded})
+        return Response(status_code=status.HTTP_504_GATEWAY_TIMEOUT, headers=HEADERS)
     return response
 
-# database query timing decorator
+# middleware to rate limit the requests, declared after the concurrency, circuit breaker and deadline middlewares so it
+# runs before them and a rejected request never takes a slot, and before the timing middleware so the rejections are measured
+@app.middleware('http')
+async def rate_limit(request: Request, call_next):
+    retry_after, reason = admission.admit(request.scope)
+    if retry_after:
+        return Response(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            headers={**HEADERS, "Retry-After": str(math.ceil(min(retry_after, 3600)))}
+        )
+    return await call_next(request)
+
+# middleware to track API calls and timing
+@app.middleware('http')
+async def add_process_time_header(request: Request, call_next):
+    start_time = time.perf_counter()
+    # per dependency breakdown of the sampled requests
+    recorder = start_request()
+    query_profile = query_profiler.start_request()
+    status_code = 500
+    response = None
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        # process time in milliseconds, keyed by the route template so path parameters and 404 probes
+        # do not create new metrics
+        process_time = (time.perf_counter() - start_time) * 1000
+        route = route_name(request.scope)
+        metric = f'api.{route}.{request.method}'
+        tags = {"status_class": status_class(status_code)}
+        statsd_client.timing(f'{metric}.time', process_time, tags=tags)
+        statsd_client.incr(f'{metric}.count', tags=tags)
+
+        if query_profile is not None:
+            query_profiler.finish_request(query_profile, route, request.method)
+
+        if recorder is not None:
+            if response is not None:
+                response.headers["Server-Timing"] = recorder.server_timing(process_time)
+            log_request(recorder, request.method, route, status_code, process_time)
+
+# database query timing decorator, works for both the sync and the async queries
 def time_database_query(func):
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            tags = {"timeout": "false"}
+            with statsd_client.timer('database.query.time', tags=tags), span('db'), circuit_breakers["db"].protect():
+                try:
+                    return await bounded(func(*args, **kwargs), 'db')
+                except DeadlineExceededError:
+                    tags["timeout"] = "true"
+                    raise
+        return async_wrapper
+
     def wrapper(*args, **kwargs):
-        with statsd_client.timer('database.query.time'):
+        with statsd_client.timer('database.query.time'), span('db'):
             return func(*args, **kwargs)
     return wrapper
 
-# s3 call timing decorator
+# s3 call timing decorator, also reports how saturated the shared S3 connection pool is
 def time_s3_call(func):
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            tags = {"timeout": "false"}
+            try:
+                with statsd_client.timer('aws.s3.call.time', tags=tags), span('s3'):
+                    try:
+                        return await bounded(func(*args, **kwargs), 's3')
+                    except DeadlineExceededError:
+                        tags["timeout"] = "true"
+                        raise
+            finally:
+                statsd_client.gauge('aws.s3.pool.in_use', aws_clients.pool_stats('s3')["in_use"])
+        return async_wrapper
+
     def wrapper(*args, **kwargs):
-        with statsd_client.timer('aws.s3.call.time'):
-            return func(*args, **kwargs)
+        try:
+            with statsd_client.timer('aws.s3.call.time'), span('s3'):
+                return func(*args, **kwargs)
+        finally:
+            statsd_client.gauge('aws.s3.pool.in_use', aws_clients.pool_stats('s3')["in_use"])
     return wrapper
 
 """
 Function: authenticate
 Descr: This function authenticates the user based on the Basic Auth token passed to the server
-params: credentials: HTTPBasicCredentials, db: Session
+       and resolves the user once per request, handlers get the AuthenticatedUser instead of re-querying it
+params: credentials: HTTPBasicCredentials, db: AsyncSession
 """
-def authenticate(credentials: HTTPBasicCredentials = Depends(security), db: Session = Depends(get_database_session)):
-    if not get_database_connection():
+@traced('auth')
+async def authenticate(credentials: HTTPBasicCredentials = Depends(security), db: AsyncSession = Depends(get_async_database_session)) -> AuthenticatedUser:
+    if not database_monitor.is_healthy:
         logger.info(f"Database connection error... ")
-        return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers=HEADERS)
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers=HEADERS)
     
     if not credentials:
         logger.info("Credentials not passed!!!")
@@ -142,15 +394,32 @@ def authenticate(credentials: HTTPBasicCredentials = Depends(security), db: Sess
     user_to_authenticate = credentials.username.strip()
     password_to_authenticate = credentials.password.strip()
 
+    cached_user = credential_cache.get(user_to_authenticate, password_to_authenticate)
+    if cached_user:
+        logger.info("User authenticated from the credential cache!")
+        return cached_user
+
+    # emails looked up without success a moment ago are rejected without a query
+    if admission.is_unknown_email(user_to_authenticate):
+        logger.info("Invalid authentication credentials - unknown email!")
+        admission.record_auth_failure(user_to_authenticate)
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid authentication credentials!",
+            headers={'WWW-Authenticate': "Basic"}
+        )
+
     @time_database_query
-    def get_user_from_db(db, user_to_authenticate):
-        user = db.query(User).filter(User.email == user_to_authenticate).first()
+    async def get_user_from_db(db, user_to_authenticate):
+        user = await queries.get_user_by_email(db, user_to_authenticate)
         return user
     
-    user = get_user_from_db(db, user_to_authenticate)
+    user = await get_user_from_db(db, user_to_authenticate)
 
     if not user:
         logger.info("Invalid authentication credentials - email!")
+        admission.remember_unknown_email(user_to_authenticate)
+        admission.record_auth_failure(user_to_authenticate)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid authentication credentials!",
@@ -159,10 +428,15 @@ def authenticate(credentials: HTTPBasicCredentials = Depends(security), db: Sess
 
     logger.info("User exists, checking for password match...")
 
-    dehashed_password = bcrypt.checkpw(password_to_authenticate.encode('utf-8'), user.password.encode('utf-8'))
+    try:
+        dehashed_password = await password_hasher.check_password(password_to_authenticate, user.password)
+    except HashingQueueFullError:
+        logger.info("Hashing queue is full!")
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
 
     if not dehashed_password:
         logger.info("Invalud authentication credentials!")
+        admission.record_auth_failure(user_to_authenticate)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid authentication credentials!",
@@ -176,6 +450,7 @@ def authenticate(credentials: HTTPBasicCredentials = Depends(security), db: Sess
     # Check if user is verified
     if not user.is_verified:
         logger.info("User email not verified!")
+        credential_cache.invalidate(user_to_authenticate)
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Please verify your email before accessing this resource",
@@ -184,7 +459,12 @@ def authenticate(credentials: HTTPBasicCredentials = Depends(security), db: Sess
 
     logger.info("Email verified: User is authorized!")
 
-    return user.email
+    authenticated_user = AuthenticatedUser.model_validate(user)
+
+    # only verified users are cached, so a hit never bypasses the verification check
+    credential_cache.set(user_to_authenticate, password_to_authenticate, authenticated_user)
+
+    return authenticated_user
 
 '''
 API Endpoints
@@ -202,10 +482,16 @@ async def healthcheck(request: Request, response: Response):
         return Response(status_code=status.HTTP_400_BAD_REQUEST, headers=HEADERS)
     
     # checks if the database connection is up
-    if not get_database_connection():
+    if not database_monitor.is_healthy:
         logger.info("/healthz: database is not up yet...")
         return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers=HEADERS)
     
+    # dependencies with an open circuit, from memory, the instance itself still serves the other routes
+    degraded = circuit_breakers.degraded()
+    if degraded:
+        logger.info(f"/healthz: degraded dependencies: {degraded}...")
+        return Response(status_code=status.HTTP_200_OK, headers={**HEADERS, "X-Degraded-Dependencies": ",".join(degraded)})
+
     logger.info("/healthz: the database is up and in service...")
     return Response(status_code=status.HTTP_200_OK, headers=HEADERS)
 
@@ -223,12 +509,39 @@ async def cicd(request: Request, response: Response):
         return Response(status_code=status.HTTP_400_BAD_REQUEST, headers=HEADERS)
     
     # checks if the database connection is up
-    if not get_database_connection():
+    if not database_monitor.is_healthy:
         logger.info("/cicd_new: database is not up yet...")
         return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers=HEADERS)
     
     logger.info("/cicd_new: the database is up and in service...")
     return Response(status_code=status.HTTP_200_OK, headers=HEADERS)
+
+"""
+GET: /debug/queries
+Per route statement counts collected by the query profiler, disabled unless APP_QUERY_DEBUG_ENDPOINT_ENABLED is set
+"""
+@app.get("/debug/queries")
+async def debug_queries(request: Request):
+    if not QUERY_DEBUG_ENDPOINT_ENABLED:
+        return Response(status_code=status.HTTP_404_NOT_FOUND, headers=HEADERS)
+
+    if request.query_params.get("reset") == "true":
+        query_profiler.reset()
+        return Response(status_code=status.HTTP_204_NO_CONTENT, headers=HEADERS)
+
+    return JSONResponse(status_code=status.HTTP_200_OK, content=query_profiler.snapshot(), headers=HEADERS)
+
+"""
+GET: /debug/circuits
+State of the circuit breakers, disabled unless APP_CIRCUIT_DEBUG_ENDPOINT_ENABLED is set
+"""
+@app.get("/debug/circuits")
+async def debug_circuits(request: Request):
+    if not CIRCUIT_DEBUG_ENDPOINT_ENABLED:
+        return Response(status_code=status.HTTP_404_NOT_FOUND, headers=HEADERS)
+
+    return JSONResponse(status_code=status.HTTP_200_OK, content=circuit_breakers.stats(), headers=HEADERS)
+
 """
 /healthz
 POST, PUT, PATCH, DELETE, HEAD, OPTIONS 
@@ -250,85 +563,158 @@ POST: /v2/user
 Create a user
 """
 @app.post("/v2/user", response_model=UserSchema, status_code=status.HTTP_201_CREATED)
-async def create_user(request: Request, user: UserRequestBodyModel, db: Session = Depends(get_database_session)):
+async def create_user(request: Request, user: UserRequestBodyModel, db: AsyncSession = Depends(get_async_database_session)):
 
     if request.query_params:
         logger.info("/v2/user: POST: query params not allowed...")
         return Response(status_code=status.HTTP_400_BAD_REQUEST)
 
     try:
-        if not get_database_connection():
+        if not database_monitor.is_healthy:
             logger.info("/v2/user: POST: database is not up yet...")
             return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers=HEADERS)
 
-        if db.query(User).filter(User.email == user.email).first():
+        @time_database_query
+        async def get_existing_user(db, email):
+            return await queries.get_user_by_email(db, email)
+
+        if await get_existing_user(db, user.email):
             logger.error(f"/v2/user: POST: Database error... User already exists!!")
             return Response(status_code=status.HTTP_400_BAD_REQUEST, headers=HEADERS)
         
-        hashed_password = bcrypt.hashpw(password=user.password.encode('utf-8'), salt=bcrypt.gensalt())
+        hashed_password = await password_hasher.hash_password(user.password)
 
         new_user = User(
             email=user.email.strip(), 
-            password=hashed_password.decode('utf-8'), 
+            password=hashed_password, 
             first_name=user.first_name.strip(), 
             last_name=user.last_name.strip()
         )
         
+        # the verification email is published by the outbox dispatcher, not in the request
+        verification_values, outbox_values = build_verification(new_user.email, new_user.first_name, new_user.last_name)
+        verification = Verification(**verification_values)
+        outbox_message = OutboxMessage(**outbox_values) if outbox_values else None
+
         @time_database_query
-        def create_user_in_db(db, new_user): 
-            db.add(new_user)
-            db.commit()
-            db.refresh(new_user)
+        async def create_user_in_db(db, new_user, verification, outbox_message): 
+            await queries.add_user_with_verification(db, new_user, verification, outbox_message)
         
-        create_user_in_db(db, new_user)
+        await create_user_in_db(db, new_user, verification, outbox_message)
 
         logger.info("/v2/user: POST: user created and saved in the database successfully...")
+        admission.forget_unknown_email(new_user.email)
 
-        token = str(uuid.uuid4())
-        nyc_timezone = ZoneInfo("America/New_York")
-        nyc_time = datetime.now(nyc_timezone)
-        expiration_time = nyc_time + timedelta(minutes=3)
-        verification_link = f'{os.getenv('APP_API_ENDPOINT')}/v2/user/verify?token={token}'
+        outbox_dispatcher.wake()
 
-        logger.info("Creating SNS client...")
-        
-        # SNS client creation
-        sns_client = session.client('sns', region_name='us-east-1')
-        SNS_TOPIC_ARN = os.getenv('APP_SNS_TOPIC_ARN')
-
-        message = {
-            "username": f'{new_user.first_name} {new_user.last_name}',
-            "email": new_user.email,
-            "verification_link": verification_link,
-            "expiration_time": str(expiration_time),
-            "token": token
-        }
+        # returning a response skips the response_model validation, UserSchema stays for the docs
+        return FastJSONResponse(status_code=status.HTTP_201_CREATED, content=serialize_user(new_user))
 
-        try:
-            response = sns_client.publish(
-                TopicArn = SNS_TOPIC_ARN,
-                Message = json.dumps(message),
-                MessageStructure = 'string'
-            )
-
-        except ClientError as e:
-            logger.error(f"Failed to publish message to SNS: {e}")
-            return Response(status_code=status.HTTP_400_BAD_REQUEST, headers=HEADERS)
+    except HashingQueueFullError:
+        logger.info("/v2/user: POST: hashing queue is full...")
+        return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers=HEADERS)
+    except Exception as e:
+        logger.error(f"/v2/user: POST: Database error... {e}")
+        return Response(status_code=status.HTTP_400_BAD_REQUEST, headers=HEADERS)
 
-        return new_user
+"""
+Function: is_admin_request
+Descr: Checks the X-Admin-Token header against APP_ADMIN_TOKEN
+params: request: Request
+"""
+def is_admin_request(request: Request) -> bool:
+    token = request.headers.get("x-admin-token")
+    return bool(ADMIN_TOKEN) and token is not None and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+"""
+Function: iter_report
+Descr: Streams the spooled import report back and closes it at the end
+params: report_file: file object
+"""
+def iter_report(report_file, chunk_size: int = 64 * 1024):
+    try:
+        report_file.seek(0)
+        while chunk := report_file.read(chunk_size):
+            yield chunk
+    finally:
+        report_file.close()
+
+"""
+POST: /v2/admin/users/import
+Bulk create users from an NDJSON body, one UserRequestBodyModel per line, returns the per record results as NDJSON
+"""
+@app.post("/v2/admin/users/import")
+async def import_users(request: Request):
+    if not is_admin_request(request):
+        logger.info("/v2/admin/users/import: POST: not an admin request...")
+        return Response(status_code=status.HTTP_404_NOT_FOUND, headers=HEADERS)
 
+    if not database_monitor.is_healthy:
+        logger.info("/v2/admin/users/import: POST: database is not up yet...")
+        return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers=HEADERS)
+
+    def on_import_chunk_committed(created_emails):
+        # the new accounts may have been looked up as unknown emails a moment ago
+        for email in created_emails:
+            admission.forget_unknown_email(email)
+        outbox_dispatcher.wake()
+
+    importer = UserImporter(
+        session_factory=guarded_session,
+        password_hasher=password_hasher,
+        on_chunk_committed=on_import_chunk_committed,
+        statsd_client=statsd_client
+    )
+
+    # the report is spooled to disk and sent once the whole body is read, memory stays flat for any input size
+    report_file = tempfile.TemporaryFile()
+    try:
+        summary = await importer.run_to_file(request.stream(), report_file)
     except Exception as e:
-        logger.error(f"/v2/user: POST: Database error... {e}")
+        report_file.close()
+        logger.error(f"/v2/admin/users/import: POST: import failed... {e}")
         return Response(status_code=status.HTTP_400_BAD_REQUEST, headers=HEADERS)
 
+    logger.info(f"/v2/admin/users/import: POST: {summary}")
+    return StreamingResponse(iter_report(report_file), status_code=status.HTTP_200_OK, media_type="application/x-ndjson", headers=HEADERS)
+
+"""
+GET: /v2/admin/users/export
+Streams all users as NDJSON or CSV, ?format=ndjson|csv&include=images,verifications&cursor=<token to resume after>
+"""
+@app.get("/v2/admin/users/export")
+async def export_users(request: Request, format: str = "ndjson", include: str = "", cursor: str = None, page_size: int = EXPORT_PAGE_SIZE):
+    if not is_admin_request(request):
+        logger.info("/v2/admin/users/export: GET: not an admin request...")
+        return Response(status_code=status.HTTP_404_NOT_FOUND, headers=HEADERS)
+
+    if not database_monitor.is_healthy:
+        logger.info("/v2/admin/users/export: GET: database is not up yet...")
+        return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers=HEADERS)
+
+    try:
+        exporter = UserExporter(
+            session_factory=guarded_session,
+            format=format,
+            includes=parse_includes(include),
+            page_size=min(page_size, EXPORT_PAGE_SIZE),
+            cursor=cursor
+        )
+    except (ValueError, InvalidCursorError) as e:
+        logger.info(f"/v2/admin/users/export: GET: {e}")
+        return Response(status_code=status.HTTP_400_BAD_REQUEST, headers=HEADERS)
+
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(exporter.run(), status_code=status.HTTP_200_OK, media_type=media_type, headers=HEADERS)
+
 """
 GET /v1/user/self
 Get User based on authentication
 """
-@app.get("/v2/user/self", dependencies=[Depends(authenticate)], response_model=UserSchema)
-async def get_user(request: Request, authenticated_email: str = Depends(authenticate), db: Session = Depends(get_database_session)):
+@app.get("/v2/user/self", response_model=UserSchema)
+async def get_user(request: Request, authenticated_user: AuthenticatedUser = Depends(authenticate)):
     try:
-        if not get_database_connection():
+        if not database_monitor.is_healthy:
             logger.info("/v2/user/self: GET: database is not up yet...")
             return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers=HEADERS)
         
@@ -348,71 +734,69 @@ async def get_user(request: Request, authenticated_email: str = Depends(authenti
         if body:
             return Response(status_code=status.HTTP_400_BAD_REQUEST)
 
-        @time_database_query
-        def get_user_from_db(db, authenticated_email):
-            user = db.query(User).filter(User.email == authenticated_email).first()
-            return user
-
-        user = get_user_from_db(db, authenticated_email)
+        # the ETag only depends on the user loaded by authenticate, an unchanged profile is not serialized at all
+        etag = make_etag(authenticated_user.id, authenticated_user.account_updated)
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            logger.info("/v2/user/self: GET: user not modified...")
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={**PROFILE_HEADERS, "ETag": etag})
 
+        body = dumps(serialize_user(authenticated_user))
         logger.info("/v2/user/self: GET: user retrieved and returned successfully...")
 
-        return user
+        return Response(status_code=status.HTTP_200_OK, content=body, media_type="application/json", headers={**PROFILE_HEADERS, "ETag": etag})
     except Exception as e:
-        print(f"/v2/user/self: GET: Server error... {e}")
+        logger.error(f"/v2/user/self: GET: Server error... {e}")
         return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
 
 """
 PUT: /v2/user/self
 Update user based on authentication
 """
-@app.put("/v2/user/self", dependencies=[Depends(authenticate)])
-async def update_user(request: Request, user_details: UserUpdateRequestBodyModel, authenticated_email: str = Depends(authenticate),  db: Session = Depends(get_database_session)):
+@app.put("/v2/user/self")
+async def update_user(request: Request, user_details: UserUpdateRequestBodyModel, authenticated_user: AuthenticatedUser = Depends(authenticate),  db: AsyncSession = Depends(get_async_database_session)):
 
     if request.query_params:
         logger.info("/v2/user/self: PUT: query params not allowed...")
         return Response(status_code=status.HTTP_400_BAD_REQUEST)
 
     try:
-        @time_database_query
-        def get_user_from_db(db, authenticated_email):
-            user = db.query(User).filter(User.email == authenticated_email).first()
-            return user
-
-        user = get_user_from_db(db, authenticated_email)
-
-        if authenticated_email != user_details.email:
+        if authenticated_user.email != user_details.email:
             logger.info("/v2/user/self: PUT: Updates to email are not allowed...")
             return Response(status_code=status.HTTP_400_BAD_REQUEST)
 
-        if not user:
-            logger.info("/v2/user/self: PUT: User not found...")
-            return Response(status_code=status.HTTP_404_NOT_FOUND, headers=HEADERS)
+        # the user was already loaded by authenticate, so the changes go out as a single UPDATE
+        values = {}
 
         if user_details.first_name is not None:
-            user.first_name = user_details.first_name
+            values["first_name"] = user_details.first_name
             logger.info("/v2/user/self: PUT: Updated the first name...")
         
         if user_details.last_name is not None:
-            user.last_name = user_details.last_name
+            values["last_name"] = user_details.last_name
             logger.info("/v2/user/self: PUT: Updated the last name...")
         
         if user_details.password is not None:
-            hashed_password = bcrypt.hashpw(password=user_details.password.encode('utf-8'), salt=bcrypt.gensalt())
-            user.password = hashed_password.decode('utf-8')
+            values["password"] = await password_hasher.hash_password(user_details.password)
             logger.info("/v2/user/self: PUT: Updated the password...")
 
         @time_database_query
-        def update_user_in_db(db, user):
-            db.commit()
-            db.refresh(user)
-        
-        update_user_in_db(db, user)
+        async def update_user_in_db(db, user_id, values):
+            return await queries.update_user_by_id(db, user_id, values)
+
+        if values and not await update_user_in_db(db, authenticated_user.id, values):
+            logger.info("/v2/user/self: PUT: User not found...")
+            return Response(status_code=status.HTTP_404_NOT_FOUND, headers=HEADERS)
+
+        # the cached credentials may hold the old password and the old names
+        credential_cache.invalidate(authenticated_user.email)
 
         logger.info("/v2/user/self: PUT: Updated the user in the db...")
 
         return Response(status_code=status.HTTP_204_NO_CONTENT, headers=HEADERS)
 
+    except HashingQueueFullError:
+        logger.info("/v2/user/self: PUT: hashing queue is full...")
+        return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers=HEADERS)
     except Exception as e:
         logger.info(f"/v2/user/self: PUT: Database error... {e}")
         return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers=HEADERS)
@@ -436,22 +820,28 @@ def users():
 POST: /v2/user/self/pic
 Update user based on authentication
 """
-@app.post("/v2/user/self/pic", dependencies=[Depends(authenticate)])
+@app.post("/v2/user/self/pic")
 async def upload_profile_pic(
     request: Request,
-    authenticated_email: str = Depends(authenticate),
-    db: Session = Depends(get_database_session)
+    user: AuthenticatedUser = Depends(authenticate),
+    db: AsyncSession = Depends(get_async_database_session)
 ):
     if request.query_params:
         logger.info("/v2/user/self/pic: POST: query params not allowed...")
         return Response(status_code=status.HTTP_400_BAD_REQUEST)
-    # Read binary data from the request body
-    body = await request.body()
+
+    # reject oversized uploads before reading anything, the size is enforced again while streaming
+    content_length = request.headers.get('Content-Length')
+    if content_length is not None and content_length.isdigit() and int(content_length) > UPLOAD_MAX_SIZE:
+        logger.info("/v2/user/self/pic: POST: Image is larger than the maximum upload size.")
+        return Response(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, headers=HEADERS)
 
     try:
-        user = db.query(User).filter(User.email == authenticated_email).first()
+        @time_database_query
+        async def get_existing_image(db, user_id):
+            return await queries.get_image_by_user_id(db, user_id)
 
-        existing_image = db.query(Image).filter(Image.user_id == user.id).first()
+        existing_image = await get_existing_image(db, user.id)
 
         if existing_image:
             logger.info("/v2/user/self/pic: POST: User already has a profile picture. Delete the existing image before uploading a new one.")
@@ -462,14 +852,13 @@ async def upload_profile_pic(
         return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers=HEADERS)
 
 
-    # print("DEBUG body: ", type(body), body)
     # as the body is of type binary bytes we cannot see the filename as metadata
     # but we can do that with the help of UploadFile class where we upload from Postman
     # as form-data
     
     # Validate content type (assuming it's sent as a header)
     content_type = request.headers.get('Content-Type')
-    if content_type not in ["image/jpeg", "image/png", "image/jpg"]:
+    if content_type not in ALLOWED_CONTENT_TYPES:
         logger.info("/v2/user/self/pic: POST: Invalid file type. Only JPEG, JPG, and PNG are allowed.")
         raise HTTPException(status_code=400, detail="Invalid file type. Only JPEG, JPG, and PNG are allowed.")
 
@@ -480,23 +869,32 @@ async def upload_profile_pic(
     # generate a key - create a folder by the userid-firstname/filename
     s3_file_key = f'{user.id}-{user.first_name}-{user.last_name}/{unique_filename}'
 
-    print(file_extension)
-    print(content_type.split("/"))
+    logger.info(f"/v2/user/self/pic: POST: uploading {s3_file_key}...")
 
-    # upload to s3 bucket
+    # stream the body to the s3 bucket, only one part is held in memory at a time
     @time_s3_call
-    def upload_image_to_s3(s3_file_key, body, content_type):
-        s3 = session.client("s3")
+    async def upload_image_to_s3(s3_file_key, chunks, content_type):
+        s3 = aws_clients.get("s3", timeout=remaining())
         bucket_name = os.getenv("APP_S3_BUCKET_NAME")
 
         try:
-            s3_response = s3.put_object(Bucket=bucket_name, Key=s3_file_key, Body=body, ContentType=content_type)
+            await stream_to_s3(s3, bucket_name, s3_file_key, content_type, chunks)
             logger.info("/v2/user/self/pic: POST: image uploaded to S3 successfully...")
             return f"https://{bucket_name}.s3.amazonaws.com/{s3_file_key}"
+        except (UploadTooLargeError, InvalidImageError):
+            raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Failed to upload the file to S3 bucket: {str(e)}")
     
-    image_url = upload_image_to_s3(s3_file_key, body, content_type)
+    try:
+        # the magic bytes are checked against the content type as the first chunks arrive
+        image_url = await upload_image_to_s3(s3_file_key, validate_image_stream(request.stream(), content_type), content_type)
+    except UploadTooLargeError:
+        logger.info("/v2/user/self/pic: POST: Image is larger than the maximum upload size.")
+        return Response(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, headers=HEADERS)
+    except InvalidImageError:
+        logger.info("/v2/user/self/pic: POST: The file content does not match the content type.")
+        raise HTTPException(status_code=400, detail="Invalid file type. Only JPEG, JPG, and PNG are allowed.")
 
     try:
 
@@ -508,21 +906,17 @@ async def upload_profile_pic(
         )
         
         @time_database_query
-        def insert_image_in_db(db, image):
-            db.add(image)
-            db.commit()
+        async def insert_image_in_db(db, image):
+            await queries.add_image(db, image)
         
-        insert_image_in_db(db, new_image)
+        await insert_image_in_db(db, new_image)
 
         logger.info("/v2/user/self/pic: POST: image uploaded to the database successfully...")
 
-        return {
-            "file_name": unique_filename,
-            "id": new_image.id,
-            "url": image_url,
-            "upload_date": new_image.upload_date,
-            "user_id": user.id
-        }
+        if IMAGE_PIPELINE_ENABLED:
+            image_pipeline.submit(new_image.id, s3_file_key)
+
+        return FastJSONResponse(status_code=status.HTTP_200_OK, content=serialize_image(new_image, file_name=unique_filename))
 
     except Exception as e:
         logger.info(f"/v2/user/self/pic: POST: Database error... {e}")
@@ -534,32 +928,22 @@ async def upload_profile_pic(
 GET: /v2/user/self/pic
 Get user's image 
 """
-@app.get("/v2/user/self/pic", dependencies=[Depends(authenticate)])
+@app.get("/v2/user/self/pic")
 async def upload_profile_pic(
     request: Request,
-    authenticated_email: str = Depends(authenticate),
-    db: Session = Depends(get_database_session)
+    user: AuthenticatedUser = Depends(authenticate),
+    db: AsyncSession = Depends(get_async_database_session)
 ):
     if request.query_params:
         logger.info("/v2/user/self/pic: GET: query params not allowed...")
         return Response(status_code=status.HTTP_400_BAD_REQUEST)
     try:
-        
-        @time_database_query
-        def get_user_from_db(db, authenticated_email):
-            user = db.query(User).filter(User.email == authenticated_email).first()
-            return user
-
-        user = get_user_from_db(db, authenticated_email)
-
-        logger.info(f"/v2/user/self/pic: GET: User found..")
-
         @time_database_query
-        def get_image_from_db(db, user):
-            image = db.query(Image).filter(Image.user_id == user.id).first()
+        async def get_image_from_db(db, user):
+            image = await queries.get_image_with_variants_by_user_id(db, user.id)
             return image
 
-        image = get_image_from_db(db, user)
+        image = await get_image_from_db(db, user)
 
         if not image:
             logger.info(f"/v2/user/self/pic: GET: Image not found..")
@@ -567,13 +951,7 @@ async def upload_profile_pic(
 
         logger.info(f"/v2/user/self/pic: GET: Image found..")
 
-        return {
-            "file_name": image.file_name,
-            "id": image.id,
-            "url": image.url,
-            "upload_date": image.upload_date,
-            "user_id": image.user_id
-        }
+        return FastJSONResponse(status_code=status.HTTP_200_OK, content=serialize_image(image, variants=image.variants))
     except HTTPException as he:
         logger.info(f"/v2/user/self/pic: GET: Image not found: {he}")
         return Response(status_code=status.HTTP_404_NOT_FOUND, headers=HEADERS)
@@ -585,31 +963,22 @@ async def upload_profile_pic(
 DELETE: /v2/user/self/pic
 Delete user's image 
 """
-@app.delete("/v2/user/self/pic", dependencies=[Depends(authenticate)], status_code=204)
+@app.delete("/v2/user/self/pic", status_code=204)
 async def upload_profile_pic(
     request: Request,
-    authenticated_email: str = Depends(authenticate),
-    db: Session = Depends(get_database_session)
+    user: AuthenticatedUser = Depends(authenticate),
+    db: AsyncSession = Depends(get_async_database_session)
 ): 
     if request.query_params:
         logger.info("/v2/user/self/pic: DELETE: query params not allowed...")
         return Response(status_code=status.HTTP_400_BAD_REQUEST)
     try:
         @time_database_query
-        def get_user_from_db(db, authenticated_email):
-            user = db.query(User).filter(User.email == authenticated_email).first()
-            return user
-
-        user = get_user_from_db(db, authenticated_email)
-
-        logger.info(f"/v2/user/self/pic: DELETE: User found..")
-
-        @time_database_query
-        def get_image_from_db(db, user):
-            image = db.query(Image).filter(Image.user_id == user.id).first()
+        async def get_image_from_db(db, user):
+            image = await queries.get_image_with_variants_by_user_id(db, user.id)
             return image
 
-        image = get_image_from_db(db, user)
+        image = await get_image_from_db(db, user)
 
         if not image:
             raise HTTPException(status_code=404, detail="Image not found!")
@@ -617,30 +986,33 @@ async def upload_profile_pic(
         # delete the image from the S3 bucket
         @time_s3_call
         def delete_image_from_s3(image):
-            s3 = session.client('s3')
+            # asyncio.to_thread copies the context, the deadline of the request is visible here
+            s3 = aws_clients.get('s3', timeout=remaining())
             bucket_name = os.getenv("APP_S3_BUCKET_NAME")
 
             try:
                 logger.info(f"/v2/user/self/pic: DELETE: Image to be deleted: {image.file_name}")
                 s3.delete_object(Bucket=bucket_name, Key=image.file_name)
+                for variant in image.variants:
+                    s3.delete_object(Bucket=bucket_name, Key=variant.file_name)
                 logger.info("/v2/user/self/pic: DELETE: Image deletion from S3 is successful..")
 
             except Exception as e:
                 raise HTTPException(status_code=500, detail=f"Failed to delete from the S3 bucket: {str(e)}")
-            
-        delete_image_from_s3(image)
+
+        # boto3 is blocking, keep it off the event loop and within the request deadline
+        await bounded(asyncio.to_thread(delete_image_from_s3, image), 's3')
         
         @time_database_query
-        def delete_image_from_db(db, image):
-            db.delete(image)
+        async def delete_image_from_db(db, image):
+            await queries.delete_image(db, image)
             logger.info("/v2/user/self/pic: DELETE: Image deletion from DB is successful..")
-            db.commit()
         
-        delete_image_from_db(db, image)
+        await delete_image_from_db(db, image)
 
     except HTTPException as he:
         if he.status_code == 404:
-            print(f"/v2/user/self/pic: DELETE: Image not found error... {he}")
+            logger.info(f"/v2/user/self/pic: DELETE: Image not found error... {he}")
             return Response(status_code=status.HTTP_404_NOT_FOUND, headers=HEADERS)
         elif he.status_code == 500:
             logger.info(f"/v2/user/self/pic: DELETE: Failed to delete from the S3 bucket: {str(he)}")
@@ -649,6 +1021,141 @@ async def upload_profile_pic(
         logger.info(f"/v2/user/self/pic: DELETE: Server: unexpected error!!: {e}")
         return Response(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, headers=HEADERS)
 """
+POST: /v2/user/self/pic/upload-url
+Returns a presigned POST so the client uploads the image straight to S3
+"""
+@app.post("/v2/user/self/pic/upload-url")
+async def create_profile_pic_upload_url(
+    request: Request,
+    upload_details: PresignedUploadRequestBodyModel,
+    user: AuthenticatedUser = Depends(authenticate),
+    db: AsyncSession = Depends(get_async_database_session)
+):
+    if request.query_params:
+        logger.info("/v2/user/self/pic/upload-url: POST: query params not allowed...")
+        return Response(status_code=status.HTTP_400_BAD_REQUEST)
+
+    if upload_details.content_type not in ALLOWED_CONTENT_TYPES:
+        logger.info("/v2/user/self/pic/upload-url: POST: Invalid file type. Only JPEG, JPG, and PNG are allowed.")
+        raise HTTPException(status_code=400, detail="Invalid file type. Only JPEG, JPG, and PNG are allowed.")
+
+    try:
+        @time_database_query
+        async def get_image_from_db(db, user):
+            image = await queries.get_image_by_user_id(db, user.id)
+            return image
+
+        if await get_image_from_db(db, user):
+            logger.info("/v2/user/self/pic/upload-url: POST: User already has a profile picture.")
+            return Response(status_code=status.HTTP_400_BAD_REQUEST, content=json.dumps({'message': 'User already has a profile picture. Delete the existing image before uploading a new one.'}))
+    except Exception as e:
+        logger.info(f"/v2/user/self/pic/upload-url: POST: Database error... {e}")
+        return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers=HEADERS)
+
+    # same key scheme as the uploads going through the app
+    file_extension = upload_details.content_type.split("/")[-1]
+    unique_filename = f"profile-pic-{uuid.uuid4()}.{file_extension}"
+    s3_file_key = f'{user.id}-{user.first_name}-{user.last_name}/{unique_filename}'
+
+    @time_s3_call
+    def create_upload_url(s3_file_key, content_type):
+        s3 = aws_clients.get("s3")
+        bucket_name = os.getenv("APP_S3_BUCKET_NAME")
+        return create_presigned_upload(s3, bucket_name, s3_file_key, content_type)
+
+    try:
+        presigned_post = create_upload_url(s3_file_key, upload_details.content_type)
+    except Exception as e:
+        logger.info(f"/v2/user/self/pic/upload-url: POST: Failed to create the presigned upload: {e}")
+        return Response(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, headers=HEADERS)
+
+    logger.info("/v2/user/self/pic/upload-url: POST: presigned upload created...")
+
+    return {
+        "file_name": s3_file_key,
+        "url": presigned_post["url"],
+        "fields": presigned_post["fields"],
+        "expires_in": UPLOAD_URL_EXPIRES_IN,
+        "max_size": UPLOAD_MAX_SIZE
+    }
+
+"""
+POST: /v2/user/self/pic/complete
+Verifies the image uploaded with the presigned POST and saves its metadata
+"""
+@app.post("/v2/user/self/pic/complete")
+async def complete_profile_pic_upload(
+    request: Request,
+    upload_details: UploadCompleteRequestBodyModel,
+    user: AuthenticatedUser = Depends(authenticate),
+    db: AsyncSession = Depends(get_async_database_session)
+):
+    if request.query_params:
+        logger.info("/v2/user/self/pic/complete: POST: query params not allowed...")
+        return Response(status_code=status.HTTP_400_BAD_REQUEST)
+
+    # the key has to be one of the user's own profile picture keys
+    s3_file_key = upload_details.file_name
+    folder, _, unique_filename = s3_file_key.partition("/")
+    if not folder.startswith(f'{user.id}-') or not unique_filename.startswith("profile-pic-") or "/" in unique_filename:
+        logger.info("/v2/user/self/pic/complete: POST: file name does not belong to the user...")
+        return Response(status_code=status.HTTP_400_BAD_REQUEST, headers=HEADERS)
+
+    bucket_name = os.getenv("APP_S3_BUCKET_NAME")
+
+    @time_s3_call
+    def head_image_in_s3(s3_file_key):
+        return head_uploaded_object(aws_clients.get("s3", timeout=remaining()), bucket_name, s3_file_key)
+
+    try:
+        uploaded_object = await bounded(asyncio.to_thread(head_image_in_s3, s3_file_key), 's3')
+    except Exception as e:
+        logger.info(f"/v2/user/self/pic/complete: POST: Failed to check the object in S3: {e}")
+        return Response(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, headers=HEADERS)
+
+    if uploaded_object is None:
+        logger.info("/v2/user/self/pic/complete: POST: image was not uploaded to S3...")
+        return Response(status_code=status.HTTP_404_NOT_FOUND, headers=HEADERS)
+
+    if uploaded_object["content_type"] not in ALLOWED_CONTENT_TYPES or uploaded_object["size"] > UPLOAD_MAX_SIZE:
+        logger.info("/v2/user/self/pic/complete: POST: uploaded object is not a valid image...")
+        return Response(status_code=status.HTTP_400_BAD_REQUEST, headers=HEADERS)
+
+    try:
+        @time_database_query
+        async def get_existing_image(db, user_id):
+            return await queries.get_image_by_user_id(db, user_id)
+
+        if await get_existing_image(db, user.id):
+            logger.info("/v2/user/self/pic/complete: POST: User already has a profile picture.")
+            return Response(status_code=status.HTTP_400_BAD_REQUEST, content=json.dumps({'message': 'User already has a profile picture. Delete the existing image before uploading a new one.'}))
+
+        image_url = f"https://{bucket_name}.s3.amazonaws.com/{s3_file_key}"
+        new_image = Image(
+            id = str(uuid.uuid4()),
+            file_name = s3_file_key,
+            url = image_url,
+            user_id = user.id
+        )
+
+        @time_database_query
+        async def insert_image_in_db(db, image):
+            await queries.add_image(db, image)
+
+        await insert_image_in_db(db, new_image)
+
+        logger.info("/v2/user/self/pic/complete: POST: image saved in the database successfully...")
+
+        if IMAGE_PIPELINE_ENABLED:
+            image_pipeline.submit(new_image.id, s3_file_key)
+
+        return FastJSONResponse(status_code=status.HTTP_200_OK, content=serialize_image(new_image, file_name=unique_filename))
+
+    except Exception as e:
+        logger.info(f"/v2/user/self/pic/complete: POST: Database error... {e}")
+        return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers=HEADERS)
+
+"""
 Methods not allowed for uploading image
 HEAD, PUT, OPTIONS, PATCH: 405 method not allowed
 """
@@ -662,45 +1169,63 @@ def users():
 
 
 @app.get("/v2/user/verify")
-async def verify_email(token: str, db: Session = Depends(get_database_session)):
+async def verify_email(token: str, db: AsyncSession = Depends(get_async_database_session)):
     logger.info("Verifying user... ")
     if not token:
         logger.info("No token provided")
         return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"error": "No token provided"})
 
+    # checks the token and the expiry and flips link_verified and is_verified in a single statement
     @time_database_query
-    def get_verification_from_db(db, token):
-        return db.query(Verification).filter(
-            and_(
-                Verification.token == token,
-                Verification.expiration_time > datetime.now()
-            )
-        ).first()
+    async def verify_user_in_db(db, token):
+        return await queries.verify_user_by_token(db, token, datetime.now(timezone.utc))
 
-    verification = get_verification_from_db(db, token)
-
-    if not verification:
+    if not await verify_user_in_db(db, token):
         logger.info("Invalid or expired token")
         return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"error": "Invalid or expired token"})
 
-    @time_database_query
-    def get_user_from_db(db, email):
-        return db.query(User).filter(User.email == verification.email).first()
+    # is_verified is not part of the profile and the UPDATE moves account_updated forward, nothing cached has to be dropped
+    logger.info("Email verified successfully")
+    return JSONResponse(status_code=status.HTTP_200_OK, content={"message": "Email verified successfully"})
 
-    user = get_user_from_db(db, verification.email)
-    
-    if user:
-        user.is_verified = True
-        verification.link_verified = True
-        # db.delete(verification) # I do not want to delete this is an option, I want to keep history
-        db.commit()
-        logger.info(f"Email verified successfully for user: {user.email}")
-        return JSONResponse(status_code=status.HTTP_200_OK, content={"message": "Email verified successfully"})
-    else:
-        logger.info(f"User not found for email: {verification.email}")
-        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"error": "User not found"})
+"""
+Function: server_settings
+Descr: Returns the uvicorn settings, the reloader only works with a single worker
+params: None
+"""
+def server_settings() -> dict:
+    return {
+        "host": SERVER_HOST,
+        "port": SERVER_PORT,
+        "workers": 1 if SERVER_RELOAD else max(SERVER_WORKERS, 1),
+        "loop": SERVER_LOOP,
+        "http": SERVER_HTTP,
+        "timeout_keep_alive": SERVER_KEEP_ALIVE_TIMEOUT,
+        "backlog": SERVER_BACKLOG,
+        "limit_concurrency": SERVER_LIMIT_CONCURRENCY,
+        "timeout_graceful_shutdown": SERVER_GRACEFUL_SHUTDOWN_TIMEOUT,
+        "reload": SERVER_RELOAD
+    }
+
+"""
+Function: run_server
+Descr: Creates the schema once, then starts the uvicorn workers
+params: None
+"""
+def run_server():
+    settings = server_settings()
+
+    init_database()
+    # the workers are separate processes, they must not share the connections opened here
+    get_engine().dispose()
+    os.environ["APP_SCHEMA_INITIALIZED"] = "true"
+
+    # split the cores between the bcrypt pools of the workers instead of giving each worker all of them
+    os.environ.setdefault("APP_HASHING_POOL_SIZE", str(max((os.cpu_count() or 1) // settings["workers"], 1)))
+
+    logger.info(f"Starting {settings['workers']} workers on {settings['host']}:{settings['port']} with {settings['loop']}/{settings['http']}")
+    uvicorn.run("app:app", **settings)
 
 # Code entrypoint
 if __name__ == "__main__":
-    init_database()
-    uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    run_server()
\ No newline at end of file
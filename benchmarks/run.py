@@ -0,0 +1,272 @@
+"""
+HTTP load test of the webapp routes.
+
+Starts benchmarks/server.py under uvicorn against SQLite (or the database given with --database-url),
+drives the routes from concurrent virtual users and reports the throughput and the latency
+percentiles per route.
+
+    # record a baseline
+    python -m benchmarks.run --concurrency 16 --duration 30 --output benchmarks/baseline.json
+
+    # fail when a route got slower than the baseline
+    python -m benchmarks.run --concurrency 16 --duration 30 --compare benchmarks/baseline.json --threshold 0.2
+"""
+from sqlalchemy import create_engine, update
+from models.user import User
+import argparse
+import asyncio
+import base64
+import httpx
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+# smallest valid PNG, the uploads only need the right magic bytes
+PNG_IMAGE = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+)
+PASSWORD = "benchmark-password"
+
+
+"""
+Function: percentile
+Descr: Nearest rank percentile of an already sorted list
+params: values: list, percent: float
+"""
+def percentile(values: list, percent: float) -> float:
+    if not values:
+        return 0.0
+    rank = max(math.ceil(percent / 100 * len(values)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+"""
+Function: summarize
+Descr: Reduces the latency samples to count, errors, RPS and p50/p95/p99 per route, latencies in milliseconds
+params: samples: dict of route -> list of (latency, ok), duration: float in seconds
+"""
+def summarize(samples: dict, duration: float) -> dict:
+    routes = {}
+    for route, route_samples in sorted(samples.items()):
+        latencies = sorted(latency for latency, _ in route_samples)
+        routes[route] = {
+            "count": len(route_samples),
+            "errors": sum(1 for _, ok in route_samples if not ok),
+            "rps": round(len(route_samples) / duration, 2) if duration else 0.0,
+            "mean": round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+            "p50": round(percentile(latencies, 50), 3),
+            "p95": round(percentile(latencies, 95), 3),
+            "p99": round(percentile(latencies, 99), 3)
+        }
+    return routes
+
+"""
+Function: compare
+Descr: Returns the regressions of the current run against a baseline, a route regresses when its p95 or p99
+       grew, or its RPS dropped, by more than the threshold, or when it started to return errors
+params: baseline: dict, current: dict, threshold: float, e.g. 0.2 for 20%
+"""
+def compare(baseline: dict, current: dict, threshold: float) -> list:
+    regressions = []
+    for route, before in baseline["routes"].items():
+        after = current["routes"].get(route)
+        if after is None:
+            regressions.append(f"{route}: missing from the current run")
+            continue
+        for metric in ("p95", "p99"):
+            if before[metric] and after[metric] > before[metric] * (1 + threshold):
+                regressions.append(f"{route}: {metric} {before[metric]:.1f} ms -> {after[metric]:.1f} ms")
+        if before["rps"] and after["rps"] < before["rps"] * (1 - threshold):
+            regressions.append(f"{route}: rps {before['rps']:.1f} -> {after['rps']:.1f}")
+        if after["errors"] > before["errors"]:
+            regressions.append(f"{route}: {after['errors']} errors, baseline had {before['errors']}")
+    return regressions
+
+"""
+Function: print_report
+Descr: Prints the per route results as a table
+params: result: dict
+"""
+def print_report(result: dict):
+    print(f"{'route':<34}{'count':>8}{'errors':>8}{'rps':>10}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for route, stats in result["routes"].items():
+        print(f"{route:<34}{stats['count']:>8}{stats['errors']:>8}{stats['rps']:>10.1f}"
+              f"{stats['p50']:>10.2f}{stats['p95']:>10.2f}{stats['p99']:>10.2f}")
+
+
+class LoadGenerator:
+    """
+    Virtual users which each sign up, then loop over the authenticated routes until the end of the run
+    """
+    def __init__(self, base_url: str, concurrency: int, duration: float, warmup: float):
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.duration = duration
+        self.warmup = warmup
+        self.run_id = uuid.uuid4().hex[:8]
+        self.samples = {}
+        self._recording = False
+
+    async def request(self, client: httpx.AsyncClient, method: str, route: str, expected: tuple, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            response = await client.request(method, route, **kwargs)
+            ok = response.status_code in expected
+        except httpx.HTTPError:
+            ok = False
+        latency = (time.perf_counter() - start_time) * 1000
+        if self._recording:
+            self.samples.setdefault(f"{method} {route}", []).append((latency, ok))
+        return ok
+
+    def user(self, worker: int, iteration: int = 0) -> dict:
+        return {
+            "email": f"bench-{self.run_id}-{worker}-{iteration}@example.com",
+            "password": PASSWORD,
+            "first_name": "Bench",
+            "last_name": "User"
+        }
+
+    async def sign_up(self, client: httpx.AsyncClient, workers: int) -> list:
+        users = [self.user(worker) for worker in range(workers)]
+        await asyncio.gather(*(self.request(client, "POST", "/v2/user", (201,), json=user) for user in users))
+        return users
+
+    async def worker(self, client: httpx.AsyncClient, worker: int, user: dict, deadline: float):
+        auth = (user["email"], PASSWORD)
+        iteration = 0
+        while time.perf_counter() < deadline:
+            iteration += 1
+            await self.request(client, "GET", "/healthz", (200,))
+            await self.request(client, "GET", "/v2/user/self", (200,), auth=auth)
+            await self.request(client, "PUT", "/v2/user/self", (204,), auth=auth,
+                               json={"email": user["email"], "first_name": "Bench" if iteration % 2 else "Benchmark"})
+            await self.request(client, "POST", "/v2/user/self/pic", (200, 201), auth=auth,
+                               content=PNG_IMAGE, headers={"Content-Type": "image/png"})
+            await self.request(client, "GET", "/v2/user/self/pic", (200,), auth=auth)
+            await self.request(client, "DELETE", "/v2/user/self/pic", (204,), auth=auth)
+            # a new account per iteration keeps the bcrypt heavy signup in the mix
+            await self.request(client, "POST", "/v2/user", (201,), json=self.user(worker, iteration))
+
+    async def run(self, verify_users) -> dict:
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        async with httpx.AsyncClient(base_url=self.base_url, limits=limits, timeout=30) as client:
+            users = await self.sign_up(client, self.concurrency)
+            # the authenticated routes need verified accounts
+            verify_users([user["email"] for user in users])
+
+            start_time = time.perf_counter()
+            deadline = start_time + self.warmup + self.duration
+
+            async def start_recording():
+                await asyncio.sleep(self.warmup)
+                self._recording = True
+
+            await asyncio.gather(start_recording(), *(self.worker(client, worker, user, deadline) for worker, user in enumerate(users)))
+            elapsed = time.perf_counter() - start_time - self.warmup
+
+        return {
+            "meta": {
+                "concurrency": self.concurrency,
+                "duration": round(elapsed, 3),
+                "warmup": self.warmup,
+                "python": platform.python_version(),
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+            },
+            "routes": summarize(self.samples, elapsed)
+        }
+
+"""
+Function: database_urls
+Descr: Returns the sync and async SQLAlchemy URLs, a SQLite file in a temporary directory by default
+params: database_url: str, workdir: str
+"""
+def database_urls(database_url: str, workdir: str) -> tuple:
+    if not database_url:
+        path = os.path.join(workdir, "benchmark.db")
+        return f"sqlite:///{path}", f"sqlite+aiosqlite:///{path}"
+    if database_url.startswith("mysql+pymysql"):
+        return database_url, database_url.replace("mysql+pymysql", "mysql+aiomysql", 1)
+    if database_url.startswith("sqlite:"):
+        return database_url, database_url.replace("sqlite:", "sqlite+aiosqlite:", 1)
+    raise ValueError("Only mysql+pymysql:// and sqlite:// URLs are supported")
+
+"""
+Function: start_server
+Descr: Starts benchmarks/server.py in a subprocess and waits until /healthz answers
+params: port: int, env: dict, timeout: float
+"""
+def start_server(port: int, env: dict, timeout: float = 30) -> subprocess.Popen:
+    server = subprocess.Popen([sys.executable, "-m", "benchmarks.server", "--port", str(port)], env=env)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Benchmark server exited with {server.returncode}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/healthz", timeout=1).status_code == 200:
+                return server
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("Benchmark server did not become healthy in time")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="webapp HTTP load test")
+    parser.add_argument("--concurrency", type=int, default=16, help="number of virtual users")
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds run before recording")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--database-url", help="mysql+pymysql:// or sqlite:// URL, a temporary SQLite file by default")
+    parser.add_argument("--output", help="write the results as JSON, e.g. to record a baseline")
+    parser.add_argument("--compare", help="baseline JSON to compare against, exits 1 on a regression")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed regression, 0.2 is 20%%")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        sync_url, async_url = database_urls(args.database_url, workdir)
+        env = {**os.environ, "APP_DATABASE_URL": sync_url, "APP_ASYNC_DATABASE_URL": async_url}
+        server = start_server(args.port, env)
+
+        engine = create_engine(sync_url)
+
+        def verify_users(emails: list):
+            with engine.begin() as conn:
+                conn.execute(update(User).where(User.email.in_(emails)).values(is_verified=True))
+
+        try:
+            generator = LoadGenerator(f"http://127.0.0.1:{args.port}", args.concurrency, args.duration, args.warmup)
+            result = asyncio.run(generator.run(verify_users))
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+            engine.dispose()
+
+    print_report(result)
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(result, output, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(baseline, result, args.threshold)
+        if regressions:
+            print(f"Regressions beyond {args.threshold:.0%}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print(f"No regressions beyond {args.threshold:.0%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,73 @@
+"""
+Per response CPU cost of the user and image payloads: the response_model path (Pydantic validation from the
+ORM attributes, then the stdlib json encoder) against the precompiled serializers with orjson.
+
+    python -m benchmarks.serialization --number 20000
+"""
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse
+from datetime import datetime, timezone
+from models.user import User, Image
+from schemas.user_schema import UserSchema
+from services.serialization import FastJSONResponse, serialize_user, serialize_image
+import argparse
+import timeit
+import uuid
+
+
+def sample_user() -> User:
+    now = datetime.now(timezone.utc)
+    return User(
+        id=str(uuid.uuid4()),
+        email="benchmark@example.com",
+        password="not-serialized",
+        first_name="Bench",
+        last_name="Mark",
+        account_created=now,
+        account_updated=now
+    )
+
+def sample_image(user: User) -> Image:
+    return Image(
+        id=str(uuid.uuid4()),
+        file_name=f"{user.id}-Bench-Mark/profile-pic-{uuid.uuid4()}.png",
+        url="https://bucket.s3.amazonaws.com/profile-pic.png",
+        upload_date=datetime.now(timezone.utc),
+        user_id=user.id
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="response serialization microbenchmark")
+    parser.add_argument("--number", type=int, default=20000, help="responses per measurement")
+    parser.add_argument("--repeat", type=int, default=5, help="measurements, the fastest one is reported")
+    args = parser.parse_args()
+
+    user = sample_user()
+    image = sample_image(user)
+    # render without building a whole Response each time
+    stdlib_render = JSONResponse.render.__get__(JSONResponse(None))
+    fast_render = FastJSONResponse.render.__get__(FastJSONResponse(None))
+
+    cases = {
+        "user: response_model + json": lambda: stdlib_render(UserSchema.model_validate(user).model_dump(mode="json")),
+        "user: serializer + orjson": lambda: fast_render(serialize_user(user)),
+        "image: jsonable_encoder + json": lambda: stdlib_render(jsonable_encoder({
+            "file_name": image.file_name, "id": image.id, "url": image.url, "upload_date": image.upload_date, "user_id": image.user_id
+        })),
+        "image: serializer + orjson": lambda: fast_render(serialize_image(image)),
+    }
+
+    results = {}
+    for name, case in cases.items():
+        best = min(timeit.repeat(case, number=args.number, repeat=args.repeat))
+        results[name] = best / args.number * 1_000_000
+        print(f"{name:<34}{results[name]:>8.2f} us/response")
+
+    for payload in ("user", "image"):
+        before, after = [value for name, value in results.items() if name.startswith(payload)]
+        print(f"{payload}: {before - after:.2f} us saved per response ({before / after:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
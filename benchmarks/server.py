@@ -0,0 +1,41 @@
+"""
+Runs the webapp under uvicorn for the benchmarks, with in-memory S3 and SNS backends.
+The database comes from APP_DATABASE_URL / APP_ASYNC_DATABASE_URL, set by benchmarks/run.py.
+
+    python -m benchmarks.server --port 8089
+"""
+import argparse
+import logging
+import os
+
+# the variants pipeline would try to decode the placeholder images
+os.environ.setdefault("APP_IMAGE_PIPELINE_ENABLED", "false")
+# the load generator is a single client, the limits would turn the run into a 429 benchmark
+os.environ.setdefault("APP_RATE_LIMIT_ENABLED", "false")
+os.environ.setdefault("APP_S3_BUCKET_NAME", "benchmark-bucket")
+os.environ.setdefault("APP_SNS_TOPIC_ARN", "arn:aws:sns:us-east-1:000000000000:benchmark")
+
+import uvicorn
+import app as webapp
+from tests.fakes import FakeS3Client, FakePublisher
+
+
+def main():
+    parser = argparse.ArgumentParser(description="webapp benchmark server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--log-level", default="warning")
+    args = parser.parse_args()
+
+    # no AWS calls leave the process
+    webapp.aws_clients.override("s3", FakeS3Client())
+    webapp.outbox_dispatcher.publisher = FakePublisher()
+
+    # the request logging would dominate the measurements
+    logging.getLogger().setLevel(args.log_level.upper())
+
+    uvicorn.run(webapp.app, host=args.host, port=args.port, log_level=args.log_level, access_log=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,18 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text, event
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from dotenv import load_dotenv
 import os
 import logging
+import threading
+import time
+import asyncio
 
 # Parse a .env file and then load all the variables found as environment variables.
 load_dotenv()
 
-# setting up the logger 
+# setting up the logger
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -18,16 +23,164 @@ HOST = os.getenv("MYSQL_HOST")
 PORT = os.getenv("MYSQL_PORT")
 DATABASE = os.getenv("MYSQL_DATABASE")
 
-DB_CONNECTION_STRING = f"mysql+pymysql://{USER}:{PASSWORD}@{HOST}/{DATABASE}"
+# full URLs take precedence over the MySQL credentials, the benchmarks point these at SQLite
+DB_CONNECTION_STRING = os.getenv("APP_DATABASE_URL") or f"mysql+pymysql://{USER}:{PASSWORD}@{HOST}/{DATABASE}"
+ASYNC_DB_CONNECTION_STRING = os.getenv("APP_ASYNC_DATABASE_URL") or f"mysql+aiomysql://{USER}:{PASSWORD}@{HOST}/{DATABASE}"
+
+# Connection pool settings
+POOL_SIZE = int(os.getenv("MYSQL_POOL_SIZE", 10))
+POOL_MAX_OVERFLOW = int(os.getenv("MYSQL_POOL_MAX_OVERFLOW", 20))
+POOL_TIMEOUT = int(os.getenv("MYSQL_POOL_TIMEOUT", 30))
+POOL_RECYCLE = int(os.getenv("MYSQL_POOL_RECYCLE", 1800))
+POOL_PRE_PING = os.getenv("MYSQL_POOL_PRE_PING", "true").lower() == "true"
+CONNECT_TIMEOUT = int(os.getenv("MYSQL_CONNECT_TIMEOUT", 5))
+READ_TIMEOUT = int(os.getenv("MYSQL_READ_TIMEOUT", 30))
+WRITE_TIMEOUT = int(os.getenv("MYSQL_WRITE_TIMEOUT", 30))
+
+# Liveness monitor settings, interval in seconds
+HEALTH_CHECK_INTERVAL = float(os.getenv("MYSQL_HEALTH_CHECK_INTERVAL", 5))
+
+# one engine (and one connection pool) per process, created on first use
+_engine = None
+_session_factory = None
+_async_engine = None
+_async_session_factory = None
+_engine_lock = threading.Lock()
+
+
+class TimedPoolMixin:
+    """
+    Pool mixin that records how long callers wait to check out a connection.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        start_time = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            wait_time = time.perf_counter() - start_time
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_time_total += wait_time
+                self.wait_time_max = max(self.wait_time_max, wait_time)
+
+    def recreate(self):
+        # keep the stats counters when the pool is recreated after a dispose
+        pool = super().recreate()
+        pool.checkouts = self.checkouts
+        pool.wait_time_total = self.wait_time_total
+        pool.wait_time_max = self.wait_time_max
+        return pool
+
+
+class TimedQueuePool(TimedPoolMixin, QueuePool):
+    pass
+
+
+class TimedAsyncAdaptedQueuePool(TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
 
 
 def get_engine():
-    try:
-        engine = create_engine(DB_CONNECTION_STRING)
-        return engine
-    except Exception as e:
-        logger.error(f"SQLAlchemy engine error... {e}")
-    
+    global _engine
+    if _engine is not None:
+        return _engine
+
+    with _engine_lock:
+        if _engine is None:
+            try:
+                _engine = create_engine(
+                    DB_CONNECTION_STRING,
+                    poolclass=TimedQueuePool,
+                    pool_size=POOL_SIZE,
+                    max_overflow=POOL_MAX_OVERFLOW,
+                    pool_timeout=POOL_TIMEOUT,
+                    pool_recycle=POOL_RECYCLE,
+                    pool_pre_ping=POOL_PRE_PING,
+                    # the timeouts are MySQL driver options
+                    connect_args={
+                        "connect_timeout": CONNECT_TIMEOUT,
+                        "read_timeout": READ_TIMEOUT,
+                        "write_timeout": WRITE_TIMEOUT
+                    } if DB_CONNECTION_STRING.startswith("mysql") else {}
+                )
+                logger.info(f"SQLAlchemy engine created with pool_size={POOL_SIZE}, max_overflow={POOL_MAX_OVERFLOW}")
+            except Exception as e:
+                logger.error(f"SQLAlchemy engine error... {e}")
+    return _engine
+
+
+def get_async_engine():
+    global _async_engine
+    if _async_engine is not None:
+        return _async_engine
+
+    with _engine_lock:
+        if _async_engine is None:
+            try:
+                _async_engine = create_async_engine(
+                    ASYNC_DB_CONNECTION_STRING,
+                    poolclass=TimedAsyncAdaptedQueuePool,
+                    pool_size=POOL_SIZE,
+                    max_overflow=POOL_MAX_OVERFLOW,
+                    pool_timeout=POOL_TIMEOUT,
+                    pool_recycle=POOL_RECYCLE,
+                    pool_pre_ping=POOL_PRE_PING,
+                    connect_args={
+                        "connect_timeout": CONNECT_TIMEOUT
+                    } if ASYNC_DB_CONNECTION_STRING.startswith("mysql") else {}
+                )
+                logger.info(f"SQLAlchemy async engine created with pool_size={POOL_SIZE}, max_overflow={POOL_MAX_OVERFLOW}")
+            except Exception as e:
+                logger.error(f"SQLAlchemy async engine error... {e}")
+    return _async_engine
+
+
+'''
+Function: dispose_async_engine()
+Desc.: Closes the pooled async connections, they are bound to the event loop that opened them
+Params: None
+Return: None
+'''
+async def dispose_async_engine():
+    global _async_engine, _async_session_factory
+    if _async_engine is not None:
+        await _async_engine.dispose()
+        _async_engine = None
+        _async_session_factory = None
+
+
+'''
+Function: get_pool_stats()
+Desc.: Returns the connection pool statistics of the process-wide engine
+Params: engine: sync engine or async engine, defaults to the sync engine
+Return: dict
+'''
+def get_pool_stats(engine=None) -> dict:
+    engine = engine or get_engine()
+    pool = engine.pool
+    checkouts = getattr(pool, "checkouts", 0)
+    wait_time_total = getattr(pool, "wait_time_total", 0.0)
+    # only the queue pools keep a fixed set of connections
+    is_queue_pool = isinstance(pool, QueuePool)
+    return {
+        "size": pool.size() if is_queue_pool else 0,
+        "checked_in": pool.checkedin() if is_queue_pool else 0,
+        "checked_out": pool.checkedout() if is_queue_pool else 0,
+        "overflow": pool.overflow() if is_queue_pool else 0,
+        "checkouts": checkouts,
+        # wait times in milliseconds
+        "wait_time_total": wait_time_total * 1000,
+        "wait_time_avg": (wait_time_total / checkouts * 1000) if checkouts else 0.0,
+        "wait_time_max": getattr(pool, "wait_time_max", 0.0) * 1000
+    }
+
 
 '''
 Function: get_database_connection()
@@ -45,19 +198,154 @@ def get_database_connection() -> bool:
         logger.info(f"Error in database connection!  {e}")
         return False
 
+
+'''
+Function: get_async_database_connection()
+Desc.: Checks the database connection without blocking the event loop
+Params: None
+Return: bool
+'''
+async def get_async_database_connection() -> bool:
+    engine = get_async_engine()
+    try:
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+            logger.info("Connection successful!")
+            return True
+    except Exception as e:
+        logger.info(f"Error in database connection!  {e}")
+        return False
+
+
+def get_session_factory():
+    global _session_factory
+    if _session_factory is None:
+        _session_factory = sessionmaker(autoflush=False, autocommit=False, bind=get_engine())
+    return _session_factory
+
 """
 Function: get_database_session()
-Desc.: Returns the database session
+Desc.: Yields a database session bound to the pooled engine, closing it once the request is done
 Params: None
 Return: .Session
-"""  
+"""
 def get_database_session():
+    db_session = None
     try:
-        engine = get_engine()
-        SessionLocal = sessionmaker(autoflush=False, autocommit=False, bind=engine)
-        db_session = SessionLocal()
-        return db_session
-    except Exception as e:
-        logger.error(f"Exception occurred... {e}")
+        db_session = get_session_factory()()
+        yield db_session
     finally:
         if db_session: db_session.close()
+
+
+def get_async_session_factory():
+    global _async_session_factory
+    if _async_session_factory is None:
+        # expire_on_commit is off so the handlers can still read the ORM objects after a commit
+        _async_session_factory = async_sessionmaker(bind=get_async_engine(), autoflush=False, expire_on_commit=False, class_=AsyncSession)
+    return _async_session_factory
+
+"""
+Function: get_async_database_session()
+Desc.: Yields an async database session bound to the pooled async engine, closing it once the request is done
+Params: None
+Return: .AsyncSession
+"""
+async def get_async_database_session():
+    async with get_async_session_factory()() as db_session:
+        yield db_session
+
+
+class DatabaseHealthMonitor:
+    """
+    Probes the pooled async engine in the background and keeps the database status in memory,
+    so the health checks and handlers do not open a connection per request.
+    A connection error from any real query flips the status immediately.
+    """
+    def __init__(self, interval: float = HEALTH_CHECK_INTERVAL, timeout: float = CONNECT_TIMEOUT, statsd_client=None):
+        self.interval = interval
+        self.timeout = timeout
+        self.statsd_client = statsd_client
+        self.is_healthy = False
+        self.last_checked = None
+        self.last_error = None
+        self._task = None
+        self._engine = None
+
+    def mark_healthy(self):
+        if not self.is_healthy:
+            logger.info("Database is up and in service!")
+        self.is_healthy = True
+        self.last_error = None
+
+    def mark_unhealthy(self, error):
+        if self.is_healthy:
+            logger.info(f"Database is down!  {error}")
+        self.is_healthy = False
+        self.last_error = str(error)
+
+    def _handle_error(self, context):
+        # only a dropped connection means the database is down right now, a deadlock or a lock wait timeout
+        # is an error of that query and leaves /healthz alone
+        if context.is_disconnect:
+            self.mark_unhealthy(context.original_exception)
+
+    async def probe(self) -> bool:
+        try:
+            async with asyncio.timeout(self.timeout):
+                async with get_async_engine().connect() as conn:
+                    await conn.execute(text("SELECT 1"))
+            self.mark_healthy()
+        except Exception as e:
+            self.mark_unhealthy(e)
+        self.last_checked = time.time()
+        self._report_pool_stats()
+        return self.is_healthy
+
+    def _report_pool_stats(self):
+        if not self.statsd_client or get_async_engine() is None:
+            return
+        stats = get_pool_stats(get_async_engine())
+        self.statsd_client.gauge('database.pool.checked_out', stats["checked_out"])
+        self.statsd_client.gauge('database.pool.overflow', stats["overflow"])
+        self.statsd_client.gauge('database.pool.wait_time_avg', stats["wait_time_avg"])
+        self.statsd_client.gauge('database.up', 1 if self.is_healthy else 0)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.probe()
+            except Exception as e:
+                logger.error(f"Database health check error... {e}")
+
+    async def start(self):
+        """
+        Runs a first probe and starts the heartbeat task on the running event loop
+        """
+        self._engine = get_async_engine()
+        if self._engine is not None:
+            event.listen(self._engine.sync_engine, "handle_error", self._handle_error)
+        await self.probe()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._engine is not None:
+            event.remove(self._engine.sync_engine, "handle_error", self._handle_error)
+            self._engine = None
+
+"""
+Function: async_session()
+Desc.: Returns a new async session for background jobs running outside of a request
+Params: None
+Return: .AsyncSession
+"""
+def async_session() -> AsyncSession:
+    return get_async_session_factory()()
@@ -1 +1,2 @@
-from .user import User, Base
\ No newline at end of file
+from .user import User, Base
+from .outbox import OutboxMessage
\ No newline at end of file
@@ -0,0 +1,23 @@
+from sqlalchemy import Column, Integer, String, Text, DateTime, func, Index
+from .user import Base
+from datetime import datetime, timezone
+import uuid
+
+# Outbox schema, messages are written in the same transaction as the business rows
+# and published to SNS later by the background dispatcher
+class OutboxMessage(Base):
+    __tablename__ = "outbox_messages"
+
+    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()), unique=True, nullable=False)
+    topic_arn = Column(String(255), nullable=False)
+    payload = Column(Text, nullable=False)
+    status = Column(String(16), default="pending", nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), nullable=False)
+    last_error = Column(String(255))
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    sent_at = Column(DateTime(timezone=True))
+
+    __table_args__ = (
+        Index("ix_outbox_messages_status_next_attempt_at", "status", "next_attempt_at"),
+    )
@@ -1,5 +1,7 @@
-from sqlalchemy import Column, Integer, String, DateTime, func, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, func, ForeignKey, Boolean, Index
+from sqlalchemy.dialects import mysql
 from sqlalchemy.orm import declarative_base, relationship
+from datetime import datetime, timezone
 import uuid
 
 Base = declarative_base()
@@ -14,9 +16,17 @@ class User(Base):
     first_name = Column(String(255))
     last_name = Column(String(255))
     account_created = Column(DateTime(timezone=True), server_default=func.now())
-    account_updated = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    # the profile ETag is derived from it, kept to the microsecond so that two updates within a second differ
+    account_updated = Column(
+        DateTime(timezone=True).with_variant(mysql.DATETIME(fsp=6), "mysql"),
+        default=lambda: datetime.now(timezone.utc),
+        onupdate=lambda: datetime.now(timezone.utc)
+    )
     is_verified = Column(Boolean, default=False, nullable=False)
 
+    # keyset pagination of the export
+    __table_args__ = (Index("ix_users_account_created_id", "account_created", "id"),)
+
     images = relationship("Image", back_populates="user")
     verification = relationship("Verification", back_populates="user", uselist=False)
 
@@ -31,6 +41,25 @@ class Image(Base):
     user_id = Column(String(36), ForeignKey('users.id'), nullable=False)
 
     user = relationship("User", back_populates="images")
+    variants = relationship("ImageVariant", back_populates="image", cascade="all, delete-orphan", passive_deletes=True)
+
+
+# resized and re-encoded copies of a profile picture, created in the background after the upload
+class ImageVariant(Base):
+    __tablename__ = "image_variants"
+
+    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()), unique=True, nullable=False)
+    image_id = Column(String(36), ForeignKey('images.id', ondelete='CASCADE'), index=True, nullable=False)
+    name = Column(String(32), nullable=False)
+    file_name = Column(String(255), nullable=False)
+    url = Column(String(255), nullable=False)
+    content_type = Column(String(32), nullable=False)
+    width = Column(Integer, nullable=False)
+    height = Column(Integer, nullable=False)
+    size = Column(Integer, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    image = relationship("Image", back_populates="variants")
 
 
 class Verification(Base):
@@ -40,8 +69,23 @@ class Verification(Base):
     email = Column(String(255), ForeignKey('users.email'), unique=True, nullable=False)
     verification_link = Column(String(255), nullable=False)
     token = Column(String(36), unique=True, nullable=False)
-    expiration_time = Column(DateTime(timezone=True), nullable=False)
+    # stored in UTC, the sweeper archives the rows by it
+    expiration_time = Column(DateTime(timezone=True), index=True, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     link_verified = Column(Boolean, default=False, nullable=False)
 
-    user = relationship("User", back_populates="verification")
\ No newline at end of file
+    user = relationship("User", back_populates="verification")
+
+
+# used and expired verifications, moved out of the verifications table by the background sweeper to keep the history
+class VerificationArchive(Base):
+    __tablename__ = "verifications_archive"
+
+    id = Column(String(36), primary_key=True, nullable=False)
+    email = Column(String(255), index=True, nullable=False)
+    verification_link = Column(String(255), nullable=False)
+    token = Column(String(36), nullable=False)
+    expiration_time = Column(DateTime(timezone=True), nullable=False)
+    created_at = Column(DateTime(timezone=True))
+    link_verified = Column(Boolean, nullable=False)
+    archived_at = Column(DateTime(timezone=True), server_default=func.now())
\ No newline at end of file
@@ -1 +1 @@
-from .user_schema import UserSchema, UserUpdateRequestBodyModel, UserRequestBodyModel
\ No newline at end of file
+from .user_schema import UserSchema, UserUpdateRequestBodyModel, UserRequestBodyModel, AuthenticatedUser
\ No newline at end of file
@@ -46,9 +46,41 @@ class UserUpdateRequestBodyModel(BaseModel):
         str_strip_whitespace = True
     )
 
+# Authenticated user resolved once per request, shared by the handlers
+class AuthenticatedUser(BaseModel):
+    id: str
+    email: str
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    is_verified: bool
+    account_created: Optional[datetime] = None
+    account_updated: Optional[datetime] = None
+
+    model_config = ConfigDict(
+        from_attributes = True,
+        frozen = True
+    )
+
 class ImageCreatedUserSchema(BaseModel):
     file_name: str
     id: UUID
     url: str
     upload_date: datetime
     user_id: UUID
+
+
+# Profile picture presigned upload request body schema
+class PresignedUploadRequestBodyModel(BaseModel):
+    content_type: str
+
+    model_config = ConfigDict(
+        str_strip_whitespace = True
+    )
+
+# Profile picture upload completion request body schema
+class UploadCompleteRequestBodyModel(BaseModel):
+    file_name: str
+
+    model_config = ConfigDict(
+        str_strip_whitespace = True
+    )
@@ -0,0 +1,102 @@
+from collections import OrderedDict
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import threading
+import time
+
+# setting up the logger
+logger = logging.getLogger(__name__)
+
+# credential cache settings, the cache is per process and a password change only invalidates it in the worker which
+# handled it, the other workers keep accepting the old password until their entry expires, so the TTL stays short
+AUTH_CACHE_MAX_SIZE = int(os.getenv("APP_AUTH_CACHE_MAX_SIZE", 10000))
+AUTH_CACHE_TTL = int(os.getenv("APP_AUTH_CACHE_TTL", 5))
+# without a configured secret every process uses its own random key
+AUTH_CACHE_SECRET = os.getenv("APP_AUTH_CACHE_SECRET")
+
+
+class CredentialCache:
+    """
+    LRU/TTL cache of recently verified Basic auth credentials.
+    Entries are keyed by email and hold a keyed HMAC of the password, never the plaintext,
+    so a hit can skip both the user lookup and bcrypt.
+    """
+    def __init__(self, max_size: int = AUTH_CACHE_MAX_SIZE, ttl: int = AUTH_CACHE_TTL, secret: str = AUTH_CACHE_SECRET, statsd_client=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.statsd_client = statsd_client
+        self.hits = 0
+        self.misses = 0
+        self._secret = secret.encode('utf-8') if secret else secrets.token_bytes(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _digest(self, password: str) -> bytes:
+        return hmac.new(self._secret, password.encode('utf-8'), hashlib.sha256).digest()
+
+    def _record(self, hit: bool):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        if self.statsd_client: self.statsd_client.incr('auth.cache.hit' if hit else 'auth.cache.miss')
+
+    def get(self, email: str, password: str):
+        """
+        Returns the cached value for the credentials, None on a miss
+        """
+        if self.max_size <= 0:
+            return None
+
+        digest = self._digest(password)
+        value = None
+        hit = False
+        with self._lock:
+            entry = self._entries.get(email)
+            if entry is not None:
+                cached_digest, value, expires_at = entry
+                if expires_at <= time.monotonic():
+                    del self._entries[email]
+                else:
+                    hit = hmac.compare_digest(cached_digest, digest)
+                    if hit:
+                        self._entries.move_to_end(email)
+        self._record(hit)
+        return value if hit else None
+
+    def set(self, email: str, password: str, value):
+        """
+        Caches the value for credentials which were just verified
+        """
+        if self.max_size <= 0:
+            return
+
+        digest = self._digest(password)
+        with self._lock:
+            self._entries[email] = (digest, value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(email)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, email: str):
+        """
+        Drops the cached credentials of the user, e.g. after a password change
+        """
+        with self._lock:
+            self._entries.pop(email, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses
+        }
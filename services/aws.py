@@ -0,0 +1,129 @@
+from botocore.config import Config
+from services.circuit_breaker import GuardedClient
+import boto3
+import logging
+import os
+import threading
+
+# setting up the logger
+logger = logging.getLogger(__name__)
+
+# botocore client settings
+AWS_REGION = os.getenv("AWS_REGION", "us-east-1")
+AWS_MAX_POOL_CONNECTIONS = int(os.getenv("APP_AWS_MAX_POOL_CONNECTIONS", 50))
+AWS_CONNECT_TIMEOUT = float(os.getenv("APP_AWS_CONNECT_TIMEOUT", 2))
+AWS_READ_TIMEOUT = float(os.getenv("APP_AWS_READ_TIMEOUT", 10))
+AWS_MAX_ATTEMPTS = int(os.getenv("APP_AWS_MAX_ATTEMPTS", 3))
+
+# timeouts in seconds of the clients used within a request deadline, the remaining budget is rounded down to one of them.
+# Every class gets its own client with its own pool of APP_AWS_MAX_POOL_CONNECTIONS, so a service can hold up to
+# len(AWS_TIMEOUT_CLASSES) + 1 times that many connections
+AWS_TIMEOUT_CLASSES = (0.5, 1, 2, 5)
+
+
+def build_client_config() -> Config:
+    return Config(
+        max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+        connect_timeout=AWS_CONNECT_TIMEOUT,
+        read_timeout=AWS_READ_TIMEOUT,
+        retries={"max_attempts": AWS_MAX_ATTEMPTS, "mode": "adaptive"}
+    )
+
+"""
+Function: timeout_class
+Descr: Rounds the remaining budget of a request down to a timeout class, None when the default timeouts fit in it
+params: timeout: float, seconds, None without a deadline
+"""
+def timeout_class(timeout: float = None):
+    if timeout is None or timeout >= AWS_READ_TIMEOUT:
+        return None
+    fitting = [timeout_class for timeout_class in AWS_TIMEOUT_CLASSES if timeout_class <= timeout]
+    # below the smallest class the call is still abandoned at the deadline
+    return fitting[-1] if fitting else AWS_TIMEOUT_CLASSES[0]
+
+
+class ClientRegistry:
+    """
+    Builds each boto3 client once per process and shares it.
+    boto3 clients are thread safe once created, the session is not, so creation is locked.
+    Calls within a request deadline get a client per timeout class, its connect and read timeouts fit in the budget
+    and it does not retry, so the call stops in botocore instead of running on after the request was answered.
+    """
+    def __init__(self, session=None, config: Config = None, breakers: dict = None):
+        self._session = session or boto3.Session()
+        self._config = config or build_client_config()
+        # circuit breaker per service name, the clients of these services are wrapped by it
+        self._breakers = breakers or {}
+        self._clients = {}
+        self._overrides = {}
+        self._lock = threading.Lock()
+
+    def _config_for(self, budget_class):
+        if budget_class is None:
+            return self._config
+        return self._config.merge(Config(
+            connect_timeout=min(self._config.connect_timeout, budget_class),
+            read_timeout=min(self._config.read_timeout, budget_class),
+            retries={"total_max_attempts": 1, "mode": "standard"}
+        ))
+
+    def get(self, service_name: str, region_name: str = None, timeout: float = None):
+        """
+        Returns the shared client of the service, timeout is what is left of the request deadline in seconds
+        """
+        override = self._overrides.get((service_name, region_name))
+        if override is not None:
+            return override
+
+        budget_class = timeout_class(timeout)
+        key = (service_name, region_name) if budget_class is None else (service_name, region_name, budget_class)
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                kwargs = {"config": self._config_for(budget_class)}
+                if region_name:
+                    kwargs["region_name"] = region_name
+                client = self._session.client(service_name, **kwargs)
+                if service_name in self._breakers:
+                    client = GuardedClient(client, self._breakers[service_name])
+                self._clients[key] = client
+                logger.info(f"{service_name} client created with max_pool_connections={self._config.max_pool_connections}, timeout class {budget_class}")
+        return client
+
+    def override(self, service_name: str, client, region_name: str = None):
+        """
+        Serves this client for the service whatever the timeout, e.g. an in-memory S3 for the tests and benchmarks
+        """
+        self._overrides[(service_name, region_name)] = client
+
+    def pool_stats(self, service_name: str, region_name: str = None) -> dict:
+        """
+        Returns the HTTP connection pool usage of the service, summed over its default client and the client of every
+        timeout class. Each of them has its own pool of max_pool_connections, so max_size is the real ceiling,
+        up to len(AWS_TIMEOUT_CLASSES) + 1 times max_pool_connections. in_use close to max_size means saturated.
+        """
+        clients = [client for key, client in list(self._clients.items()) if key[:2] == (service_name, region_name)]
+        stats = {"max_size": self._config.max_pool_connections * max(len(clients), 1), "in_use": 0, "pools": 0, "clients": len(clients)}
+
+        for client in clients:
+            try:
+                # botocore does not expose the urllib3 pools publicly
+                manager = client._endpoint.http_session._manager
+                for key in manager.pools.keys():
+                    pool = manager.pools.get(key)
+                    if pool is None or pool.pool is None:
+                        continue
+                    stats["pools"] += 1
+                    stats["in_use"] += pool.pool.maxsize - pool.pool.qsize()
+            except AttributeError:
+                pass
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._clients.clear()
+            self._overrides.clear()
@@ -0,0 +1,260 @@
+"""
+Bulk user import from NDJSON, one UserRequestBodyModel record per line.
+
+Records are processed in chunks: validated, checked for duplicates with a single IN query, hashed across the
+bcrypt pool and inserted with one executemany per table together with their verification records and outbox
+entries. Only one chunk is held in memory at a time, the per record results are written out as they are produced.
+
+    python -m services.bulk_import users.ndjson --report report.ndjson
+"""
+from pydantic import ValidationError
+from sqlalchemy.exc import IntegrityError
+from schemas.user_schema import UserRequestBodyModel
+from services import queries
+from services.hashing import HashingQueueFullError
+from services.verification import build_verification
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import uuid
+
+# setting up the logger
+logger = logging.getLogger(__name__)
+
+# bulk import settings
+IMPORT_CHUNK_SIZE = int(os.getenv("APP_IMPORT_CHUNK_SIZE", 500))
+# longer lines are rejected instead of being buffered
+IMPORT_MAX_LINE_SIZE = int(os.getenv("APP_IMPORT_MAX_LINE_SIZE", 64 * 1024))
+
+
+"""
+Function: iter_ndjson_lines
+Descr: Splits a stream of byte chunks into (line number, line) pairs, skipping the blank lines
+params: chunks: async iterator of bytes, max_line_size: int
+"""
+async def iter_ndjson_lines(chunks, max_line_size: int = IMPORT_MAX_LINE_SIZE):
+    buffer = b""
+    line_number = 0
+    skipping = False
+    async for chunk in chunks:
+        if skipping:
+            # drop the rest of an oversized line, it was already reported as invalid
+            if b"\n" not in chunk:
+                continue
+            chunk = chunk.split(b"\n", 1)[1]
+            skipping = False
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            line_number += 1
+            if line.strip():
+                yield line_number, line if len(line) <= max_line_size else None
+        if len(buffer) > max_line_size:
+            line_number += 1
+            yield line_number, None
+            buffer = b""
+            skipping = True
+    if buffer.strip():
+        yield line_number + 1, buffer
+
+"""
+Function: iter_file_chunks
+Descr: Reads a file in chunks without blocking the event loop
+params: path: str, chunk_size: int
+"""
+async def iter_file_chunks(path: str, chunk_size: int = 64 * 1024):
+    with open(path, "rb") as input_file:
+        while True:
+            chunk = await asyncio.to_thread(input_file.read, chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+class UserImporter:
+    """
+    Runs the chunked import, results are dicts with the line, email, status and the new id or the error.
+    Status is one of created, duplicate, invalid or failed.
+    on_chunk_committed is called with the emails of the users created by each committed chunk.
+    """
+    def __init__(self, session_factory, password_hasher, chunk_size: int = IMPORT_CHUNK_SIZE, on_chunk_committed=None, statsd_client=None):
+        self.session_factory = session_factory
+        self.password_hasher = password_hasher
+        self.chunk_size = max(chunk_size, 1)
+        self.on_chunk_committed = on_chunk_committed
+        self.statsd_client = statsd_client
+
+    def _parse(self, line_number: int, line: bytes):
+        if line is None:
+            return None, {"line": line_number, "email": None, "status": "invalid", "error": "Line is too long"}
+        try:
+            return UserRequestBodyModel.model_validate_json(line), None
+        except ValidationError as e:
+            error = "; ".join(f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in e.errors())
+            email = None
+            try:
+                email = json.loads(line).get("email")
+            except (ValueError, AttributeError):
+                pass
+            return None, {"line": line_number, "email": email, "status": "invalid", "error": error}
+
+    async def _hash(self, passwords: list) -> list:
+        # online traffic shares the bcrypt pool, back off instead of failing the import when it is busy
+        while True:
+            try:
+                return await self.password_hasher.hash_passwords(passwords)
+            except HashingQueueFullError:
+                await asyncio.sleep(0.1)
+
+    async def _insert(self, records: list) -> set:
+        """
+        Inserts the records, returns the lowercased emails skipped because they already exist
+        """
+        async with self.session_factory() as db:
+            for attempt in range(2):
+                existing = await queries.get_existing_emails(db, [record["user"]["email"] for record in records])
+                to_insert = [record for record in records if record["user"]["email"].lower() not in existing]
+                if not to_insert:
+                    return existing
+                try:
+                    await queries.bulk_add_users_with_verifications(
+                        db,
+                        [record["user"] for record in to_insert],
+                        [record["verification"] for record in to_insert],
+                        [record["outbox_message"] for record in to_insert if record["outbox_message"]]
+                    )
+                    return existing
+                except IntegrityError:
+                    # a user with one of the emails was created since the duplicate check
+                    await db.rollback()
+                    if attempt:
+                        raise
+
+    async def _process_chunk(self, chunk: list) -> list:
+        results = []
+        valid = []
+        seen = set()
+        for line_number, line in chunk:
+            user, error = self._parse(line_number, line)
+            if error:
+                results.append(error)
+                continue
+            email = user.email.strip()
+            if email.lower() in seen:
+                results.append({"line": line_number, "email": email, "status": "duplicate"})
+                continue
+            seen.add(email.lower())
+            valid.append((line_number, user, email))
+
+        if not valid:
+            return results
+
+        # skip hashing the passwords of the users which already exist
+        async with self.session_factory() as db:
+            existing = await queries.get_existing_emails(db, [email for _, _, email in valid])
+        new_users = []
+        for line_number, user, email in valid:
+            if email.lower() in existing:
+                results.append({"line": line_number, "email": email, "status": "duplicate"})
+            else:
+                new_users.append((line_number, user, email))
+        if not new_users:
+            return results
+
+        hashed_passwords = await self._hash([user.password for _, user, _ in new_users])
+
+        records = []
+        for (line_number, user, email), hashed_password in zip(new_users, hashed_passwords):
+            first_name, last_name = user.first_name.strip(), user.last_name.strip()
+            verification, outbox_message = build_verification(email, first_name, last_name)
+            records.append({
+                "line": line_number,
+                "user": {
+                    "id": str(uuid.uuid4()),
+                    "email": email,
+                    "password": hashed_password,
+                    "first_name": first_name,
+                    "last_name": last_name,
+                    "is_verified": False
+                },
+                "verification": verification,
+                "outbox_message": outbox_message
+            })
+
+        try:
+            skipped = await self._insert(records)
+        except Exception as e:
+            logger.error(f"Bulk import: failed to insert the chunk... {e}")
+            results.extend({"line": record["line"], "email": record["user"]["email"], "status": "failed", "error": "Database error"} for record in records)
+            return results
+
+        for record in records:
+            email = record["user"]["email"]
+            if email.lower() in skipped:
+                results.append({"line": record["line"], "email": email, "status": "duplicate"})
+            else:
+                results.append({"line": record["line"], "email": email, "status": "created", "id": record["user"]["id"]})
+
+        if self.on_chunk_committed:
+            self.on_chunk_committed([result["email"] for result in results if result["status"] == "created"])
+        return results
+
+    async def run(self, chunks):
+        """
+        Imports the NDJSON byte chunks, yields the result of every record in line order
+        """
+        chunk = []
+        async for line_number, line in iter_ndjson_lines(chunks):
+            chunk.append((line_number, line))
+            if len(chunk) >= self.chunk_size:
+                for result in sorted(await self._process_chunk(chunk), key=lambda result: result["line"]):
+                    yield result
+                chunk = []
+        if chunk:
+            for result in sorted(await self._process_chunk(chunk), key=lambda result: result["line"]):
+                yield result
+
+    async def run_to_file(self, chunks, report_file) -> dict:
+        """
+        Writes the results as NDJSON to a binary file object, returns the counts per status
+        """
+        summary = {"created": 0, "duplicate": 0, "invalid": 0, "failed": 0}
+        async for result in self.run(chunks):
+            summary[result["status"]] += 1
+            report_file.write(json.dumps(result).encode() + b"\n")
+        report_file.write(json.dumps({"summary": summary}).encode() + b"\n")
+        if self.statsd_client:
+            for status, count in summary.items():
+                if count: self.statsd_client.incr(f'import.users.{status}', count)
+        logger.info(f"Bulk import finished: {summary}")
+        return summary
+
+
+async def _main(args) -> int:
+    from database import async_session, dispose_async_engine
+    from services.hashing import PasswordHasher
+
+    password_hasher = PasswordHasher()
+    importer = UserImporter(async_session, password_hasher, chunk_size=args.chunk_size)
+    try:
+        if args.report:
+            with open(args.report, "wb") as report_file:
+                summary = await importer.run_to_file(iter_file_chunks(args.path), report_file)
+        else:
+            summary = await importer.run_to_file(iter_file_chunks(args.path), sys.stdout.buffer)
+    finally:
+        password_hasher.shutdown()
+        await dispose_async_engine()
+    print(json.dumps(summary), file=sys.stderr)
+    return 0 if not summary["failed"] else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="bulk import users from NDJSON, the verification emails go out through the running app")
+    parser.add_argument("path", help="NDJSON file, one user per line")
+    parser.add_argument("--report", help="write the per record results here instead of stdout")
+    parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE)
+    sys.exit(asyncio.run(_main(parser.parse_args())))
@@ -0,0 +1,319 @@
+from collections import deque
+from contextvars import ContextVar
+from botocore.exceptions import BotoCoreError, ClientError
+from sqlalchemy.exc import OperationalError, InterfaceError, DBAPIError, TimeoutError as PoolTimeoutError
+from services.deadline import DeadlineExceededError
+import asyncio
+import logging
+import os
+import threading
+import time
+
+# setting up the logger
+logger = logging.getLogger(__name__)
+
+# circuit breaker settings, a circuit opens after the threshold of failures within the window (seconds)
+# and lets the probes through again after the open timeout (seconds)
+CIRCUIT_BREAKER_ENABLED = os.getenv("APP_CIRCUIT_BREAKER_ENABLED", "true").lower() == "true"
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("APP_CIRCUIT_FAILURE_THRESHOLD", 5))
+CIRCUIT_WINDOW = float(os.getenv("APP_CIRCUIT_WINDOW", 10))
+CIRCUIT_OPEN_TIMEOUT = float(os.getenv("APP_CIRCUIT_OPEN_TIMEOUT", 15))
+CIRCUIT_HALF_OPEN_MAX_CALLS = int(os.getenv("APP_CIRCUIT_HALF_OPEN_MAX_CALLS", 1))
+CIRCUIT_DEBUG_ENDPOINT_ENABLED = os.getenv("APP_CIRCUIT_DEBUG_ENDPOINT_ENABLED", "false").lower() == "true"
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+STATE_GAUGE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# error codes AWS returns when it is overloaded, counted like the 5xx responses
+AWS_THROTTLING_CODES = frozenset(("Throttling", "ThrottlingException", "ThrottledException", "RequestLimitExceeded", "SlowDown", "RequestTimeout"))
+
+# client methods which never leave the process
+AWS_LOCAL_METHODS = frozenset(("generate_presigned_post", "generate_presigned_url", "can_paginate", "get_paginator", "get_waiter", "close"))
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling a dependency while its circuit is open
+    """
+    def __init__(self, name: str, retry_after: float = 0):
+        super().__init__(f"Circuit {name} is open")
+        self.name = name
+        self.retry_after = retry_after
+
+
+"""
+Function: is_database_failure
+Descr: Connection errors and pool timeouts count against the database circuit, constraint violations and bad queries do not.
+       A request running out of its own deadline does not either, clients choose how tight it is
+params: exc: Exception
+"""
+def is_database_failure(exc: Exception) -> bool:
+    if isinstance(exc, (OperationalError, InterfaceError, PoolTimeoutError)):
+        return True
+    if isinstance(exc, DBAPIError):
+        return exc.connection_invalidated
+    return isinstance(exc, ConnectionError)
+
+"""
+Function: is_aws_failure
+Descr: 5xx responses, throttling and network errors count against an AWS circuit, the other 4xx responses do not
+params: exc: Exception
+"""
+def is_aws_failure(exc: Exception) -> bool:
+    if isinstance(exc, ClientError):
+        error = exc.response.get("Error", {})
+        status_code = exc.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return status_code >= 500 or error.get("Code") in AWS_THROTTLING_CODES
+    return isinstance(exc, (BotoCoreError, ConnectionError))
+
+
+class _Guard:
+    def __init__(self, breaker):
+        self.breaker = breaker
+
+    def __enter__(self):
+        self.breaker.before_call()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if isinstance(exc_value, (DeadlineExceededError, asyncio.CancelledError)):
+            # the call was given up on, it tells nothing about the dependency
+            self.breaker.release_probe()
+        elif exc_value is not None and self.breaker.is_failure(exc_value):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return False
+
+
+class CircuitBreaker:
+    """
+    Counts the failures of one dependency in a rolling window. Closed lets every call through, open fails them right away,
+    after the open timeout half open lets a few probe calls through which close the circuit again or re-open it.
+    Calls run on the event loop and in the executor threads, so the state is locked.
+    """
+    def __init__(self, name: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD, window: float = CIRCUIT_WINDOW,
+                 open_timeout: float = CIRCUIT_OPEN_TIMEOUT, half_open_max_calls: int = CIRCUIT_HALF_OPEN_MAX_CALLS,
+                 is_failure=None, enabled: bool = CIRCUIT_BREAKER_ENABLED, statsd_client=None, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = max(failure_threshold, 1)
+        self.window = window
+        self.open_timeout = open_timeout
+        self.half_open_max_calls = max(half_open_max_calls, 1)
+        self.is_failure = is_failure or (lambda exc: isinstance(exc, Exception))
+        self.enabled = enabled
+        self.statsd_client = statsd_client
+        self.clock = clock
+        self.state = CLOSED
+        self.opened_at = None
+        self.rejected = 0
+        self.times_opened = 0
+        self._failures = deque()
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    def _set_state(self, state: str, now: float):
+        if state == self.state:
+            return
+        logger.info(f"Circuit {self.name}: {self.state} -> {state}")
+        self.state = state
+        if state == OPEN:
+            self.opened_at = now
+            self.times_opened += 1
+            if self.statsd_client: self.statsd_client.incr(f'circuit.{self.name}.opened')
+        elif state == HALF_OPEN:
+            self._probes = 0
+        else:
+            self.opened_at = None
+            self._failures.clear()
+        if self.statsd_client: self.statsd_client.gauge(f'circuit.{self.name}.state', STATE_GAUGE[state])
+
+    def _refresh(self, now: float):
+        if self.state == OPEN and now - self.opened_at >= self.open_timeout:
+            self._set_state(HALF_OPEN, now)
+        elif self.state == HALF_OPEN and now - self.opened_at >= 2 * self.open_timeout:
+            # probes which never reported back, e.g. a request which ended before calling the dependency
+            self.opened_at = now - self.open_timeout
+            self._probes = 0
+
+    def retry_after(self) -> float:
+        """
+        Seconds until the circuit lets calls through again, 0 when it does now. Does not take a probe slot
+        """
+        if not self.enabled:
+            return 0
+        with self._lock:
+            now = self.clock()
+            self._refresh(now)
+            if self.state == OPEN:
+                return self.opened_at + self.open_timeout - now
+            return 0
+
+    def before_call(self, probe: bool = True):
+        """
+        Raises CircuitOpenError when the call must not go out, takes a probe slot in half open.
+        Without probe it only rejects while the circuit is open, e.g. when opening a session, which is not a call itself
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            now = self.clock()
+            self._refresh(now)
+            if self.state == CLOSED:
+                return
+            if self.state == HALF_OPEN and not probe:
+                return
+            if self.state == HALF_OPEN and self._probes < self.half_open_max_calls:
+                self._probes += 1
+                return
+            self.rejected += 1
+            retry_after = self.opened_at + self.open_timeout - now if self.state == OPEN else self.open_timeout
+        if self.statsd_client: self.statsd_client.incr(f'circuit.{self.name}.rejected')
+        _record_rejection(self.name)
+        raise CircuitOpenError(self.name, max(retry_after, 0))
+
+    def record_success(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._set_state(CLOSED, self.clock())
+
+    def release_probe(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            if self.state == HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    def record_failure(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            now = self.clock()
+            if self.state == HALF_OPEN:
+                self._set_state(OPEN, now)
+                return
+            self._failures.append(now)
+            while self._failures and self._failures[0] <= now - self.window:
+                self._failures.popleft()
+            if self.state == CLOSED and len(self._failures) >= self.failure_threshold:
+                self._set_state(OPEN, now)
+
+    def protect(self) -> _Guard:
+        """
+        Context manager around one call to the dependency, usable around sync code and awaits alike
+        """
+        return _Guard(self)
+
+    def reset(self):
+        with self._lock:
+            self._set_state(CLOSED, self.clock())
+            self._failures.clear()
+
+    def stats(self) -> dict:
+        retry_after = self.retry_after()
+        with self._lock:
+            now = self.clock()
+            return {
+                "state": self.state,
+                "recent_failures": sum(1 for failed_at in self._failures if failed_at > now - self.window),
+                "failure_threshold": self.failure_threshold,
+                "window": self.window,
+                "open_timeout": self.open_timeout,
+                "retry_after": round(retry_after, 3),
+                "times_opened": self.times_opened,
+                "rejected": self.rejected
+            }
+
+
+class GuardedClient:
+    """
+    Proxy of a boto3 client, every API call goes through the circuit breaker of the service
+    """
+    def __init__(self, client, breaker: CircuitBreaker):
+        self._client = client
+        self._breaker = breaker
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._client, name)
+        if not callable(attribute) or name.startswith("_") or name in AWS_LOCAL_METHODS:
+            return attribute
+
+        def call(*args, **kwargs):
+            with self._breaker.protect():
+                return attribute(*args, **kwargs)
+        return call
+
+
+class GuardedSessionFactory:
+    """
+    Session factory of the background jobs and the admin import and export, refuses new sessions while the database circuit is open
+    """
+    def __init__(self, session_factory, breaker: CircuitBreaker):
+        self.session_factory = session_factory
+        self.breaker = breaker
+
+    def __call__(self):
+        # counted and reported like any other rejection
+        self.breaker.before_call(probe=False)
+        return self.session_factory()
+
+
+# circuits which turned a call of the current request away, a handler may have turned the error into another response
+_rejections = ContextVar("circuit_rejections", default=None)
+
+def _record_rejection(name: str):
+    rejections = _rejections.get()
+    if rejections is not None:
+        rejections.append(name)
+
+"""
+Function: start_request
+Descr: Starts collecting the circuits which reject calls of the current request, returns the list they are added to
+params: None
+"""
+def start_request() -> list:
+    rejections = []
+    _rejections.set(rejections)
+    return rejections
+
+
+class CircuitBreakers:
+    """
+    The circuit breakers of the process by dependency name, and the dependencies of the routes as
+    (path prefix, methods or None for all of them, dependency names), the longest prefix matching the method wins
+    """
+    def __init__(self, breakers: list, route_dependencies: tuple = ()):
+        self.breakers = {breaker.name: breaker for breaker in breakers}
+        self.route_dependencies = sorted(route_dependencies, key=lambda route: len(route[0]), reverse=True)
+
+    def __getitem__(self, name: str) -> CircuitBreaker:
+        return self.breakers[name]
+
+    def get(self, name: str):
+        return self.breakers.get(name)
+
+    def retry_after(self, method: str, path: str) -> tuple:
+        """
+        Returns (seconds, name) of an open circuit the route depends on, (0, None) when none is open
+        """
+        for prefix, methods, dependencies in self.route_dependencies:
+            if path.startswith(prefix) and (methods is None or method in methods):
+                for name in dependencies:
+                    retry_after = self.breakers[name].retry_after()
+                    if retry_after:
+                        return retry_after, name
+                break
+        return 0, None
+
+    def degraded(self) -> list:
+        """
+        Names of the dependencies whose circuit is not closed, read from memory without probing them
+        """
+        return [name for name, breaker in self.breakers.items() if breaker.enabled and breaker.state != CLOSED]
+
+    def stats(self) -> dict:
+        return {name: breaker.stats() for name, breaker in self.breakers.items()}
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import os
+import time
+
+# setting up the logger
+logger = logging.getLogger(__name__)
+
+# concurrency limiter settings, per route group "group=limit:queue size:queue timeout in seconds" separated by commas
+CONCURRENCY_LIMIT_ENABLED = os.getenv("APP_CONCURRENCY_LIMIT_ENABLED", "true").lower() == "true"
+CONCURRENCY_LIMITS = os.getenv("APP_CONCURRENCY_LIMITS", "user=64:128:1,pic=16:32:2,admin=2:0:0,default=32:64:1")
+CONCURRENCY_EXEMPT_PATHS = os.getenv("APP_CONCURRENCY_EXEMPT_PATHS", "/healthz,/cicd_new")
+
+# path prefix of every route group, the longest prefix wins and everything else is in the default group
+ROUTE_GROUPS = (
+    ("/v2/user/self/pic", "pic"),
+    ("/v2/admin", "admin"),
+    ("/v2/user", "user"),
+)
+
+
+"""
+Function: parse_group_limits
+Descr: Parses "group=limit:queue size:queue timeout,..." into {group: (limit, queue size, queue timeout)}
+params: value: str
+"""
+def parse_group_limits(value: str) -> dict:
+    limits = {}
+    for item in (value or "").split(","):
+        if not item.strip():
+            continue
+        group, _, settings = item.partition("=")
+        limit, queue_size, queue_timeout = (settings.split(":") + ["0", "0"])[:3]
+        limits[group.strip()] = (int(limit), int(queue_size or 0), float(queue_timeout or 0))
+    return limits
+
+
+class LoadShedError(Exception):
+    """
+    Raised when a request is turned away before any work started, the reason is queue_full or timeout
+    """
+    def __init__(self, group: str, reason: str):
+        super().__init__(f"{group}: {reason}")
+        self.group = group
+        self.reason = reason
+
+
+class RouteGroupLimiter:
+    """
+    Caps the requests in flight of one route group, the excess waits in a bounded FIFO queue up to the queue timeout.
+    """
+    def __init__(self, name: str, limit: int, queue_size: int = 0, queue_timeout: float = 0):
+        self.name = name
+        self.limit = max(limit, 1)
+        self.queue_size = max(queue_size, 0)
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self.shed = 0
+        self._semaphore = None
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # created lazily, it belongs to the event loop of the worker
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        return self._semaphore
+
+    async def acquire(self, timeout: float = None) -> float:
+        """
+        Waits for a slot, returns the seconds spent queued, raises LoadShedError instead of queueing past the bounds.
+        The timeout, e.g. what is left of the request deadline, shortens the queue timeout.
+        """
+        semaphore = self._get_semaphore()
+        if not semaphore.locked():
+            await semaphore.acquire()
+            self.in_flight += 1
+            return 0
+
+        if self.waiting >= self.queue_size:
+            self.shed += 1
+            raise LoadShedError(self.name, "queue_full")
+
+        timeout = self.queue_timeout if timeout is None else min(timeout, self.queue_timeout)
+        start_time = time.perf_counter()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(semaphore.acquire(), timeout=max(timeout, 0))
+        except asyncio.TimeoutError:
+            self.shed += 1
+            raise LoadShedError(self.name, "timeout")
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        return time.perf_counter() - start_time
+
+    def release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "queue_size": self.queue_size,
+            "queue_timeout": self.queue_timeout,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "shed": self.shed
+        }
+
+
+class ConcurrencyLimiter:
+    """
+    One RouteGroupLimiter per route group, the exempt paths (the health checks) are never limited or queued.
+    """
+    def __init__(self, enabled: bool = CONCURRENCY_LIMIT_ENABLED, limits: str = CONCURRENCY_LIMITS,
+                 exempt_paths: str = CONCURRENCY_EXEMPT_PATHS, route_groups: tuple = ROUTE_GROUPS, statsd_client=None):
+        self.enabled = enabled
+        self.exempt_paths = frozenset(path.strip() for path in exempt_paths.split(",") if path.strip())
+        self.route_groups = sorted(route_groups, key=lambda route_group: len(route_group[0]), reverse=True)
+        self.statsd_client = statsd_client
+        self.groups = {
+            name: RouteGroupLimiter(name, limit, queue_size, queue_timeout)
+            for name, (limit, queue_size, queue_timeout) in parse_group_limits(limits).items()
+        }
+
+    def group_for(self, path: str):
+        """
+        Returns the limiter of the path, None when it is exempt or its group has no limit configured
+        """
+        if not self.enabled or path in self.exempt_paths:
+            return None
+        for prefix, name in self.route_groups:
+            if path.startswith(prefix):
+                return self.groups.get(name)
+        return self.groups.get("default")
+
+    async def acquire(self, group: RouteGroupLimiter, timeout: float = None):
+        try:
+            queue_wait = await group.acquire(timeout)
+        except LoadShedError as e:
+            if self.statsd_client: self.statsd_client.incr(f'concurrency.{group.name}.shed', tags={"reason": e.reason})
+            raise
+        if self.statsd_client:
+            self.statsd_client.timing(f'concurrency.{group.name}.queue_wait.time', queue_wait * 1000)
+            self.statsd_client.gauge(f'concurrency.{group.name}.in_flight', group.in_flight)
+
+    def stats(self) -> dict:
+        return {name: group.stats() for name, group in self.groups.items()}
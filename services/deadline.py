@@ -0,0 +1,125 @@
+from contextvars import ContextVar
+import asyncio
+import logging
+import os
+import time
+
+# setting up the logger
+logger = logging.getLogger(__name__)
+
+# request deadline settings in milliseconds, per route overrides are "path prefix=ms" separated by commas, 0 is no deadline
+DEADLINE_ENABLED = os.getenv("APP_DEADLINE_ENABLED", "true").lower() == "true"
+DEADLINE_DEFAULT_MS = int(os.getenv("APP_DEADLINE_DEFAULT_MS", 10000))
+DEADLINE_ROUTES = os.getenv("APP_DEADLINE_ROUTES", "/v2/user/self/pic=30000,/v2/admin=0")
+# clients can tighten the deadline of their request, never extend it
+DEADLINE_HEADER = "x-request-timeout"
+
+_current_deadline = ContextVar("request_deadline", default=None)
+
+
+class DeadlineExceededError(Exception):
+    """
+    Raised instead of waiting on a dependency past the request deadline
+    """
+    def __init__(self, dependency: str):
+        super().__init__(f"Request deadline exceeded waiting on {dependency}")
+        self.dependency = dependency
+
+
+class RequestDeadline:
+    """
+    Absolute deadline of the current request, records the dependency which ran out of time.
+    """
+    __slots__ = ("expires_at", "exceeded")
+
+    def __init__(self, timeout: float):
+        self.expires_at = time.monotonic() + timeout
+        self.exceeded = None
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+
+"""
+Function: parse_route_deadlines
+Descr: Parses "prefix=ms,..." into (prefix, seconds) tuples, longest prefix first
+params: value: str
+"""
+def parse_route_deadlines(value: str) -> list:
+    routes = []
+    for item in (value or "").split(","):
+        if not item.strip():
+            continue
+        prefix, _, timeout = item.partition("=")
+        routes.append((prefix.strip(), int(timeout) / 1000))
+    return sorted(routes, key=lambda route: len(route[0]), reverse=True)
+
+ROUTE_DEADLINES = parse_route_deadlines(DEADLINE_ROUTES)
+
+"""
+Function: timeout_for
+Descr: Returns the timeout in seconds of a request, the route default tightened by the client header, None without a deadline
+params: path: str, header: str, value of the X-Request-Timeout header in milliseconds
+"""
+def timeout_for(path: str, header: str = None, default_ms: int = DEADLINE_DEFAULT_MS, routes: list = None):
+    timeout = default_ms / 1000
+    for prefix, route_timeout in (ROUTE_DEADLINES if routes is None else routes):
+        if path.startswith(prefix):
+            timeout = route_timeout
+            break
+
+    if header:
+        try:
+            requested = int(header) / 1000
+        except ValueError:
+            requested = 0
+        if requested > 0:
+            timeout = min(timeout, requested) if timeout > 0 else requested
+    return timeout if timeout > 0 else None
+
+"""
+Function: start_deadline
+Descr: Sets the deadline of the current request, returns it or None when the request has no deadline
+params: timeout: float, seconds
+"""
+def start_deadline(timeout: float):
+    if not DEADLINE_ENABLED or timeout is None:
+        _current_deadline.set(None)
+        return None
+    deadline = RequestDeadline(timeout)
+    _current_deadline.set(deadline)
+    return deadline
+
+"""
+Function: remaining
+Descr: Seconds left before the deadline of the current request, None without a deadline
+params: None
+"""
+def remaining():
+    deadline = _current_deadline.get()
+    return None if deadline is None else deadline.remaining()
+
+"""
+Function: bounded
+Descr: Awaits a call to a dependency for at most the remaining budget of the request,
+       raises DeadlineExceededError and marks the request as timed out otherwise
+params: awaitable: coroutine or future, dependency: str, e.g. db or s3
+"""
+async def bounded(awaitable, dependency: str):
+    deadline = _current_deadline.get()
+    if deadline is None:
+        return await awaitable
+
+    budget = deadline.remaining()
+    if budget <= 0:
+        # the call is never started
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        deadline.exceeded = dependency
+        raise DeadlineExceededError(dependency)
+
+    try:
+        return await asyncio.wait_for(awaitable, timeout=budget)
+    except asyncio.TimeoutError:
+        deadline.exceeded = dependency
+        raise DeadlineExceededError(dependency)
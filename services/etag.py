@@ -0,0 +1,30 @@
+from datetime import datetime
+import hashlib
+
+"""
+Function: make_etag
+Descr: Strong ETag of a user profile derived from its id and account_updated, which every update moves forward,
+       so a conditional request is answered without serializing the profile
+params: user_id: str, account_updated: datetime
+"""
+def make_etag(user_id: str, account_updated: datetime) -> str:
+    version = account_updated.isoformat() if account_updated else ""
+    return f'"{hashlib.blake2b(f"{user_id}:{version}".encode(), digest_size=16).hexdigest()}"'
+
+"""
+Function: etag_matches
+Descr: Checks an If-None-Match header against an ETag, with the weak comparison RFC 9110 asks for
+params: if_none_match: str, etag: str
+"""
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
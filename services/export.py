@@ -0,0 +1,224 @@
+"""
+Streaming user export as NDJSON or CSV, optionally with the images and the verification status of every user.
+
+Users are read in keyset pages ordered by (account_created, id), each page through a server-side cursor, so memory
+stays bounded by the page size whatever the table size is. Every record carries the cursor token of its position,
+an interrupted export resumes from the last received one. The password hash, the verification token and the
+verification link are never selected.
+
+    python -m services.export --format csv --include images,verifications --output users.csv
+"""
+from sqlalchemy import select, and_, or_
+from models.user import User, Image, Verification
+from datetime import datetime
+import argparse
+import asyncio
+import base64
+import csv
+import io
+import json
+import logging
+import os
+import sys
+import orjson
+
+# setting up the logger
+logger = logging.getLogger(__name__)
+
+# users per keyset page, also the server-side cursor batch size
+EXPORT_PAGE_SIZE = int(os.getenv("APP_EXPORT_PAGE_SIZE", 1000))
+
+EXPORT_FORMATS = ("ndjson", "csv")
+EXPORT_INCLUDES = ("images", "verifications")
+
+# exported user columns, the password is deliberately not part of them
+USER_COLUMNS = (User.id, User.email, User.first_name, User.last_name, User.account_created, User.account_updated, User.is_verified)
+VERIFICATION_COLUMNS = (
+    Verification.link_verified.label("verification_link_verified"),
+    Verification.expiration_time.label("verification_expiration_time"),
+    Verification.created_at.label("verification_created_at")
+)
+IMAGE_COLUMNS = (Image.user_id, Image.id, Image.url, Image.upload_date)
+
+
+class InvalidCursorError(ValueError):
+    pass
+
+
+"""
+Function: encode_cursor
+Descr: Opaque resume token of an exported row, the keyset position (account_created, id)
+params: account_created: datetime, user_id: str
+"""
+def encode_cursor(account_created: datetime, user_id: str) -> str:
+    position = [account_created.isoformat() if account_created else None, user_id]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode().rstrip("=")
+
+"""
+Function: decode_cursor
+Descr: Returns the (account_created, id) position of a resume token, raises InvalidCursorError when it is malformed
+params: token: str
+"""
+def decode_cursor(token: str) -> tuple:
+    try:
+        account_created, user_id = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        return (datetime.fromisoformat(account_created) if account_created else None), str(user_id)
+    except (ValueError, TypeError) as e:
+        raise InvalidCursorError(f"Invalid export cursor: {e}")
+
+"""
+Function: parse_includes
+Descr: Validates the comma separated list of related tables to export
+params: include: str
+"""
+def parse_includes(include: str) -> tuple:
+    includes = tuple(name.strip() for name in (include or "").split(",") if name.strip())
+    unknown = [name for name in includes if name not in EXPORT_INCLUDES]
+    if unknown:
+        raise ValueError(f"Unknown export include: {', '.join(unknown)}")
+    return includes
+
+
+def _after(position: tuple):
+    # expanded instead of a row comparison, MySQL only uses the index range for this form
+    account_created, user_id = position
+    if account_created is None:
+        return or_(User.account_created.is_not(None), and_(User.account_created.is_(None), User.id > user_id))
+    return or_(User.account_created > account_created, and_(User.account_created == account_created, User.id > user_id))
+
+
+class UserExporter:
+    """
+    Yields the encoded export in chunks of one page each, NDJSON lines or CSV rows with a header
+    """
+    def __init__(self, session_factory, format: str = "ndjson", includes: tuple = (), page_size: int = EXPORT_PAGE_SIZE, cursor: str = None):
+        if format not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format: {format}")
+        self.session_factory = session_factory
+        self.format = format
+        self.includes = includes
+        self.page_size = max(page_size, 1)
+        self.position = decode_cursor(cursor) if cursor else None
+        self.rows = 0
+
+    def _page_query(self):
+        columns = USER_COLUMNS + (VERIFICATION_COLUMNS if "verifications" in self.includes else ())
+        # NULL account_created sorts first in MySQL and SQLite, the keyset condition follows that order
+        query = select(*columns).order_by(User.account_created, User.id).limit(self.page_size)
+        if "verifications" in self.includes:
+            # one verification per user, the join cannot repeat a user
+            query = query.outerjoin(Verification, Verification.email == User.email)
+        if self.position is not None:
+            query = query.where(_after(self.position))
+        return query.execution_options(yield_per=self.page_size)
+
+    async def _images_by_user(self, db, user_ids: list) -> dict:
+        images = {}
+        result = await db.execute(select(*IMAGE_COLUMNS).where(Image.user_id.in_(user_ids)).order_by(Image.upload_date))
+        for user_id, image_id, url, upload_date in result.all():
+            images.setdefault(user_id, []).append({"id": image_id, "url": url, "upload_date": upload_date})
+        return images
+
+    def _record(self, row, images: dict) -> dict:
+        record = {
+            "id": row.id,
+            "email": row.email,
+            "first_name": row.first_name,
+            "last_name": row.last_name,
+            "account_created": row.account_created,
+            "account_updated": row.account_updated,
+            "is_verified": row.is_verified
+        }
+        if "verifications" in self.includes:
+            record["verification"] = None if row.verification_created_at is None else {
+                "link_verified": row.verification_link_verified,
+                "expiration_time": row.verification_expiration_time,
+                "created_at": row.verification_created_at
+            }
+        if "images" in self.includes:
+            record["images"] = images.get(row.id, [])
+        record["cursor"] = encode_cursor(row.account_created, row.id)
+        return record
+
+    def _csv_header(self) -> list:
+        header = ["id", "email", "first_name", "last_name", "account_created", "account_updated", "is_verified"]
+        if "verifications" in self.includes:
+            header += ["verification_link_verified", "verification_expiration_time", "verification_created_at"]
+        if "images" in self.includes:
+            header += ["image_id", "image_url", "image_upload_date"]
+        return header + ["cursor"]
+
+    def _csv_row(self, record: dict) -> list:
+        row = [record["id"], record["email"], record["first_name"], record["last_name"], record["account_created"], record["account_updated"], record["is_verified"]]
+        if "verifications" in self.includes:
+            verification = record["verification"] or {}
+            row += [verification.get("link_verified"), verification.get("expiration_time"), verification.get("created_at")]
+        if "images" in self.includes:
+            # a user has a single profile picture, the latest one is exported
+            image = record["images"][-1] if record["images"] else {}
+            row += [image.get("id"), image.get("url"), image.get("upload_date")]
+        row.append(record["cursor"])
+        return [value.isoformat() if isinstance(value, datetime) else value for value in row]
+
+    def _encode(self, records: list) -> bytes:
+        if self.format == "ndjson":
+            return b"".join(orjson.dumps(record) + b"\n" for record in records)
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerows(self._csv_row(record) for record in records)
+        return buffer.getvalue().encode()
+
+    async def _read_page(self) -> list:
+        # a short session per page, the export never holds a transaction open while the client reads
+        async with self.session_factory() as db:
+            stream = await db.stream(self._page_query())
+            rows = [row async for row in stream]
+            images = await self._images_by_user(db, [row.id for row in rows]) if "images" in self.includes and rows else {}
+        return [self._record(row, images) for row in rows]
+
+    async def run(self):
+        if self.format == "csv":
+            buffer = io.StringIO()
+            csv.writer(buffer, lineterminator="\n").writerow(self._csv_header())
+            yield buffer.getvalue().encode()
+
+        while True:
+            records = await self._read_page()
+            if not records:
+                break
+            self.rows += len(records)
+            last = records[-1]
+            self.position = (last["account_created"], last["id"])
+            yield self._encode(records)
+            if len(records) < self.page_size:
+                break
+        logger.info(f"User export finished: {self.rows} rows")
+
+
+async def _main(args) -> int:
+    from database import async_session, dispose_async_engine
+
+    try:
+        exporter = UserExporter(async_session, format=args.format, includes=parse_includes(args.include), page_size=args.page_size, cursor=args.cursor)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        async for chunk in exporter.run():
+            output.write(chunk)
+    finally:
+        if args.output:
+            output.close()
+        await dispose_async_engine()
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="stream the users table as NDJSON or CSV")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="ndjson")
+    parser.add_argument("--include", default="", help="comma separated: images, verifications")
+    parser.add_argument("--cursor", help="resume after the record with this cursor")
+    parser.add_argument("--page-size", type=int, default=EXPORT_PAGE_SIZE)
+    parser.add_argument("--output", help="write here instead of stdout")
+    sys.exit(asyncio.run(_main(parser.parse_args())))
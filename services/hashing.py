@@ -0,0 +1,98 @@
+from concurrent.futures import ProcessPoolExecutor
+from services.tracing import span
+import asyncio
+import logging
+import os
+import time
+import bcrypt
+
+# setting up the logger
+logger = logging.getLogger(__name__)
+
+# hashing pool settings
+HASHING_POOL_SIZE = int(os.getenv("APP_HASHING_POOL_SIZE", os.cpu_count() or 1))
+HASHING_QUEUE_SIZE = int(os.getenv("APP_HASHING_QUEUE_SIZE", 64))
+
+
+class HashingQueueFullError(Exception):
+    """
+    Raised when the hashing queue is full, callers should answer 503.
+    """
+    pass
+
+
+# the functions below run inside the worker processes
+def _hash_password(password: bytes) -> bytes:
+    return bcrypt.hashpw(password=password, salt=bcrypt.gensalt())
+
+def _check_password(password: bytes, hashed_password: bytes) -> bool:
+    return bcrypt.checkpw(password, hashed_password)
+
+def _hash_passwords(passwords: list) -> list:
+    return [bcrypt.hashpw(password=password, salt=bcrypt.gensalt()) for password in passwords]
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt in a process pool so the CPU heavy hashing stays off the event loop.
+    At most pool_size + queue_size calls are pending at a time, the rest fail fast.
+    """
+    def __init__(self, pool_size: int = HASHING_POOL_SIZE, queue_size: int = HASHING_QUEUE_SIZE, statsd_client=None):
+        self.pool_size = max(pool_size, 1)
+        self.max_pending = self.pool_size + max(queue_size, 0)
+        self.pending = 0
+        self.statsd_client = statsd_client
+        self._executor = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.pool_size)
+            logger.info(f"Hashing pool started with {self.pool_size} workers")
+        return self._executor
+
+    async def _submit(self, metric: str, func, *args):
+        if self.pending >= self.max_pending:
+            logger.info("Hashing queue is full, rejecting the request...")
+            if self.statsd_client: self.statsd_client.incr('bcrypt.queue.rejected')
+            raise HashingQueueFullError()
+
+        self.pending += 1
+        if self.statsd_client: self.statsd_client.gauge('bcrypt.queue.depth', self.pending)
+        start_time = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            with span('bcrypt'):
+                return await loop.run_in_executor(self._get_executor(), func, *args)
+        finally:
+            self.pending -= 1
+            # hash latency in milliseconds, includes the time spent waiting in the queue
+            if self.statsd_client: self.statsd_client.timing(metric, (time.perf_counter() - start_time) * 1000)
+
+    async def hash_password(self, password: str) -> str:
+        """
+        Hashes the password with a new salt
+        """
+        hashed_password = await self._submit('bcrypt.hash.time', _hash_password, password.encode('utf-8'))
+        return hashed_password.decode('utf-8')
+
+    async def hash_passwords(self, passwords: list) -> list:
+        """
+        Hashes a batch of passwords, split in one slice per worker so a batch takes a single queue slot per worker
+        """
+        if not passwords:
+            return []
+        slice_size = -(-len(passwords) // self.pool_size)
+        slices = [[password.encode('utf-8') for password in passwords[start:start + slice_size]] for start in range(0, len(passwords), slice_size)]
+        results = await asyncio.gather(*(self._submit('bcrypt.hash_batch.time', _hash_passwords, passwords_slice) for passwords_slice in slices))
+        return [hashed_password.decode('utf-8') for hashed_passwords in results for hashed_password in hashed_passwords]
+
+    async def check_password(self, password: str, hashed_password: str) -> bool:
+        """
+        Checks the password against the stored bcrypt hash
+        """
+        return await self._submit('bcrypt.check.time', _check_password, password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,260 @@
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image as PILImage, ImageOps
+from models.user import Image, ImageVariant
+import asyncio
+import io
+import logging
+import os
+import time
+import uuid
+
+# setting up the logger
+logger = logging.getLogger(__name__)
+
+# image pipeline settings
+IMAGE_PIPELINE_ENABLED = os.getenv("APP_IMAGE_PIPELINE_ENABLED", "true").lower() == "true"
+IMAGE_POOL_SIZE = int(os.getenv("APP_IMAGE_POOL_SIZE", 2))
+
+# variant name -> longest side in pixels, "full" is the original size capped and stripped of its metadata
+VARIANT_SIZES = {
+    "thumbnail": 128,
+    "small": 256,
+    "medium": 512,
+    "full": 2048
+}
+
+# magic bytes of the formats which are allowed to be uploaded
+IMAGE_SIGNATURES = {
+    "image/png": b"\x89PNG\r\n\x1a\n",
+    "image/jpeg": b"\xff\xd8\xff"
+}
+SIGNATURE_LENGTH = max(len(signature) for signature in IMAGE_SIGNATURES.values())
+
+
+class InvalidImageError(Exception):
+    """
+    Raised when the bytes do not match the declared image format.
+    """
+    pass
+
+
+"""
+Function: sniff_image_type
+Descr: Returns the real content type from the magic bytes, None for anything else than PNG or JPEG
+params: data: bytes
+"""
+def sniff_image_type(data: bytes):
+    for content_type, signature in IMAGE_SIGNATURES.items():
+        if data.startswith(signature):
+            return content_type
+    return None
+
+"""
+Function: normalize_content_type
+Descr: image/jpg is not a registered type, it is the same format as image/jpeg
+params: content_type: str
+"""
+def normalize_content_type(content_type: str) -> str:
+    return "image/jpeg" if content_type == "image/jpg" else content_type
+
+"""
+Function: validate_image_stream
+Descr: Passes the chunks through, checking the magic bytes of the first ones against the declared content type
+params: chunks: async iterator of bytes, content_type: str
+"""
+async def validate_image_stream(chunks, content_type: str):
+    head = b""
+    validated = False
+    async for chunk in chunks:
+        if not validated:
+            head += chunk
+            if len(head) < SIGNATURE_LENGTH:
+                continue
+            if sniff_image_type(head) != normalize_content_type(content_type):
+                raise InvalidImageError("The file content does not match the content type")
+            validated = True
+            chunk = head
+        yield chunk
+
+    if not validated:
+        # the whole body was shorter than a signature
+        if sniff_image_type(head) != normalize_content_type(content_type):
+            raise InvalidImageError("The file content does not match the content type")
+        yield head
+
+
+# runs inside the worker processes
+def strip_metadata(data: bytes) -> tuple:
+    """
+    Re-encodes the original upload in its own format without EXIF, GPS or any other metadata,
+    returns (body, content_type). The EXIF orientation is applied to the pixels first.
+    """
+    content_type = sniff_image_type(data)
+    if content_type is None:
+        raise InvalidImageError("Unsupported image format")
+
+    try:
+        source = PILImage.open(io.BytesIO(data))
+        source.load()
+    except (PILImage.UnidentifiedImageError, PILImage.DecompressionBombError, OSError) as e:
+        raise InvalidImageError(f"Corrupt image: {e}")
+
+    with source:
+        image = ImageOps.exif_transpose(source)
+        output = io.BytesIO()
+        if content_type == "image/png":
+            image.save(output, format="PNG", optimize=True)
+        else:
+            image.convert("RGB").save(output, format="JPEG", quality=95, optimize=True)
+        return output.getvalue(), content_type
+
+# runs inside the worker processes
+def render_variants(data: bytes, variant_sizes: dict = VARIANT_SIZES) -> list:
+    """
+    Decodes the image and returns the re-encoded variants as (name, body, content_type, width, height).
+    Re-encoding from the pixel data drops EXIF and any other metadata.
+    """
+    content_type = sniff_image_type(data)
+    if content_type is None:
+        raise InvalidImageError("Unsupported image format")
+
+    try:
+        source = PILImage.open(io.BytesIO(data))
+        source.load()
+    except (PILImage.UnidentifiedImageError, PILImage.DecompressionBombError, OSError) as e:
+        raise InvalidImageError(f"Corrupt image: {e}")
+
+    with source:
+        # apply the EXIF orientation before the metadata is dropped
+        source = ImageOps.exif_transpose(source)
+        has_alpha = source.mode in ("RGBA", "LA") or (source.mode == "P" and "transparency" in source.info)
+        source = source.convert("RGBA" if has_alpha else "RGB")
+
+        variants = []
+        for name, max_side in variant_sizes.items():
+            variant = source.copy()
+            variant.thumbnail((max_side, max_side), PILImage.LANCZOS)
+            output = io.BytesIO()
+            if has_alpha:
+                variant.save(output, format="PNG", optimize=True)
+                variant_type = "image/png"
+            else:
+                variant.save(output, format="JPEG", quality=85, optimize=True, progressive=True)
+                variant_type = "image/jpeg"
+            variants.append((name, output.getvalue(), variant_type, variant.width, variant.height))
+        return variants
+
+
+class ImagePipeline:
+    """
+    Builds the image variants in the background after an upload: downloads the original from S3,
+    renders the variants in a process pool, replaces the original by a copy stripped of its metadata,
+    uploads the variants and records them on the image.
+    """
+    def __init__(self, s3_factory, session_factory, bucket_name: str = None, pool_size: int = IMAGE_POOL_SIZE, statsd_client=None):
+        self.s3_factory = s3_factory
+        self.session_factory = session_factory
+        self.bucket_name = bucket_name or os.getenv("APP_S3_BUCKET_NAME")
+        self.pool_size = max(pool_size, 1)
+        self.statsd_client = statsd_client
+        self._executor = None
+        self._tasks = set()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.pool_size)
+            logger.info(f"Image processing pool started with {self.pool_size} workers")
+        return self._executor
+
+    def submit(self, image_id: str, file_name: str):
+        """
+        Schedules the variants of an uploaded image, the request does not wait for them
+        """
+        task = asyncio.create_task(self._process_logged(image_id, file_name))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        if self.statsd_client: self.statsd_client.gauge('image.pipeline.pending', len(self._tasks))
+        return task
+
+    async def _process_logged(self, image_id: str, file_name: str):
+        try:
+            return await self.process(image_id, file_name)
+        except Exception as e:
+            logger.error(f"Failed to create the variants of {file_name}: {e}")
+            if self.statsd_client: self.statsd_client.incr('image.process.failed')
+
+    async def process(self, image_id: str, file_name: str) -> list:
+        s3 = self.s3_factory()
+        response = await asyncio.to_thread(s3.get_object, Bucket=self.bucket_name, Key=file_name)
+        data = await asyncio.to_thread(response["Body"].read)
+
+        start_time = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            rendered = await loop.run_in_executor(self._get_executor(), render_variants, data)
+        except InvalidImageError as e:
+            logger.info(f"Image {file_name} is not a valid image, no variants created: {e}")
+            if self.statsd_client: self.statsd_client.incr('image.process.invalid')
+            return []
+        finally:
+            # per image processing time in milliseconds
+            if self.statsd_client: self.statsd_client.timing('image.process.time', (time.perf_counter() - start_time) * 1000)
+
+        # the original is still served as the url of the image, it must not keep the GPS position of the upload.
+        # It is replaced before the variants are recorded, so a delete of the image in the meantime is caught below
+        stripped, content_type = await loop.run_in_executor(self._get_executor(), strip_metadata, data)
+        await asyncio.to_thread(s3.put_object, Bucket=self.bucket_name, Key=file_name, Body=stripped, ContentType=content_type)
+
+        base_name = file_name.rsplit(".", 1)[0]
+        variants = []
+        for name, body, content_type, width, height in rendered:
+            variant_key = f"{base_name}-{name}-{uuid.uuid4().hex[:8]}.{content_type.split('/')[-1]}"
+            await asyncio.to_thread(s3.put_object, Bucket=self.bucket_name, Key=variant_key, Body=body, ContentType=content_type)
+            variants.append(ImageVariant(
+                image_id=image_id,
+                name=name,
+                file_name=variant_key,
+                url=f"https://{self.bucket_name}.s3.amazonaws.com/{variant_key}",
+                content_type=content_type,
+                width=width,
+                height=height,
+                size=len(body)
+            ))
+
+        try:
+            async with self.session_factory() as db:
+                # not every database enforces the foreign key of the variants
+                if await db.get(Image, image_id) is None:
+                    raise LookupError(f"image {image_id} not found")
+                db.add_all(variants)
+                await db.commit()
+        except Exception as e:
+            # most likely the image was deleted while its variants were rendered
+            logger.info(f"Failed to save the variants of {file_name}, removing them from S3: {e}")
+            for variant in variants:
+                await asyncio.to_thread(s3.delete_object, Bucket=self.bucket_name, Key=variant.file_name)
+            # the stripped copy must not outlive a deleted image, while the image exists it is its original
+            if not await self._image_exists(image_id):
+                await asyncio.to_thread(s3.delete_object, Bucket=self.bucket_name, Key=file_name)
+            return []
+
+        logger.info(f"Created {len(variants)} variants for {file_name}")
+        return variants
+
+    async def _image_exists(self, image_id: str) -> bool:
+        try:
+            async with self.session_factory() as db:
+                return await db.get(Image, image_id) is not None
+        except Exception as e:
+            # the original is kept when in doubt, it is removed along with the image
+            logger.error(f"Failed to check the image {image_id}: {e}")
+            return True
+
+    async def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,206 @@
+from datetime import timedelta
+import asyncio
+import logging
+import os
+import socket
+import threading
+import time
+
+# setting up the logger
+logger = logging.getLogger(__name__)
+
+# statsd settings, the CloudWatch agent listens on localhost:8125
+STATSD_HOST = os.getenv("APP_STATSD_HOST", "localhost")
+STATSD_PORT = int(os.getenv("APP_STATSD_PORT", 8125))
+METRICS_FLUSH_INTERVAL = float(os.getenv("APP_METRICS_FLUSH_INTERVAL", 1))
+# flush early once this many samples are buffered
+METRICS_MAX_BUFFER = int(os.getenv("APP_METRICS_MAX_BUFFER", 1000))
+# stay below the usual network MTU so the packets are not fragmented
+METRICS_MAX_PACKET_SIZE = 1432
+
+
+class UdpTransport:
+    """
+    Fire and forget UDP sender, a missing agent must never fail a request.
+    """
+    def __init__(self, host: str = STATSD_HOST, port: int = STATSD_PORT):
+        self.address = (socket.gethostbyname(host), port)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def __call__(self, packet: bytes):
+        try:
+            self._socket.sendto(packet, self.address)
+        except OSError:
+            pass
+
+    def close(self):
+        self._socket.close()
+
+
+class _Timer:
+    def __init__(self, client, stat: str, tags: dict):
+        self.client = client
+        self.stat = stat
+        self.tags = tags
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.client.timing(self.stat, (time.perf_counter() - self._start) * 1000, tags=self.tags)
+
+
+class BufferedStatsClient:
+    """
+    Drop-in for statsd.StatsClient which aggregates in memory instead of sending a packet per call.
+    Counters are summed and gauges keep their last value until the next flush, timings are kept
+    per sample. The buffer goes out every flush_interval seconds, or as soon as max_buffer samples
+    are waiting, packed into as few packets as possible. Tags use the DogStatsD format the
+    CloudWatch agent understands.
+    """
+    def __init__(self, transport=None, prefix: str = None, flush_interval: float = METRICS_FLUSH_INTERVAL,
+                 max_buffer: int = METRICS_MAX_BUFFER, max_packet_size: int = METRICS_MAX_PACKET_SIZE):
+        self._transport = transport
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.max_packet_size = max_packet_size
+        self._counters = {}
+        self._gauges = {}
+        self._timings = {}
+        self._samples = 0
+        self._lock = threading.Lock()
+        self._task = None
+
+    @property
+    def transport(self):
+        # the socket is only opened on the first flush
+        if self._transport is None:
+            self._transport = UdpTransport()
+        return self._transport
+
+    @staticmethod
+    def _key(stat: str, tags: dict):
+        return (stat, tuple(sorted(tags.items())) if tags else ())
+
+    def _added(self):
+        self._samples += 1
+        return self._samples >= self.max_buffer
+
+    def incr(self, stat: str, count: int = 1, tags: dict = None):
+        key = self._key(stat, tags)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + count
+            full = self._added()
+        if full:
+            self.flush()
+
+    def decr(self, stat: str, count: int = 1, tags: dict = None):
+        self.incr(stat, -count, tags)
+
+    def gauge(self, stat: str, value, tags: dict = None):
+        key = self._key(stat, tags)
+        with self._lock:
+            self._gauges[key] = value
+            full = self._added()
+        if full:
+            self.flush()
+
+    def timing(self, stat: str, delta, tags: dict = None):
+        """
+        Records a duration in milliseconds, a timedelta is converted
+        """
+        if isinstance(delta, timedelta):
+            delta = delta.total_seconds() * 1000
+        key = self._key(stat, tags)
+        with self._lock:
+            self._timings.setdefault(key, []).append(delta)
+            full = self._added()
+        if full:
+            self.flush()
+
+    def timer(self, stat: str, tags: dict = None) -> _Timer:
+        return _Timer(self, stat, tags)
+
+    def _line(self, key, value, metric_type: str) -> str:
+        stat, tags = key
+        if self.prefix:
+            stat = f"{self.prefix}.{stat}"
+        if isinstance(value, float):
+            value = round(value, 3)
+        line = f"{stat}:{value}|{metric_type}"
+        if tags:
+            line += "|#" + ",".join(f"{name}:{tag}" for name, tag in tags)
+        return line
+
+    def flush(self) -> int:
+        """
+        Sends everything buffered so far, returns the number of packets sent
+        """
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            gauges, self._gauges = self._gauges, {}
+            timings, self._timings = self._timings, {}
+            self._samples = 0
+
+        lines = [self._line(key, count, "c") for key, count in counters.items()]
+        lines += [self._line(key, value, "g") for key, value in gauges.items()]
+        lines += [self._line(key, value, "ms") for key, values in timings.items() for value in values]
+        if not lines:
+            return 0
+
+        packets = 0
+        packet = ""
+        for line in lines:
+            if packet and len(packet) + len(line) + 1 > self.max_packet_size:
+                self.transport(packet.encode())
+                packets += 1
+                packet = ""
+            packet = f"{packet}\n{line}" if packet else line
+        self.transport(packet.encode())
+        return packets + 1
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush the metrics... {e}")
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush()
+
+
+"""
+Function: status_class
+Descr: Groups the status codes as 2xx, 3xx, 4xx and 5xx to keep the number of tag values small
+params: status_code: int
+"""
+def status_class(status_code: int) -> str:
+    return f"{status_code // 100}xx"
+
+"""
+Function: route_name
+Descr: Returns the matched route template of a request, unmatched paths and 404 probes share one name
+params: scope: ASGI scope
+"""
+def route_name(scope) -> str:
+    route = scope.get("route")
+    path = getattr(route, "path", None)
+    if not path:
+        return "unmatched"
+    # ':', '|' and '#' are separators in the statsd protocol
+    return path.replace(":", "_").replace("|", "_").replace("#", "_")
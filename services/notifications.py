@@ -0,0 +1,215 @@
+from sqlalchemy import select, delete
+from models.outbox import OutboxMessage
+from services.tracing import span
+from services.circuit_breaker import CircuitOpenError
+from datetime import datetime, timedelta, timezone
+import asyncio
+import logging
+import os
+import time
+
+# setting up the logger
+logger = logging.getLogger(__name__)
+
+# outbox dispatcher settings
+OUTBOX_DISPATCHER_ENABLED = os.getenv("APP_OUTBOX_DISPATCHER_ENABLED", "true").lower() == "true"
+OUTBOX_DISPATCH_INTERVAL = float(os.getenv("APP_OUTBOX_DISPATCH_INTERVAL", 2))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("APP_OUTBOX_MAX_ATTEMPTS", 8))
+OUTBOX_BACKOFF_BASE = float(os.getenv("APP_OUTBOX_BACKOFF_BASE", 2))
+OUTBOX_BACKOFF_MAX = float(os.getenv("APP_OUTBOX_BACKOFF_MAX", 300))
+
+# sent messages are deleted once they are older than the retention, failed ones are kept for inspection
+OUTBOX_RETENTION_MINUTES = int(os.getenv("APP_OUTBOX_RETENTION_MINUTES", 1440))
+OUTBOX_PURGE_INTERVAL = float(os.getenv("APP_OUTBOX_PURGE_INTERVAL", 300))
+OUTBOX_PURGE_BATCH_SIZE = int(os.getenv("APP_OUTBOX_PURGE_BATCH_SIZE", 500))
+
+# SNS accepts at most 10 entries per publish_batch call
+SNS_BATCH_SIZE = 10
+
+
+class SnsPublisher:
+    """
+    Publishes outbox messages with SNS publish_batch.
+    """
+    def __init__(self, client_factory):
+        self.client_factory = client_factory
+
+    def publish_batch(self, topic_arn: str, messages: list) -> dict:
+        """
+        Publishes up to 10 (id, body) pairs, returns the error message per failed id
+        """
+        with span('sns'):
+            response = self.client_factory().publish_batch(
+                TopicArn = topic_arn,
+                PublishBatchRequestEntries = [{"Id": message_id, "Message": body} for message_id, body in messages]
+            )
+        return {failed["Id"]: failed.get("Message", failed.get("Code", "failed")) for failed in response.get("Failed", [])}
+
+
+class OutboxDispatcher:
+    """
+    Drains the outbox in the background, batching messages per topic into publish_batch calls.
+    Failed messages are retried with exponential backoff until OUTBOX_MAX_ATTEMPTS,
+    messages held back by an open SNS circuit are left pending without using up an attempt.
+    Sent messages past the retention are deleted in bounded batches, so the outbox scan stays on a small table.
+    """
+    def __init__(self, publisher, session_factory, interval: float = OUTBOX_DISPATCH_INTERVAL, max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+                 backoff_base: float = OUTBOX_BACKOFF_BASE, backoff_max: float = OUTBOX_BACKOFF_MAX, retention: int = OUTBOX_RETENTION_MINUTES,
+                 purge_interval: float = OUTBOX_PURGE_INTERVAL, purge_batch_size: int = OUTBOX_PURGE_BATCH_SIZE, statsd_client=None):
+        self.publisher = publisher
+        self.session_factory = session_factory
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retention = timedelta(minutes=retention)
+        self.purge_interval = purge_interval
+        self.purge_batch_size = max(purge_batch_size, 1)
+        self.statsd_client = statsd_client
+        self._task = None
+        self._wakeup = None
+        self._next_purge = 0
+
+    def _backoff(self, attempts: int) -> timedelta:
+        return timedelta(seconds=min(self.backoff_base ** attempts, self.backoff_max))
+
+    async def dispatch_once(self, batch_size: int = SNS_BATCH_SIZE) -> int:
+        """
+        Publishes one batch of due messages, returns the number of messages picked up
+        """
+        now = datetime.now(timezone.utc)
+        async with self.session_factory() as db:
+            # skip locked rows so several workers can drain the same outbox
+            result = await db.execute(
+                select(OutboxMessage)
+                .where(OutboxMessage.status == "pending", OutboxMessage.next_attempt_at <= now)
+                .order_by(OutboxMessage.created_at)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            messages = result.scalars().all()
+            if not messages:
+                await db.commit()
+                return 0
+
+            batches = {}
+            for message in messages:
+                batches.setdefault(message.topic_arn, []).append(message)
+
+            for topic_arn, batch in batches.items():
+                start_time = time.perf_counter()
+                try:
+                    # boto3 is blocking, keep it off the event loop
+                    failed = await asyncio.to_thread(self.publisher.publish_batch, topic_arn, [(message.id, message.payload) for message in batch])
+                except CircuitOpenError as e:
+                    # SNS is down, the rest of the messages wait for the circuit to close
+                    logger.info(f"Outbox dispatch paused, SNS circuit open for {e.retry_after:.1f}s...")
+                    await db.commit()
+                    return 0
+                except Exception as e:
+                    logger.error(f"Failed to publish the outbox batch to SNS: {e}")
+                    failed = {message.id: str(e) for message in batch}
+                if self.statsd_client: self.statsd_client.timing('aws.sns.publish_batch.time', (time.perf_counter() - start_time) * 1000)
+
+                for message in batch:
+                    message.attempts += 1
+                    if message.id not in failed:
+                        message.status = "sent"
+                        message.sent_at = now
+                        message.last_error = None
+                    else:
+                        message.last_error = str(failed[message.id])[:255]
+                        if message.attempts >= self.max_attempts:
+                            message.status = "failed"
+                            logger.error(f"Outbox message {message.id} failed after {message.attempts} attempts: {message.last_error}")
+                        else:
+                            message.next_attempt_at = now + self._backoff(message.attempts)
+
+                if self.statsd_client:
+                    self.statsd_client.incr('outbox.sent', len(batch) - len(failed))
+                    if failed: self.statsd_client.incr('outbox.failed', len(failed))
+
+            await db.commit()
+            return len(messages)
+
+    async def purge_once(self) -> int:
+        """
+        Deletes one batch of sent messages older than the retention, returns the number of rows deleted
+        """
+        now = datetime.now(timezone.utc)
+        async with self.session_factory() as db:
+            # skip locked rows so the dispatchers of several workers never delete the same rows
+            result = await db.execute(
+                select(OutboxMessage.id)
+                .where(OutboxMessage.status == "sent", OutboxMessage.sent_at < now - self.retention)
+                .limit(self.purge_batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            ids = result.scalars().all()
+            if ids:
+                await db.execute(delete(OutboxMessage).where(OutboxMessage.id.in_(ids)))
+            await db.commit()
+
+        if ids and self.statsd_client: self.statsd_client.incr('outbox.purged', len(ids))
+        return len(ids)
+
+    async def purge(self) -> int:
+        """
+        Deletes batches until no sent messages past the retention are left, returns the total
+        """
+        total = 0
+        while True:
+            purged = await self.purge_once()
+            total += purged
+            if purged < self.purge_batch_size:
+                break
+            # let the request traffic in between the batches
+            await asyncio.sleep(0)
+        if total:
+            logger.info(f"Outbox dispatcher: purged {total} sent messages")
+        return total
+
+    def wake(self):
+        """
+        Starts the next dispatch right away instead of waiting for the interval
+        """
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                # keep draining while full batches come back
+                while await self.dispatch_once() == SNS_BATCH_SIZE:
+                    pass
+            except CircuitOpenError as e:
+                logger.info(f"Outbox dispatcher paused, {e.name} circuit open...")
+            except Exception as e:
+                logger.error(f"Outbox dispatcher error... {e}")
+            if time.monotonic() >= self._next_purge:
+                self._next_purge = time.monotonic() + self.purge_interval
+                try:
+                    await self.purge()
+                except CircuitOpenError as e:
+                    logger.info(f"Outbox purge paused, {e.name} circuit open...")
+                except Exception as e:
+                    logger.error(f"Outbox purge error... {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._wakeup = None
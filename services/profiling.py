@@ -0,0 +1,163 @@
+from contextvars import ContextVar
+from sqlalchemy import event
+import logging
+import os
+import re
+import threading
+import time
+
+# setting up the logger
+logger = logging.getLogger(__name__)
+
+# query profiler settings, off by default
+QUERY_PROFILER_ENABLED = os.getenv("APP_QUERY_PROFILER_ENABLED", "false").lower() == "true"
+SLOW_QUERY_THRESHOLD = float(os.getenv("APP_SLOW_QUERY_THRESHOLD_MS", 100))
+# the same statement this many times in one request is reported as an N+1
+N_PLUS_ONE_THRESHOLD = int(os.getenv("APP_N_PLUS_ONE_THRESHOLD", 5))
+QUERY_DEBUG_ENDPOINT_ENABLED = os.getenv("APP_QUERY_DEBUG_ENDPOINT_ENABLED", "false").lower() == "true"
+
+# statements of the current request, None outside of a profiled request
+_current_profile = ContextVar("query_profile", default=None)
+
+_WHITESPACE = re.compile(r"\s+")
+_STRING_LITERAL = re.compile(r"'(?:[^'\\]|\\.)*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LIST = re.compile(r"\(\s*(?:\?|%s|%\(\w+\)s)(?:\s*,\s*(?:\?|%s|%\(\w+\)s))+\s*\)")
+
+
+"""
+Function: normalize_statement
+Descr: Collapses whitespace, literals and IN lists so the same query always normalizes to the same text
+params: statement: str
+"""
+def normalize_statement(statement: str) -> str:
+    statement = _STRING_LITERAL.sub("?", statement)
+    statement = _NUMBER_LITERAL.sub("?", statement)
+    statement = _PLACEHOLDER_LIST.sub("(?)", statement)
+    return _WHITESPACE.sub(" ", statement).strip()
+
+
+class RequestProfile:
+    """
+    Statements run during one request
+    """
+    __slots__ = ("statements", "db_time", "rows", "counts")
+
+    def __init__(self):
+        self.statements = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.counts = {}
+
+
+class QueryProfiler:
+    """
+    Opt-in statement profiler hooked on the engine cursor events.
+    Keeps per route statement counts, database time and rows returned, logs the slow statements
+    and flags the statements repeated within one request.
+    """
+    def __init__(self, enabled: bool = QUERY_PROFILER_ENABLED, slow_query_threshold: float = SLOW_QUERY_THRESHOLD,
+                 n_plus_one_threshold: int = N_PLUS_ONE_THRESHOLD, statsd_client=None):
+        self.enabled = enabled
+        self.slow_query_threshold = slow_query_threshold
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.statsd_client = statsd_client
+        self.routes = {}
+        self._engines = []
+        self._lock = threading.Lock()
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if _current_profile.get() is not None:
+            conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        profile = _current_profile.get()
+        if profile is None:
+            return
+        start_times = conn.info.get("query_start_time")
+        if not start_times:
+            return
+        duration = (time.perf_counter() - start_times.pop()) * 1000
+
+        normalized = normalize_statement(statement)
+        profile.statements += 1
+        profile.db_time += duration
+        # rowcount is -1 when the driver does not know it
+        profile.rows += max(cursor.rowcount or 0, 0)
+        profile.counts[normalized] = profile.counts.get(normalized, 0) + 1
+
+        if duration >= self.slow_query_threshold:
+            logger.info(f"Slow query ({duration:.1f} ms): {normalized}")
+            if self.statsd_client: self.statsd_client.incr('db.slow_query')
+
+    def attach(self, engine):
+        """
+        Starts listening on the cursor events of a sync engine, pass async_engine.sync_engine for the async one
+        """
+        if not self.enabled or engine in self._engines:
+            return
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+        self._engines.append(engine)
+
+    def detach(self):
+        for engine in self._engines:
+            event.remove(engine, "before_cursor_execute", self._before_cursor_execute)
+            event.remove(engine, "after_cursor_execute", self._after_cursor_execute)
+        self._engines = []
+
+    def start_request(self):
+        """
+        Starts collecting the statements of a request, returns None when the profiler is off
+        """
+        if not self.enabled:
+            return None
+        profile = RequestProfile()
+        _current_profile.set(profile)
+        return profile
+
+    def finish_request(self, profile: RequestProfile, route: str, method: str):
+        key = f"{method} {route}"
+        repeated = {statement: count for statement, count in profile.counts.items() if count >= self.n_plus_one_threshold}
+        for statement, count in repeated.items():
+            logger.info(f"Possible N+1 on {key}: {count}x {statement}")
+
+        with self._lock:
+            stats = self.routes.get(key)
+            if stats is None:
+                stats = self.routes[key] = {"requests": 0, "statements": 0, "db_time_ms": 0.0, "rows": 0, "max_statements": 0, "n_plus_one": {}}
+            stats["requests"] += 1
+            stats["statements"] += profile.statements
+            stats["db_time_ms"] += profile.db_time
+            stats["rows"] += profile.rows
+            stats["max_statements"] = max(stats["max_statements"], profile.statements)
+            for statement, count in repeated.items():
+                stats["n_plus_one"][statement] = max(stats["n_plus_one"].get(statement, 0), count)
+
+        if self.statsd_client:
+            tags = {"route": key}
+            self.statsd_client.incr('db.request.statements', profile.statements, tags=tags)
+            self.statsd_client.timing('db.request.time', profile.db_time, tags=tags)
+            self.statsd_client.incr('db.request.rows', profile.rows, tags=tags)
+            if repeated: self.statsd_client.incr('db.n_plus_one', tags=tags)
+
+    def snapshot(self) -> dict:
+        """
+        Returns the per route totals with the averages per request
+        """
+        with self._lock:
+            routes = {}
+            for key, stats in self.routes.items():
+                requests = stats["requests"] or 1
+                routes[key] = {
+                    **stats,
+                    "db_time_ms": round(stats["db_time_ms"], 3),
+                    "n_plus_one": dict(stats["n_plus_one"]),
+                    "avg_statements": round(stats["statements"] / requests, 2),
+                    "avg_db_time_ms": round(stats["db_time_ms"] / requests, 3)
+                }
+        return {"enabled": self.enabled, "slow_query_threshold_ms": self.slow_query_threshold, "routes": routes}
+
+    def reset(self):
+        with self._lock:
+            self.routes = {}
@@ -0,0 +1,149 @@
+from sqlalchemy import select, update, insert, and_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from models.user import User, Image, Verification
+from models.outbox import OutboxMessage
+from datetime import datetime
+
+
+'''
+Async versions of the user, image and verification queries used by the API handlers
+'''
+
+"""
+Function: get_user_by_email
+Descr: Returns the user with the given email, None if it does not exist
+params: db: AsyncSession, email: str
+"""
+async def get_user_by_email(db: AsyncSession, email: str):
+    result = await db.execute(select(User).where(User.email == email))
+    return result.scalars().first()
+
+"""
+Function: add_user
+Descr: Saves a new user in the database and refreshes the server generated columns
+params: db: AsyncSession, user: User
+"""
+async def add_user(db: AsyncSession, user: User):
+    db.add(user)
+    await db.commit()
+    await db.refresh(user)
+    return user
+
+"""
+Function: add_user_with_verification
+Descr: Saves a new user, its verification record and the verification email outbox entry in one transaction
+params: db: AsyncSession, user: User, verification: Verification, outbox_message: OutboxMessage or None
+"""
+async def add_user_with_verification(db: AsyncSession, user: User, verification: Verification, outbox_message: OutboxMessage = None):
+    db.add_all([user, verification] if outbox_message is None else [user, verification, outbox_message])
+    await db.commit()
+    await db.refresh(user)
+    return user
+
+"""
+Function: get_existing_emails
+Descr: Returns the lowercased emails of the list which already belong to a user, in a single IN query
+params: db: AsyncSession, emails: list
+"""
+async def get_existing_emails(db: AsyncSession, emails: list) -> set:
+    if not emails:
+        return set()
+    # the MySQL collation already compares case-insensitively, a lower() here would skip the email index
+    result = await db.execute(select(User.email).where(User.email.in_(emails)))
+    return {email.lower() for email in result.scalars().all()}
+
+"""
+Function: bulk_add_users_with_verifications
+Descr: Inserts users, their verification records and the verification email outbox entries with one executemany per table,
+       all in one transaction
+params: db: AsyncSession, users: list of dict, verifications: list of dict, outbox_messages: list of dict
+"""
+async def bulk_add_users_with_verifications(db: AsyncSession, users: list, verifications: list, outbox_messages: list):
+    await db.execute(insert(User), users)
+    await db.execute(insert(Verification), verifications)
+    if outbox_messages:
+        await db.execute(insert(OutboxMessage), outbox_messages)
+    await db.commit()
+
+"""
+Function: update_user_by_id
+Descr: Updates the given columns of the user in a single UPDATE, returns the number of rows matched
+params: db: AsyncSession, user_id: str, values: dict
+"""
+async def update_user_by_id(db: AsyncSession, user_id: str, values: dict) -> int:
+    result = await db.execute(update(User).where(User.id == user_id).values(**values))
+    await db.commit()
+    return result.rowcount
+
+"""
+Function: get_image_by_user_id
+Descr: Returns the profile image of the user, None if it does not exist
+params: db: AsyncSession, user_id: str
+"""
+async def get_image_by_user_id(db: AsyncSession, user_id: str):
+    result = await db.execute(select(Image).where(Image.user_id == user_id))
+    return result.scalars().first()
+
+"""
+Function: get_image_with_variants_by_user_id
+Descr: Returns the profile image of the user with its variants loaded, None if it does not exist
+params: db: AsyncSession, user_id: str
+"""
+async def get_image_with_variants_by_user_id(db: AsyncSession, user_id: str):
+    result = await db.execute(select(Image).where(Image.user_id == user_id).options(selectinload(Image.variants)))
+    return result.scalars().first()
+
+"""
+Function: add_image
+Descr: Saves the image metadata in the database
+params: db: AsyncSession, image: Image
+"""
+async def add_image(db: AsyncSession, image: Image):
+    db.add(image)
+    await db.commit()
+    await db.refresh(image)
+    return image
+
+"""
+Function: delete_image
+Descr: Deletes the image metadata from the database
+params: db: AsyncSession, image: Image
+"""
+async def delete_image(db: AsyncSession, image: Image):
+    await db.delete(image)
+    await db.commit()
+
+"""
+Function: verify_user_by_token
+Descr: Marks the verification link as used and the user as verified in one UPDATE, if the token exists and has not expired.
+       Concurrent clicks on the same link both succeed, the statement is idempotent.
+       Returns True if the token was valid, False for an unknown or expired token
+params: db: AsyncSession, token: str, now: datetime in UTC
+"""
+async def verify_user_by_token(db: AsyncSession, token: str, now: datetime) -> bool:
+    valid_token = and_(Verification.token == token, Verification.expiration_time > now)
+
+    if db.get_bind().dialect.name == "mysql":
+        # UPDATE users JOIN verifications ... SET users.is_verified, verifications.link_verified
+        result = await db.execute(
+            update(User)
+            .where(User.email == Verification.email, valid_token)
+            .values({User.is_verified: True, Verification.link_verified: True})
+        )
+    else:
+        # multiple table updates are MySQL only, two statements in the same transaction elsewhere
+        result = await db.execute(update(Verification).where(valid_token).values(link_verified=True))
+        if result.rowcount:
+            await db.execute(
+                update(User)
+                .where(User.email == select(Verification.email).where(Verification.token == token).scalar_subquery())
+                .values(is_verified=True)
+            )
+
+    if not result.rowcount:
+        await db.rollback()
+        return False
+
+    await db.commit()
+    return True
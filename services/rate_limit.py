@@ -0,0 +1,256 @@
+from collections import OrderedDict
+import base64
+import binascii
+import logging
+import math
+import os
+import threading
+import time
+
+# setting up the logger
+logger = logging.getLogger(__name__)
+
+# rate limiter settings, rates are tokens per second and the burst is the bucket size
+RATE_LIMIT_ENABLED = os.getenv("APP_RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_IP_RATE = float(os.getenv("APP_RATE_LIMIT_IP_RATE", 20))
+RATE_LIMIT_IP_BURST = float(os.getenv("APP_RATE_LIMIT_IP_BURST", 40))
+# per route overrides of the per IP limit, "path prefix=rate:burst" separated by commas, the longest prefix wins
+RATE_LIMIT_ROUTES = os.getenv("APP_RATE_LIMIT_ROUTES", "/v2/user/self=10:20,/v2/user/verify=1:5")
+RATE_LIMIT_EXEMPT_PATHS = os.getenv("APP_RATE_LIMIT_EXEMPT_PATHS", "/healthz,/cicd_new")
+# failed Basic auth attempts per username, one more attempt every 10 seconds after a burst of 5 by default
+RATE_LIMIT_AUTH_FAILURE_RATE = float(os.getenv("APP_RATE_LIMIT_AUTH_FAILURE_RATE", 0.1))
+RATE_LIMIT_AUTH_FAILURE_BURST = float(os.getenv("APP_RATE_LIMIT_AUTH_FAILURE_BURST", 5))
+# buckets kept in memory per limiter, the least recently used ones are evicted
+RATE_LIMIT_MAX_KEYS = int(os.getenv("APP_RATE_LIMIT_MAX_KEYS", 100000))
+RATE_LIMIT_SHARDS = int(os.getenv("APP_RATE_LIMIT_SHARDS", 16))
+# behind the load balancer the client address is the last X-Forwarded-For entry, the earlier ones are client supplied
+RATE_LIMIT_TRUST_FORWARDED = os.getenv("APP_RATE_LIMIT_TRUST_FORWARDED", "false").lower() == "true"
+# emails without an account, rejected without a database lookup for this many seconds. The cache is per process and
+# a signup only clears it in the worker which handled it, so the TTL stays short
+UNKNOWN_EMAIL_CACHE_TTL = float(os.getenv("APP_UNKNOWN_EMAIL_CACHE_TTL", 5))
+
+
+"""
+Function: parse_route_rules
+Descr: Parses "prefix=rate:burst,..." into (prefix, rate, burst) tuples, longest prefix first
+params: value: str
+"""
+def parse_route_rules(value: str) -> list:
+    rules = []
+    for item in (value or "").split(","):
+        if not item.strip():
+            continue
+        prefix, _, limit = item.partition("=")
+        rate, _, burst = limit.partition(":")
+        rules.append((prefix.strip(), float(rate), float(burst or rate)))
+    return sorted(rules, key=lambda rule: len(rule[0]), reverse=True)
+
+"""
+Function: basic_auth_username
+Descr: Returns the lowercased username of a Basic Authorization header, None when there is none
+params: authorization: str
+"""
+def basic_auth_username(authorization: str):
+    if not authorization or authorization[:6].lower() != "basic ":
+        return None
+    try:
+        username, _, _ = base64.b64decode(authorization[6:]).decode("utf-8").partition(":")
+    except (binascii.Error, UnicodeDecodeError):
+        return None
+    return username.strip().lower() or None
+
+
+class TokenBuckets:
+    """
+    Token buckets keyed by string, spread over shards with their own lock and LRU order.
+    Buckets are [tokens, last refill time], an evicted bucket comes back full.
+    """
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS, shards: int = RATE_LIMIT_SHARDS, clock=time.monotonic):
+        self.shards = max(shards, 1)
+        self.max_keys_per_shard = max(max_keys // self.shards, 1)
+        self.clock = clock
+        self._buckets = [OrderedDict() for _ in range(self.shards)]
+        self._locks = [threading.Lock() for _ in range(self.shards)]
+
+    def _refill(self, buckets: OrderedDict, key: str, rate: float, burst: float, now: float) -> list:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = [burst, now]
+            if len(buckets) > self.max_keys_per_shard:
+                buckets.popitem(last=False)
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            buckets.move_to_end(key)
+        return bucket
+
+    def take(self, key: str, rate: float, burst: float, cost: float = 1) -> float:
+        """
+        Takes the tokens, returns 0 when allowed, otherwise the seconds until enough tokens are back
+        """
+        shard = hash(key) % self.shards
+        with self._locks[shard]:
+            bucket = self._refill(self._buckets[shard], key, rate, burst, self.clock())
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                return 0
+            return (cost - bucket[0]) / rate if rate > 0 else math.inf
+
+    def check(self, key: str, rate: float, burst: float, cost: float = 1) -> float:
+        """
+        Same as take without taking the tokens
+        """
+        shard = hash(key) % self.shards
+        with self._locks[shard]:
+            bucket = self._buckets[shard].get(key)
+            if bucket is None:
+                return 0
+            tokens = min(burst, bucket[0] + (self.clock() - bucket[1]) * rate)
+            if tokens >= cost:
+                return 0
+            return (cost - tokens) / rate if rate > 0 else math.inf
+
+    def clear(self):
+        for shard, lock in enumerate(self._locks):
+            with lock:
+                self._buckets[shard].clear()
+
+    def __len__(self) -> int:
+        return sum(len(buckets) for buckets in self._buckets)
+
+
+class NegativeCache:
+    """
+    Short lived set of keys known not to exist, bounded with LRU eviction.
+    """
+    def __init__(self, ttl: float = UNKNOWN_EMAIL_CACHE_TTL, max_size: int = RATE_LIMIT_MAX_KEYS, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: str) -> bool:
+        if self.ttl <= 0:
+            return False
+        with self._lock:
+            expires_at = self._entries.get(key)
+            if expires_at is None:
+                return False
+            if expires_at <= self.clock():
+                del self._entries[key]
+                return False
+            return True
+
+    def add(self, key: str):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = self.clock() + self.ttl
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class AdmissionController:
+    """
+    Per IP token buckets with per route limits, per username buckets drained by failed Basic auth attempts
+    and the negative cache of unknown emails, checked before a request reaches the database or bcrypt.
+    """
+    def __init__(self, enabled: bool = RATE_LIMIT_ENABLED, ip_rate: float = RATE_LIMIT_IP_RATE, ip_burst: float = RATE_LIMIT_IP_BURST,
+                 routes: str = RATE_LIMIT_ROUTES, exempt_paths: str = RATE_LIMIT_EXEMPT_PATHS,
+                 auth_failure_rate: float = RATE_LIMIT_AUTH_FAILURE_RATE, auth_failure_burst: float = RATE_LIMIT_AUTH_FAILURE_BURST,
+                 max_keys: int = RATE_LIMIT_MAX_KEYS, shards: int = RATE_LIMIT_SHARDS, trust_forwarded: bool = RATE_LIMIT_TRUST_FORWARDED,
+                 unknown_email_ttl: float = UNKNOWN_EMAIL_CACHE_TTL, statsd_client=None, clock=time.monotonic):
+        self.enabled = enabled
+        self.default_rule = ("", ip_rate, ip_burst)
+        self.route_rules = parse_route_rules(routes)
+        self.exempt_paths = frozenset(path.strip() for path in exempt_paths.split(",") if path.strip())
+        self.auth_failure_rate = auth_failure_rate
+        self.auth_failure_burst = auth_failure_burst
+        self.trust_forwarded = trust_forwarded
+        self.statsd_client = statsd_client
+        self.ip_buckets = TokenBuckets(max_keys, shards, clock)
+        self.auth_failure_buckets = TokenBuckets(max_keys, shards, clock)
+        self.unknown_emails = NegativeCache(unknown_email_ttl, max_keys, clock)
+
+    def rule_for(self, path: str):
+        """
+        Returns the (prefix, rate, burst) limiting the path, None for the exempt paths
+        """
+        if path in self.exempt_paths:
+            return None
+        for rule in self.route_rules:
+            if path.startswith(rule[0]):
+                return rule
+        return self.default_rule
+
+    def client_ip(self, scope: dict) -> str:
+        if self.trust_forwarded:
+            for name, value in scope["headers"]:
+                if name == b"x-forwarded-for":
+                    return value.decode("latin-1").rsplit(",", 1)[-1].strip()
+        client = scope.get("client")
+        return client[0] if client else "unknown"
+
+    def admit(self, scope: dict) -> tuple:
+        """
+        Returns (0, None) when the request may go on, otherwise (retry after seconds, reason)
+        """
+        if not self.enabled:
+            return 0, None
+        rule = self.rule_for(scope["path"])
+        if rule is None:
+            return 0, None
+
+        prefix, rate, burst = rule
+        retry_after = self.ip_buckets.take(f"{prefix}|{self.client_ip(scope)}", rate, burst)
+        if retry_after:
+            self._rejected("ip")
+            return retry_after, "ip"
+
+        # only the failed attempts drain the username bucket, it is checked before every attempt
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                username = basic_auth_username(value.decode("latin-1"))
+                if username:
+                    retry_after = self.auth_failure_buckets.check(username, self.auth_failure_rate, self.auth_failure_burst)
+                    if retry_after:
+                        self._rejected("auth_failures")
+                        return retry_after, "auth_failures"
+                break
+        return 0, None
+
+    def _rejected(self, reason: str):
+        if self.statsd_client: self.statsd_client.incr('ratelimit.rejected', tags={"reason": reason})
+
+    def record_auth_failure(self, username: str):
+        if self.enabled and username:
+            self.auth_failure_buckets.take(username.lower(), self.auth_failure_rate, self.auth_failure_burst)
+
+    def is_unknown_email(self, email: str) -> bool:
+        return self.enabled and email.lower() in self.unknown_emails
+
+    def remember_unknown_email(self, email: str):
+        if self.enabled:
+            self.unknown_emails.add(email.lower())
+
+    def forget_unknown_email(self, email: str):
+        """
+        Called when an account is created for the email
+        """
+        self.unknown_emails.discard(email.lower())
+
+    def stats(self) -> dict:
+        return {
+            "ip_buckets": len(self.ip_buckets),
+            "auth_failure_buckets": len(self.auth_failure_buckets)
+        }
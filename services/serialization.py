@@ -0,0 +1,59 @@
+from fastapi.responses import ORJSONResponse
+from operator import attrgetter
+from services.tracing import span
+import orjson
+
+# same datetime format as Pydantic, UTC as "Z"
+ORJSON_OPTIONS = orjson.OPT_UTC_Z
+
+# fields of UserSchema, read in one call instead of going through Pydantic validation on the way out
+USER_FIELDS = ("id", "email", "first_name", "last_name", "account_created", "account_updated")
+_user_getter = attrgetter(*USER_FIELDS)
+
+IMAGE_FIELDS = ("file_name", "id", "url", "upload_date", "user_id")
+_image_getter = attrgetter(*IMAGE_FIELDS)
+
+
+class FastJSONResponse(ORJSONResponse):
+    """
+    Default response class, orjson instead of the stdlib json encoder
+    """
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+"""
+Function: dumps
+Descr: Encodes the content with orjson, reported as the serialize span
+params: content: dict or list
+"""
+def dumps(content) -> bytes:
+    with span("serialize"):
+        return orjson.dumps(content, option=ORJSON_OPTIONS)
+
+
+"""
+Function: serialize_user
+Descr: Returns the UserSchema fields of a User or AuthenticatedUser as a dict orjson can encode directly.
+       The data was validated when it was written, so it is not validated again on every response
+params: user: User or AuthenticatedUser
+"""
+def serialize_user(user) -> dict:
+    return dict(zip(USER_FIELDS, _user_getter(user)))
+
+"""
+Function: serialize_image
+Descr: Returns the profile image metadata, with the variants when they are passed
+params: image: Image, file_name: str to return instead of the S3 key, variants: list of ImageVariant
+"""
+def serialize_image(image, file_name: str = None, variants: list = None) -> dict:
+    content = dict(zip(IMAGE_FIELDS, _image_getter(image)))
+    if file_name is not None:
+        content["file_name"] = file_name
+    if variants is not None:
+        # empty until the background pipeline has rendered the variants
+        content["variants"] = {
+            variant.name: {"url": variant.url, "width": variant.width, "height": variant.height}
+            for variant in variants
+        }
+    return content
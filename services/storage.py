@@ -0,0 +1,114 @@
+from botocore.exceptions import ClientError
+import asyncio
+import logging
+import os
+
+# setting up the logger
+logger = logging.getLogger(__name__)
+
+# upload settings, S3 needs every part but the last one to be at least 5 MiB
+UPLOAD_PART_SIZE = max(int(os.getenv("APP_UPLOAD_PART_SIZE", 5 * 1024 * 1024)), 5 * 1024 * 1024)
+UPLOAD_MAX_SIZE = int(os.getenv("APP_UPLOAD_MAX_SIZE", 10 * 1024 * 1024))
+# presigned upload URLs expire after this many seconds
+UPLOAD_URL_EXPIRES_IN = int(os.getenv("APP_UPLOAD_URL_EXPIRES_IN", 300))
+
+ALLOWED_CONTENT_TYPES = ["image/jpeg", "image/png", "image/jpg"]
+
+
+class UploadTooLargeError(Exception):
+    """
+    Raised as soon as the streamed body goes over the maximum upload size.
+    """
+    pass
+
+
+"""
+Function: stream_to_s3
+Descr: Streams the chunks into S3, holding at most one part in memory.
+       Bodies smaller than a part go out with a single put_object, bigger ones as a multipart upload
+       which is aborted if anything fails on the way.
+params: s3: S3 client, bucket_name: str, key: str, content_type: str, chunks: async iterator of bytes,
+        part_size: int, max_size: int
+return: int: number of bytes uploaded
+"""
+async def stream_to_s3(s3, bucket_name: str, key: str, content_type: str, chunks, part_size: int = UPLOAD_PART_SIZE, max_size: int = UPLOAD_MAX_SIZE) -> int:
+    buffer = bytearray()
+    total_size = 0
+    upload_id = None
+    parts = []
+
+    async def upload_part(body: bytes):
+        part_number = len(parts) + 1
+        # boto3 is blocking, keep it off the event loop
+        response = await asyncio.to_thread(
+            s3.upload_part, Bucket=bucket_name, Key=key, UploadId=upload_id, PartNumber=part_number, Body=body
+        )
+        parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+    try:
+        async for chunk in chunks:
+            total_size += len(chunk)
+            if total_size > max_size:
+                raise UploadTooLargeError(f"Upload is larger than {max_size} bytes")
+
+            buffer.extend(chunk)
+            while len(buffer) >= part_size:
+                if upload_id is None:
+                    response = await asyncio.to_thread(s3.create_multipart_upload, Bucket=bucket_name, Key=key, ContentType=content_type)
+                    upload_id = response["UploadId"]
+                body = bytes(buffer[:part_size])
+                del buffer[:part_size]
+                await upload_part(body)
+
+        if upload_id is None:
+            await asyncio.to_thread(s3.put_object, Bucket=bucket_name, Key=key, Body=bytes(buffer), ContentType=content_type)
+        else:
+            if buffer:
+                await upload_part(bytes(buffer))
+            await asyncio.to_thread(
+                s3.complete_multipart_upload, Bucket=bucket_name, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts}
+            )
+        return total_size
+
+    except BaseException:
+        if upload_id is not None:
+            logger.info(f"Aborting the multipart upload of {key}...")
+            try:
+                await asyncio.to_thread(s3.abort_multipart_upload, Bucket=bucket_name, Key=key, UploadId=upload_id)
+            except Exception as e:
+                logger.error(f"Failed to abort the multipart upload of {key}: {e}")
+        raise
+
+
+"""
+Function: create_presigned_upload
+Descr: Returns a presigned POST which lets the client upload the image straight to S3,
+       S3 itself enforces the content type and the size range
+params: s3: S3 client, bucket_name: str, key: str, content_type: str, max_size: int, expires_in: int
+return: dict: url and form fields
+"""
+def create_presigned_upload(s3, bucket_name: str, key: str, content_type: str, max_size: int = UPLOAD_MAX_SIZE, expires_in: int = UPLOAD_URL_EXPIRES_IN) -> dict:
+    return s3.generate_presigned_post(
+        Bucket=bucket_name,
+        Key=key,
+        Fields={"Content-Type": content_type},
+        Conditions=[
+            {"Content-Type": content_type},
+            ["content-length-range", 1, max_size]
+        ],
+        ExpiresIn=expires_in
+    )
+
+"""
+Function: head_uploaded_object
+Descr: Returns the content type and size of an uploaded object, None if it does not exist
+params: s3: S3 client, bucket_name: str, key: str
+"""
+def head_uploaded_object(s3, bucket_name: str, key: str):
+    try:
+        response = s3.head_object(Bucket=bucket_name, Key=key)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+    return {"content_type": response.get("ContentType"), "size": response.get("ContentLength", 0)}
@@ -0,0 +1,119 @@
+from contextvars import ContextVar
+import asyncio
+import functools
+import json
+import logging
+import os
+import random
+import time
+
+# setting up the logger, the per request breakdown goes to its own logger so it can be routed separately
+timing_logger = logging.getLogger("app.timing")
+
+# share of the requests which get a span breakdown and a timing log line, off unless the operators opt in, e.g. 0.01
+TRACE_SAMPLE_RATE = float(os.getenv("APP_TRACE_SAMPLE_RATE", 0))
+
+# spans of the current request, None when the request is not sampled
+_current_recorder = ContextVar("span_recorder", default=None)
+
+
+class SpanRecorder:
+    """
+    Collects the time spent per dependency during one request.
+    Spans with the same name are summed, so ten queries show up as one db span with a count of ten.
+    """
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.spans = {}
+
+    def add(self, name: str, duration: float):
+        span = self.spans.get(name)
+        if span is None:
+            self.spans[name] = [duration, 1]
+        else:
+            span[0] += duration
+            span[1] += 1
+
+    def elapsed(self) -> float:
+        return (time.perf_counter() - self.start_time) * 1000
+
+    def server_timing(self, total: float = None) -> str:
+        """
+        Returns the Server-Timing header value, durations in milliseconds
+        """
+        entries = [f'{name};dur={duration:.3f};desc="{count}x"' for name, (duration, count) in self.spans.items()]
+        entries.append(f"total;dur={self.elapsed() if total is None else total:.3f}")
+        return ", ".join(entries)
+
+    def to_dict(self) -> dict:
+        return {name: {"ms": round(duration, 3), "count": count} for name, (duration, count) in self.spans.items()}
+
+
+class span:
+    """
+    Times a block into the span recorder of the current request, does nothing outside of a sampled request
+    """
+    __slots__ = ("name", "_recorder", "_start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self._recorder = _current_recorder.get()
+        if self._recorder is not None:
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._recorder is not None:
+            self._recorder.add(self.name, (time.perf_counter() - self._start) * 1000)
+
+
+"""
+Function: traced
+Descr: Decorator which records every call of the function as a span, works for both the sync and the async functions
+params: name: str
+"""
+def traced(name: str):
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+"""
+Function: start_request
+Descr: Starts the span recorder of a request if it is sampled, returns None otherwise
+params: sample_rate: float
+"""
+def start_request(sample_rate: float = TRACE_SAMPLE_RATE):
+    if sample_rate <= 0 or (sample_rate < 1 and random.random() >= sample_rate):
+        return None
+    recorder = SpanRecorder()
+    _current_recorder.set(recorder)
+    return recorder
+
+"""
+Function: log_request
+Descr: Writes the span breakdown of a request as one JSON line
+params: recorder: SpanRecorder, method: str, route: str, status_code: int, total: float
+"""
+def log_request(recorder: SpanRecorder, method: str, route: str, status_code: int, total: float):
+    if timing_logger.isEnabledFor(logging.INFO):
+        timing_logger.info(json.dumps({
+            "method": method,
+            "route": route,
+            "status": status_code,
+            "duration_ms": round(total, 3),
+            "spans": recorder.to_dict()
+        }))
+
@@ -0,0 +1,155 @@
+from sqlalchemy import select, insert, delete
+from models.user import Verification, VerificationArchive
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+import asyncio
+import json
+import logging
+import os
+import uuid
+
+# setting up the logger
+logger = logging.getLogger(__name__)
+
+# verification links expire after this many minutes
+VERIFICATION_EXPIRY_MINUTES = int(os.getenv("APP_VERIFICATION_EXPIRY_MINUTES", 3))
+
+# verification sweeper settings, rows are archived once they expired this long ago
+VERIFICATION_SWEEPER_ENABLED = os.getenv("APP_VERIFICATION_SWEEPER_ENABLED", "true").lower() == "true"
+VERIFICATION_SWEEP_INTERVAL = float(os.getenv("APP_VERIFICATION_SWEEP_INTERVAL", 300))
+VERIFICATION_ARCHIVE_BATCH_SIZE = int(os.getenv("APP_VERIFICATION_ARCHIVE_BATCH_SIZE", 500))
+VERIFICATION_ARCHIVE_AFTER_MINUTES = int(os.getenv("APP_VERIFICATION_ARCHIVE_AFTER_MINUTES", 60))
+
+# the expiration time shown in the email
+EMAIL_TIMEZONE = ZoneInfo("America/New_York")
+
+# topic of the verification emails, read once, without it no verification email is queued
+SNS_TOPIC_ARN = os.getenv("APP_SNS_TOPIC_ARN")
+if not SNS_TOPIC_ARN:
+    logger.warning("APP_SNS_TOPIC_ARN is not set, the verification emails will not be sent")
+
+
+"""
+Function: build_verification
+Descr: Returns the column values of the verification record and of the verification email outbox entry of a new user,
+       shared by the signup endpoint and the bulk import
+params: email: str, first_name: str, last_name: str
+return: tuple: (verification values, outbox message values or None without a topic)
+"""
+def build_verification(email: str, first_name: str, last_name: str) -> tuple:
+    token = str(uuid.uuid4())
+    # stored in UTC, the column drops the offset and is compared against UTC
+    expiration_time = datetime.now(timezone.utc) + timedelta(minutes=VERIFICATION_EXPIRY_MINUTES)
+    verification_link = f"{os.getenv('APP_API_ENDPOINT')}/v2/user/verify?token={token}"
+
+    verification = {
+        "id": str(uuid.uuid4()),
+        "email": email,
+        "verification_link": verification_link,
+        "token": token,
+        "expiration_time": expiration_time
+    }
+
+    message = {
+        "username": f"{first_name} {last_name}",
+        "email": email,
+        "verification_link": verification_link,
+        "expiration_time": str(expiration_time.astimezone(EMAIL_TIMEZONE)),
+        "token": token
+    }
+
+    if not SNS_TOPIC_ARN:
+        return verification, None
+
+    # the verification email is published by the outbox dispatcher, not in the request
+    outbox_message = {
+        "id": str(uuid.uuid4()),
+        "topic_arn": SNS_TOPIC_ARN,
+        "payload": json.dumps(message)
+    }
+
+    return verification, outbox_message
+
+
+class VerificationSweeper:
+    """
+    Moves expired verifications to verifications_archive in bounded batches, so the token lookups
+    stay on a small table while the history is kept.
+    """
+    def __init__(self, session_factory, interval: float = VERIFICATION_SWEEP_INTERVAL, batch_size: int = VERIFICATION_ARCHIVE_BATCH_SIZE,
+                 archive_after: int = VERIFICATION_ARCHIVE_AFTER_MINUTES, statsd_client=None):
+        self.session_factory = session_factory
+        self.interval = interval
+        self.batch_size = max(batch_size, 1)
+        self.archive_after = timedelta(minutes=archive_after)
+        self.statsd_client = statsd_client
+        self._task = None
+
+    async def sweep_once(self) -> int:
+        """
+        Archives one batch, returns the number of rows moved
+        """
+        now = datetime.now(timezone.utc)
+        async with self.session_factory() as db:
+            # skip locked rows so the sweepers of several workers never move the same rows
+            result = await db.execute(
+                select(Verification.id)
+                .where(Verification.expiration_time < now - self.archive_after)
+                .order_by(Verification.expiration_time)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            ids = result.scalars().all()
+            if not ids:
+                await db.commit()
+                return 0
+
+            # INSERT ... SELECT and DELETE in one transaction, archived_at comes from the server default
+            columns = ("id", "email", "verification_link", "token", "expiration_time", "created_at", "link_verified")
+            await db.execute(
+                insert(VerificationArchive).from_select(
+                    columns,
+                    select(*(getattr(Verification, column) for column in columns)).where(Verification.id.in_(ids))
+                )
+            )
+            await db.execute(delete(Verification).where(Verification.id.in_(ids)))
+            await db.commit()
+
+        if self.statsd_client: self.statsd_client.incr('verification.archived', len(ids))
+        return len(ids)
+
+    async def sweep(self) -> int:
+        """
+        Archives batches until no expired rows are left, returns the total
+        """
+        total = 0
+        while True:
+            archived = await self.sweep_once()
+            total += archived
+            if archived < self.batch_size:
+                break
+            # let the request traffic in between the batches
+            await asyncio.sleep(0)
+        if total:
+            logger.info(f"Verification sweeper: archived {total} rows")
+        return total
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Verification sweeper error... {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
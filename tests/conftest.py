@@ -1,9 +1,26 @@
+import os
+
+# the tests drain the outbox themselves with a fake publisher
+os.environ.setdefault("APP_OUTBOX_DISPATCHER_ENABLED", "false")
+# the image variants are rendered explicitly in the tests
+os.environ.setdefault("APP_IMAGE_PIPELINE_ENABLED", "false")
+# the tests run the verification sweeper themselves
+os.environ.setdefault("APP_VERIFICATION_SWEEPER_ENABLED", "false")
+# all the requests come from the same client, the rate limit tests enable it themselves
+os.environ.setdefault("APP_RATE_LIMIT_ENABLED", "false")
+# topic of the verification emails, only published to through the fake publisher
+os.environ.setdefault("APP_SNS_TOPIC_ARN", "arn:aws:sns:us-east-1:000000000000:test")
+# every request gets a span breakdown, the Server-Timing tests read it
+os.environ.setdefault("APP_TRACE_SAMPLE_RATE", "1")
+
 import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy_utils import database_exists, create_database
-from app import app, get_database_session
+from app import app, get_database_session, get_async_database_session
 from models.user import Base
 from database import get_engine
 import os 
@@ -20,12 +37,17 @@ TEST_DATABASE = os.getenv("TEST_MYSQL_DATABASE")
 
 # Setup test database
 TEST_DB_URL = f"mysql+pymysql://{TEST_USER}:{TEST_PASSWORD}@{TEST_HOST}:{TEST_PORT}/{TEST_DATABASE}"
+TEST_ASYNC_DB_URL = f"mysql+aiomysql://{TEST_USER}:{TEST_PASSWORD}@{TEST_HOST}:{TEST_PORT}/{TEST_DATABASE}"
 
 engine = create_engine(TEST_DB_URL)
 if not database_exists(engine.url):
     create_database(engine.url)
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# the TestClient runs each test on a new event loop, so the async connections are not pooled
+async_engine = create_async_engine(TEST_ASYNC_DB_URL, poolclass=NullPool)
+TestingAsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
 # fixture for db creation
 @pytest.fixture(scope="function")
 def test_db():
@@ -53,7 +75,12 @@ def client(db_session):
         finally:
             db_session.close()
 
+    async def override_get_async_db():
+        async with TestingAsyncSessionLocal() as async_session:
+            yield async_session
+
     app.dependency_overrides[get_database_session] = override_get_db
+    app.dependency_overrides[get_async_database_session] = override_get_async_db
     with TestClient(app) as test_client:
         yield test_client
     app.dependency_overrides.clear()
\ No newline at end of file
@@ -0,0 +1,81 @@
+"""
+In-memory stand-ins for the AWS clients, used by the tests and the benchmark server
+"""
+from botocore.exceptions import ClientError
+import io
+
+
+class FakeS3Client:
+    """
+    Stand-in for the S3 client, keeps the objects and multipart uploads in memory.
+    """
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.aborted = []
+        self._next_upload_id = 0
+
+    def put_object(self, Bucket, Key, Body, ContentType=None, **kwargs):
+        self.objects[(Bucket, Key)] = {"Body": bytes(Body), "ContentType": ContentType}
+        return {"ETag": f'"{len(self.objects)}"'}
+
+    def create_multipart_upload(self, Bucket, Key, ContentType=None, **kwargs):
+        self._next_upload_id += 1
+        upload_id = str(self._next_upload_id)
+        self.uploads[upload_id] = {"Bucket": Bucket, "Key": Key, "ContentType": ContentType, "Parts": {}}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self.uploads[UploadId]["Parts"][PartNumber] = bytes(Body)
+        return {"ETag": f'"{UploadId}-{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        upload = self.uploads.pop(UploadId)
+        body = b"".join(upload["Parts"][part["PartNumber"]] for part in MultipartUpload["Parts"])
+        self.objects[(Bucket, Key)] = {"Body": body, "ContentType": upload["ContentType"]}
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self.uploads.pop(UploadId, None)
+        self.aborted.append(UploadId)
+        return {}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        stored = self.objects.get((Bucket, Key))
+        if stored is None:
+            raise ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+        return {"ContentType": stored["ContentType"], "ContentLength": len(stored["Body"])}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        stored = self.objects.get((Bucket, Key))
+        if stored is None:
+            raise ClientError({"Error": {"Code": "NoSuchKey", "Message": "Not Found"}}, "GetObject")
+        return {"Body": io.BytesIO(stored["Body"]), "ContentType": stored["ContentType"], "ContentLength": len(stored["Body"])}
+
+    def generate_presigned_post(self, Bucket, Key, Fields=None, Conditions=None, ExpiresIn=3600):
+        return {"url": f"https://{Bucket}.s3.amazonaws.com/", "fields": {**(Fields or {}), "key": Key}, "conditions": Conditions}
+
+
+class FakePublisher:
+    """
+    Stand-in for SnsPublisher, keeps the published messages in memory.
+    """
+    def __init__(self, fail_ids: set = None):
+        self.published = []
+        self.calls = 0
+        self.fail_ids = fail_ids or set()
+
+    def publish_batch(self, topic_arn: str, messages: list) -> dict:
+        self.calls += 1
+        failed = {}
+        for message_id, body in messages:
+            if message_id in self.fail_ids:
+                failed[message_id] = "failed"
+            else:
+                self.published.append((topic_arn, message_id, body))
+        return failed
+
@@ -161,4 +161,1382 @@ def test_password_hashing(client, db_session):
     client.post("/v2/user", json=user_data)
 
     user = db_session.query(User).filter(User.email == "hash@example.com").first()
-    assert bcrypt.checkpw("testpassword".encode('utf-8'), user.password.encode('utf-8'))
\ No newline at end of file
+    assert bcrypt.checkpw("testpassword".encode('utf-8'), user.password.encode('utf-8'))
+
+"""
+Database engine / connection pool unit tests
+"""
+def test_engine_is_shared_per_process():
+    from database import get_engine
+    assert get_engine() is get_engine()
+
+def test_pool_stats(client):
+    from database import get_pool_stats
+    client.get("/healthz")
+    stats = get_pool_stats()
+    assert stats["checkouts"] >= 1
+    assert stats["checked_out"] == 0
+    for key in ("size", "checked_in", "overflow", "wait_time_total", "wait_time_avg", "wait_time_max"):
+        assert key in stats
+
+"""
+Async database layer unit tests
+"""
+def test_async_user_query(client):
+    import asyncio
+    from services import queries
+    from tests.conftest import TestingAsyncSessionLocal
+
+    user_data = {
+        "email": "async@example.com",
+        "password": "testpassword",
+        "first_name": "Async",
+        "last_name": "User"
+    }
+    client.post("/v2/user", json=user_data)
+
+    async def get_user():
+        async with TestingAsyncSessionLocal() as db:
+            return await queries.get_user_by_email(db, "async@example.com")
+
+    user = asyncio.run(get_user())
+    assert user is not None
+    assert user.first_name == "Async"
+
+"""
+Password hashing pool unit tests
+"""
+def test_password_hasher_round_trip():
+    import asyncio
+    from services.hashing import PasswordHasher
+
+    hasher = PasswordHasher(pool_size=1, queue_size=0)
+
+    async def round_trip():
+        hashed_password = await hasher.hash_password("testpassword")
+        return hashed_password, await hasher.check_password("testpassword", hashed_password), await hasher.check_password("wrong", hashed_password)
+
+    try:
+        hashed_password, matched, not_matched = asyncio.run(round_trip())
+    finally:
+        hasher.shutdown()
+
+    assert bcrypt.checkpw("testpassword".encode('utf-8'), hashed_password.encode('utf-8'))
+    assert matched
+    assert not not_matched
+
+def test_password_hasher_queue_full():
+    import asyncio
+    from services.hashing import PasswordHasher, HashingQueueFullError
+
+    hasher = PasswordHasher(pool_size=1, queue_size=0)
+
+    async def hash_concurrently():
+        return await asyncio.gather(hasher.hash_password("first"), hasher.hash_password("second"), return_exceptions=True)
+
+    try:
+        results = asyncio.run(hash_concurrently())
+    finally:
+        hasher.shutdown()
+
+    assert isinstance(results[0], str)
+    assert isinstance(results[1], HashingQueueFullError)
+
+"""
+Credential cache unit tests
+"""
+def verify_user(email):
+    from sqlalchemy import update
+    from tests.conftest import engine
+
+    with engine.begin() as connection:
+        connection.execute(update(User).where(User.email == email).values(is_verified=True))
+
+def test_credential_cache():
+    from services.auth_cache import CredentialCache
+
+    cache = CredentialCache(max_size=2, ttl=60, secret="test-secret")
+    cache.set("first@example.com", "testpassword", "first@example.com")
+
+    assert cache.get("first@example.com", "testpassword") == "first@example.com"
+    assert cache.get("first@example.com", "wrongpassword") is None
+    assert all("testpassword" not in str(entry) for entry in cache._entries.values())
+
+    cache.set("second@example.com", "testpassword", "second@example.com")
+    cache.set("third@example.com", "testpassword", "third@example.com")
+    assert cache.get("first@example.com", "testpassword") is None
+
+    cache.invalidate("second@example.com")
+    assert cache.get("second@example.com", "testpassword") is None
+    assert cache.stats()["hits"] == 1
+
+def test_credential_cache_expiry():
+    from services.auth_cache import CredentialCache
+
+    cache = CredentialCache(max_size=10, ttl=0)
+    cache.set("expired@example.com", "testpassword", "expired@example.com")
+    assert cache.get("expired@example.com", "testpassword") is None
+
+def test_credential_cache_invalidated_on_password_update(client):
+    from app import credential_cache
+
+    user_data = {
+        "email": "cache@example.com",
+        "password": "testpassword",
+        "first_name": "Cache",
+        "last_name": "User"
+    }
+    client.post("/v2/user", json=user_data)
+    verify_user("cache@example.com")
+
+    response = client.get("/v2/user/self", auth=("cache@example.com", "testpassword"))
+    assert response.status_code == status.HTTP_200_OK
+    assert credential_cache.get("cache@example.com", "testpassword").email == "cache@example.com"
+
+    update_data = {
+        "email": "cache@example.com",
+        "password": "newpassword"
+    }
+    response = client.put("/v2/user/self", json=update_data, auth=("cache@example.com", "testpassword"))
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+
+    response = client.get("/v2/user/self", auth=("cache@example.com", "testpassword"))
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+"""
+SQL statements per route unit tests
+"""
+@pytest.fixture(scope="function")
+def statement_counter():
+    from sqlalchemy import event
+    from tests.conftest import async_engine
+
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", count_statement)
+    yield statements
+    event.remove(async_engine.sync_engine, "before_cursor_execute", count_statement)
+
+def test_statements_per_authenticated_route(client, statement_counter):
+    from app import credential_cache
+
+    user_data = {
+        "email": "statements@example.com",
+        "password": "testpassword",
+        "first_name": "Statements",
+        "last_name": "User"
+    }
+    client.post("/v2/user", json=user_data)
+    verify_user("statements@example.com")
+    credential_cache.invalidate("statements@example.com")
+    auth = ("statements@example.com", "testpassword")
+
+    # first request: a single user lookup inside authenticate, the handler reuses it
+    statement_counter.clear()
+    response = client.get("/v2/user/self", auth=auth)
+    assert response.status_code == status.HTTP_200_OK
+    assert len(statement_counter) == 1
+
+    # repeat request: authenticated from the credential cache
+    statement_counter.clear()
+    response = client.get("/v2/user/self", auth=auth)
+    assert response.status_code == status.HTTP_200_OK
+    assert len(statement_counter) == 0
+
+    # image lookup only
+    statement_counter.clear()
+    response = client.get("/v2/user/self/pic", auth=auth)
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    assert len(statement_counter) == 1
+
+    # single UPDATE, no user lookup
+    statement_counter.clear()
+    response = client.put("/v2/user/self", json={"email": "statements@example.com", "first_name": "Updated"}, auth=auth)
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+    assert len([statement for statement in statement_counter if statement.lstrip().upper().startswith(("SELECT", "UPDATE"))]) == 1
+
+"""
+Database liveness monitor unit tests
+"""
+def test_healthcheck_reads_monitor_status(client):
+    from app import database_monitor
+
+    assert database_monitor.is_healthy
+    assert database_monitor.last_checked is not None
+
+    database_monitor.mark_unhealthy("connection refused")
+    try:
+        response = client.get("/healthz")
+        assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    finally:
+        database_monitor.mark_healthy()
+
+    response = client.get("/healthz")
+    assert response.status_code == status.HTTP_200_OK
+
+"""
+Verification email outbox unit tests
+"""
+def test_create_user_writes_verification_and_outbox(client, db_session):
+    import asyncio
+    import json
+    from datetime import timedelta
+    from models.user import Verification
+    from models.outbox import OutboxMessage
+    from services.notifications import OutboxDispatcher
+    from tests.fakes import FakePublisher
+    from tests.conftest import TestingAsyncSessionLocal
+
+    user_data = {
+        "email": "outbox@example.com",
+        "password": "testpassword",
+        "first_name": "Outbox",
+        "last_name": "User"
+    }
+    response = client.post("/v2/user", json=user_data)
+    assert response.status_code == status.HTTP_201_CREATED
+
+    verification = db_session.query(Verification).filter(Verification.email == "outbox@example.com").first()
+    assert verification is not None
+
+    publisher = FakePublisher()
+    dispatcher = OutboxDispatcher(publisher=publisher, session_factory=TestingAsyncSessionLocal)
+    assert asyncio.run(dispatcher.dispatch_once()) == 1
+    assert asyncio.run(dispatcher.dispatch_once()) == 0
+
+    assert publisher.calls == 1
+    message = json.loads(publisher.published[0][2])
+    assert message["email"] == "outbox@example.com"
+    assert message["token"] == verification.token
+
+    db_session.expire_all()
+    outbox_message = db_session.query(OutboxMessage).first()
+    assert outbox_message.status == "sent"
+
+    # sent messages are kept for the retention, then deleted
+    assert asyncio.run(dispatcher.purge()) == 0
+    dispatcher.retention = timedelta(minutes=-1)
+    assert asyncio.run(dispatcher.purge()) == 1
+    assert db_session.query(OutboxMessage).count() == 0
+
+def test_create_user_without_sns_topic(client, db_session, monkeypatch):
+    from models.user import Verification
+    from models.outbox import OutboxMessage
+    from services import verification
+
+    monkeypatch.setattr(verification, "SNS_TOPIC_ARN", None)
+    user_data = {"email": "notopic@example.com", "password": "testpassword", "first_name": "No", "last_name": "Topic"}
+
+    # the user and the verification are saved, no email is queued
+    response = client.post("/v2/user", json=user_data)
+    assert response.status_code == status.HTTP_201_CREATED
+    assert db_session.query(Verification).filter(Verification.email == "notopic@example.com").first()
+    assert db_session.query(OutboxMessage).count() == 0
+
+def test_outbox_dispatcher_retries_with_backoff(client, db_session):
+    import asyncio
+    from models.outbox import OutboxMessage
+    from services.notifications import OutboxDispatcher
+    from tests.fakes import FakePublisher
+    from tests.conftest import TestingAsyncSessionLocal
+
+    user_data = {
+        "email": "retry@example.com",
+        "password": "testpassword",
+        "first_name": "Retry",
+        "last_name": "User"
+    }
+    client.post("/v2/user", json=user_data)
+    message_id = db_session.query(OutboxMessage.id).scalar()
+
+    publisher = FakePublisher(fail_ids={message_id})
+    dispatcher = OutboxDispatcher(publisher=publisher, session_factory=TestingAsyncSessionLocal, backoff_base=60)
+    assert asyncio.run(dispatcher.dispatch_once()) == 1
+    # the failed message waits for its backoff before the next attempt
+    assert asyncio.run(dispatcher.dispatch_once()) == 0
+
+    db_session.expire_all()
+    outbox_message = db_session.query(OutboxMessage).first()
+    assert outbox_message.status == "pending"
+    assert outbox_message.attempts == 1
+
+"""
+AWS client registry unit tests
+"""
+def test_client_registry_shares_clients():
+    from services.aws import ClientRegistry
+
+    registry = ClientRegistry()
+    s3 = registry.get("s3", region_name="us-east-1")
+
+    assert registry.get("s3", region_name="us-east-1") is s3
+    assert registry.get("sns", region_name="us-east-1") is not s3
+    assert s3.meta.config.max_pool_connections == registry.pool_stats("s3", region_name="us-east-1")["max_size"]
+    assert s3.meta.config.retries["mode"] == "adaptive"
+
+    # within a deadline the timeouts fit in the remaining budget and the call is not retried
+    bounded_s3 = registry.get("s3", region_name="us-east-1", timeout=1.5)
+    assert bounded_s3 is not s3
+    assert registry.get("s3", region_name="us-east-1", timeout=1.2) is bounded_s3
+    assert bounded_s3.meta.config.read_timeout == 1
+    assert bounded_s3.meta.config.connect_timeout == 1
+    assert bounded_s3.meta.config.retries["total_max_attempts"] == 1
+    assert registry.get("s3", region_name="us-east-1", timeout=60) is s3
+
+    # the pool usage covers the clients of every timeout class
+    stats = registry.pool_stats("s3", region_name="us-east-1")
+    assert stats["clients"] == 2
+    assert stats["max_size"] == 2 * s3.meta.config.max_pool_connections
+
+"""
+Streaming S3 upload unit tests
+"""
+def chunked(body, chunk_size):
+    async def chunks():
+        for start in range(0, len(body), chunk_size):
+            yield body[start:start + chunk_size]
+    return chunks()
+
+def test_stream_to_s3_small_body_single_put():
+    import asyncio
+    from services.storage import stream_to_s3
+    from tests.fakes import FakeS3Client
+
+    s3 = FakeS3Client()
+    size = asyncio.run(stream_to_s3(s3, "bucket", "key", "image/png", chunked(b"x" * 100, 10), part_size=1000, max_size=1000))
+
+    assert size == 100
+    assert s3.objects[("bucket", "key")]["Body"] == b"x" * 100
+    assert not s3.uploads
+
+def test_stream_to_s3_multipart():
+    import asyncio
+    from services.storage import stream_to_s3
+    from tests.fakes import FakeS3Client
+
+    s3 = FakeS3Client()
+    body = bytes(range(256)) * 10
+    size = asyncio.run(stream_to_s3(s3, "bucket", "key", "image/png", chunked(body, 64), part_size=1000, max_size=10000))
+
+    assert size == len(body)
+    assert s3.objects[("bucket", "key")]["Body"] == body
+    assert not s3.uploads
+
+def test_stream_to_s3_too_large_aborts():
+    import asyncio
+    from services.storage import stream_to_s3, UploadTooLargeError
+    from tests.fakes import FakeS3Client
+
+    s3 = FakeS3Client()
+    with pytest.raises(UploadTooLargeError):
+        asyncio.run(stream_to_s3(s3, "bucket", "key", "image/png", chunked(b"x" * 5000, 100), part_size=1000, max_size=2500))
+
+    assert s3.aborted == ["1"]
+    assert not s3.objects
+
+def test_upload_profile_pic_streams_to_s3(client):
+    from app import aws_clients
+    from tests.fakes import FakeS3Client
+
+    s3 = FakeS3Client()
+    aws_clients.override("s3", s3)
+
+    user_data = {
+        "email": "upload@example.com",
+        "password": "testpassword",
+        "first_name": "Upload",
+        "last_name": "User"
+    }
+    client.post("/v2/user", json=user_data)
+    verify_user("upload@example.com")
+    auth = ("upload@example.com", "testpassword")
+
+    try:
+        # the content does not match the declared type
+        response = client.post("/v2/user/self/pic", content=b"GIF89a" + b"x" * 100, headers={"Content-Type": "image/png"}, auth=auth)
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert not s3.objects
+
+        response = client.post("/v2/user/self/pic", content=b"\x89PNG\r\n\x1a\n" + b"x" * 100, headers={"Content-Type": "image/png"}, auth=auth)
+        assert response.status_code == status.HTTP_200_OK
+        assert len(s3.objects) == 1
+
+        response = client.delete("/v2/user/self/pic", auth=auth)
+        assert response.status_code == status.HTTP_204_NO_CONTENT
+        assert not s3.objects
+    finally:
+        aws_clients.clear()
+
+"""
+Presigned profile picture upload unit tests
+"""
+def test_presigned_profile_pic_upload(client):
+    import os
+    from app import aws_clients
+    from tests.fakes import FakeS3Client
+
+    s3 = FakeS3Client()
+    aws_clients.override("s3", s3)
+
+    user_data = {
+        "email": "presigned@example.com",
+        "password": "testpassword",
+        "first_name": "Presigned",
+        "last_name": "User"
+    }
+    client.post("/v2/user", json=user_data)
+    verify_user("presigned@example.com")
+    auth = ("presigned@example.com", "testpassword")
+
+    try:
+        response = client.post("/v2/user/self/pic/upload-url", json={"content_type": "image/gif"}, auth=auth)
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+        response = client.post("/v2/user/self/pic/upload-url", json={"content_type": "image/png"}, auth=auth)
+        assert response.status_code == status.HTTP_200_OK
+        file_name = response.json()["file_name"]
+        assert response.json()["fields"]["Content-Type"] == "image/png"
+        assert "/profile-pic-" in file_name
+
+        # nothing uploaded yet
+        response = client.post("/v2/user/self/pic/complete", json={"file_name": file_name}, auth=auth)
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+        # the client uploads straight to S3
+        s3.put_object(Bucket=os.getenv("APP_S3_BUCKET_NAME"), Key=file_name, Body=b"\x89PNG\r\n\x1a\n" + b"x" * 100, ContentType="image/png")
+
+        response = client.post("/v2/user/self/pic/complete", json={"file_name": "someone-else/profile-pic-1.png"}, auth=auth)
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+        response = client.post("/v2/user/self/pic/complete", json={"file_name": file_name}, auth=auth)
+        assert response.status_code == status.HTTP_200_OK
+
+        response = client.get("/v2/user/self/pic", auth=auth)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()["file_name"] == file_name
+    finally:
+        aws_clients.clear()
+
+"""
+Image variant pipeline unit tests
+"""
+def make_jpeg(width: int, height: int, orientation: int = None) -> bytes:
+    import io
+    from PIL import Image as PILImage
+
+    output = io.BytesIO()
+    exif = PILImage.Exif()
+    exif[0x010F] = "Test Camera"
+    if orientation:
+        exif[0x0112] = orientation
+    PILImage.new("RGB", (width, height), "red").save(output, format="JPEG", exif=exif)
+    return output.getvalue()
+
+def test_validate_image_stream_checks_magic_bytes():
+    import asyncio
+    from services.image_processing import validate_image_stream, InvalidImageError
+
+    async def collect(chunks, content_type):
+        async def stream():
+            for chunk in chunks:
+                yield chunk
+        return b"".join([chunk async for chunk in validate_image_stream(stream(), content_type)])
+
+    png = b"\x89PNG\r\n\x1a\n" + b"x" * 10
+    # the signature is split over several chunks
+    assert asyncio.run(collect([png[:3], png[3:5], png[5:]], "image/png")) == png
+    assert asyncio.run(collect([b"\xff\xd8\xff\xe0" + b"x" * 10], "image/jpg")).startswith(b"\xff\xd8\xff")
+
+    with pytest.raises(InvalidImageError):
+        asyncio.run(collect([png], "image/jpeg"))
+    with pytest.raises(InvalidImageError):
+        asyncio.run(collect([b"\x89P"], "image/png"))
+
+def test_render_variants_strips_metadata():
+    import io
+    from PIL import Image as PILImage
+    from services.image_processing import render_variants, InvalidImageError, VARIANT_SIZES
+
+    # orientation 6 means the camera was rotated, the stored pixels are 600x300
+    variants = render_variants(make_jpeg(600, 300, orientation=6))
+    assert [variant[0] for variant in variants] == list(VARIANT_SIZES)
+
+    for name, body, content_type, width, height in variants:
+        assert content_type == "image/jpeg"
+        assert max(width, height) <= VARIANT_SIZES[name]
+        # rotated upright
+        assert height > width
+        with PILImage.open(io.BytesIO(body)) as rendered:
+            assert len(rendered.getexif()) == 0
+
+    with pytest.raises(InvalidImageError):
+        render_variants(b"\xff\xd8\xff" + b"not a jpeg")
+
+def test_strip_metadata_keeps_format():
+    import io
+    from PIL import Image as PILImage
+    from services.image_processing import strip_metadata
+
+    body, content_type = strip_metadata(make_jpeg(600, 300, orientation=6))
+    assert content_type == "image/jpeg"
+    with PILImage.open(io.BytesIO(body)) as stripped:
+        assert len(stripped.getexif()) == 0
+        assert stripped.size == (300, 600)
+
+def test_image_pipeline_stores_variants(test_db):
+    import asyncio
+    import io
+    import uuid
+    from PIL import Image as PILImage
+    from services.image_processing import ImagePipeline, VARIANT_SIZES
+    from tests.fakes import FakeS3Client
+    from models.user import User, Image, ImageVariant
+    from sqlalchemy import select
+    from tests.conftest import TestingAsyncSessionLocal
+
+    s3 = FakeS3Client()
+    pipeline = ImagePipeline(lambda: s3, TestingAsyncSessionLocal, bucket_name="test-bucket", pool_size=1)
+    user_id = str(uuid.uuid4())
+    image_id = str(uuid.uuid4())
+    file_name = f"{user_id}/profile-pic-1.jpg"
+    s3.put_object(Bucket="test-bucket", Key=file_name, Body=make_jpeg(1000, 800), ContentType="image/jpeg")
+
+    async def run():
+        async with TestingAsyncSessionLocal() as db:
+            db.add(User(id=user_id, email=f"{user_id}@example.com", password="x", first_name="Image", last_name="User"))
+            db.add(Image(id=image_id, user_id=user_id, file_name=file_name, url="https://test-bucket.s3.amazonaws.com/" + file_name))
+            await db.commit()
+
+        try:
+            variants = await pipeline.process(image_id, file_name)
+        finally:
+            await pipeline.stop()
+
+        async with TestingAsyncSessionLocal() as db:
+            stored = (await db.execute(select(ImageVariant).where(ImageVariant.image_id == image_id))).scalars().all()
+        return variants, stored
+
+    variants, stored = asyncio.run(run())
+    assert {variant.name for variant in stored} == set(VARIANT_SIZES)
+    assert len(s3.objects) == len(VARIANT_SIZES) + 1
+    thumbnail = next(variant for variant in stored if variant.name == "thumbnail")
+    assert (thumbnail.width, thumbnail.height) == (128, 102)
+    assert ("test-bucket", thumbnail.file_name) in s3.objects
+    # the original was replaced by a copy without its EXIF data
+    with PILImage.open(io.BytesIO(s3.objects[("test-bucket", file_name)]["Body"])) as original:
+        assert len(original.getexif()) == 0
+
+def test_image_pipeline_deleted_image(test_db):
+    import asyncio
+    import uuid
+    from services.image_processing import ImagePipeline
+    from tests.fakes import FakeS3Client
+    from tests.conftest import TestingAsyncSessionLocal
+
+    s3 = FakeS3Client()
+    pipeline = ImagePipeline(lambda: s3, TestingAsyncSessionLocal, bucket_name="test-bucket", pool_size=1)
+    file_name = f"{uuid.uuid4()}/profile-pic-1.jpg"
+    s3.put_object(Bucket="test-bucket", Key=file_name, Body=make_jpeg(400, 300), ContentType="image/jpeg")
+
+    async def run():
+        try:
+            # the image row is gone, e.g. deleted by the user while its variants were rendered
+            return await pipeline.process(str(uuid.uuid4()), file_name)
+        finally:
+            await pipeline.stop()
+
+    assert asyncio.run(run()) == []
+    # neither the variants nor the stripped copy of the upload are left behind
+    assert s3.objects == {}
+
+"""
+Buffered metrics unit tests
+"""
+def test_buffered_stats_client_aggregates():
+    from services.metrics import BufferedStatsClient
+
+    packets = []
+    stats = BufferedStatsClient(transport=packets.append, max_buffer=100, max_packet_size=64)
+    for _ in range(5):
+        stats.incr("api.count", tags={"status_class": "2xx"})
+    stats.gauge("pool.in_use", 3)
+    stats.gauge("pool.in_use", 4)
+    with stats.timer("query.time"):
+        pass
+
+    # nothing is sent before the flush
+    assert packets == []
+    assert stats.flush() == len(packets) == 2
+    lines = b"\n".join(packets).decode().split("\n")
+    assert "api.count:5|c|#status_class:2xx" in lines
+    assert "pool.in_use:4|g" in lines
+    assert any(line.startswith("query.time:") and line.endswith("|ms") for line in lines)
+    assert all(len(packet) <= 64 for packet in packets)
+
+    # flushed as soon as the buffer is full
+    stats = BufferedStatsClient(transport=packets.append, max_buffer=3)
+    packets.clear()
+    stats.incr("a")
+    stats.incr("a")
+    assert packets == []
+    stats.incr("a")
+    assert packets == [b"a:3|c"]
+
+def test_request_metrics_use_route_templates(client):
+    from app import statsd_client
+
+    packets = []
+    statsd_client.flush()
+    transport, statsd_client._transport = statsd_client._transport, packets.append
+    try:
+        client.get("/healthz")
+        client.get("/healthz")
+        client.get("/wp-admin/setup.php")
+        client.get("/v2/user/self")
+        statsd_client.flush()
+    finally:
+        statsd_client._transport = transport
+
+    lines = b"\n".join(packets).decode().split("\n")
+    assert "api./healthz.GET.count:2|c|#status_class:2xx" in lines
+    assert "api.unmatched.GET.count:1|c|#status_class:4xx" in lines
+    assert "api./v2/user/self.GET.count:1|c|#status_class:4xx" in lines
+    assert not any("wp-admin" in line for line in lines)
+
+"""
+Request span breakdown unit tests
+"""
+def test_server_timing_breakdown(client, caplog):
+    import json
+    import logging
+    from app import credential_cache
+
+    user_data = {
+        "email": "timing@example.com",
+        "password": "testpassword",
+        "first_name": "Timing",
+        "last_name": "User"
+    }
+    client.post("/v2/user", json=user_data)
+    verify_user("timing@example.com")
+    credential_cache.invalidate("timing@example.com")
+
+    with caplog.at_level(logging.INFO, logger="app.timing"):
+        response = client.get("/v2/user/self", auth=("timing@example.com", "testpassword"))
+    assert response.status_code == status.HTTP_200_OK
+
+    spans = {entry.split(";")[0] for entry in response.headers["Server-Timing"].split(", ")}
+    assert {"auth", "db", "bcrypt", "serialize", "total"} <= spans
+
+    records = [json.loads(record.getMessage()) for record in caplog.records if record.name == "app.timing"]
+    assert records[-1]["route"] == "/v2/user/self"
+    assert records[-1]["status"] == 200
+    assert records[-1]["spans"]["db"]["count"] == 1
+
+def test_unsampled_requests_record_nothing():
+    import asyncio
+    from services.tracing import span, start_request
+
+    async def request(sample_rate):
+        recorder = start_request(sample_rate)
+        with span("db"):
+            pass
+        return recorder
+
+    assert asyncio.run(request(0)) is None
+    recorder = asyncio.run(request(1))
+    assert recorder.spans["db"][1] == 1
+    assert "db;dur=" in recorder.server_timing()
+
+"""
+Query profiler unit tests
+"""
+def test_normalize_statement():
+    from services.profiling import normalize_statement
+
+    assert normalize_statement("SELECT *\n  FROM users WHERE id = 5 AND email = 'a@b.com'") == "SELECT * FROM users WHERE id = ? AND email = ?"
+    assert normalize_statement("SELECT * FROM images WHERE id IN (%s, %s, %s)") == normalize_statement("SELECT * FROM images WHERE id IN (%s, %s)")
+
+def test_query_profiler_per_route_counts(client, monkeypatch):
+    import app as app_module
+    from services.profiling import QueryProfiler
+    from tests.conftest import async_engine
+
+    profiler = QueryProfiler(enabled=True, slow_query_threshold=10000, n_plus_one_threshold=3)
+    profiler.attach(async_engine.sync_engine)
+    monkeypatch.setattr(app_module, "query_profiler", profiler)
+
+    user_data = {
+        "email": "profiler@example.com",
+        "password": "testpassword",
+        "first_name": "Profiler",
+        "last_name": "User"
+    }
+    client.post("/v2/user", json=user_data)
+    verify_user("profiler@example.com")
+    auth = ("profiler@example.com", "testpassword")
+
+    try:
+        client.get("/v2/user/self/pic", auth=auth)
+        client.get("/v2/user/self/pic", auth=auth)
+
+        # off unless explicitly enabled
+        assert client.get("/debug/queries").status_code == status.HTTP_404_NOT_FOUND
+        monkeypatch.setattr(app_module, "QUERY_DEBUG_ENDPOINT_ENABLED", True)
+        response = client.get("/debug/queries")
+        assert response.status_code == status.HTTP_200_OK
+    finally:
+        profiler.detach()
+
+    routes = response.json()["routes"]
+    assert routes["GET /v2/user/self/pic"]["requests"] == 2
+    # user lookup on the first request, the second one is authenticated from the cache
+    assert routes["GET /v2/user/self/pic"]["statements"] == 3
+    assert routes["POST /v2/user"]["statements"] >= 1
+    assert not routes["GET /v2/user/self/pic"]["n_plus_one"]
+
+def test_query_profiler_flags_n_plus_one(test_db):
+    import asyncio
+    from sqlalchemy import text
+    from services.profiling import QueryProfiler
+    from tests.conftest import async_engine
+
+    profiler = QueryProfiler(enabled=True, n_plus_one_threshold=3)
+    profiler.attach(async_engine.sync_engine)
+
+    async def request():
+        profile = profiler.start_request()
+        async with async_engine.connect() as conn:
+            for user_id in range(4):
+                await conn.execute(text("SELECT id FROM users WHERE id = :id"), {"id": str(user_id)})
+        profiler.finish_request(profile, "/v2/users/{user_id}", "GET")
+
+    try:
+        asyncio.run(request())
+    finally:
+        profiler.detach()
+
+    stats = profiler.snapshot()["routes"]["GET /v2/users/{user_id}"]
+    assert stats["statements"] == 4
+    assert list(stats["n_plus_one"].values()) == [4]
+
+"""
+Benchmark report unit tests
+"""
+def test_benchmark_summary_and_compare():
+    from benchmarks.run import percentile, summarize, compare
+
+    latencies = list(range(1, 101))
+    assert percentile(latencies, 50) == 50
+    assert percentile(latencies, 99) == 99
+    assert percentile([], 95) == 0.0
+
+    baseline = {"routes": summarize({"GET /healthz": [(float(latency), True) for latency in latencies]}, 10)}
+    assert baseline["routes"]["GET /healthz"]["rps"] == 10.0
+    assert compare(baseline, baseline, 0.2) == []
+
+    slower = {"routes": summarize({"GET /healthz": [(latency * 1.5, True) for latency in latencies]}, 10)}
+    assert [regression.split(":")[0] for regression in compare(baseline, slower, 0.2)] == ["GET /healthz", "GET /healthz"]
+    assert compare(baseline, {"routes": {}}, 0.2) == ["GET /healthz: missing from the current run"]
+
+"""
+Server launcher unit tests
+"""
+def test_server_settings(monkeypatch):
+    import app as app_module
+
+    settings = app_module.server_settings()
+    assert settings["workers"] >= 1
+    assert settings["loop"] == "uvloop"
+    assert settings["http"] == "httptools"
+    assert settings["timeout_keep_alive"] > 60
+
+    # the reloader forces a single worker
+    monkeypatch.setattr(app_module, "SERVER_RELOAD", True)
+    monkeypatch.setattr(app_module, "SERVER_WORKERS", 8)
+    assert app_module.server_settings()["workers"] == 1
+
+"""
+Response serialization unit tests
+"""
+def test_fast_serializers_match_user_schema():
+    import json
+    from datetime import datetime, timezone
+    from models.user import User
+    from schemas.user_schema import UserSchema
+    from services.serialization import FastJSONResponse, serialize_user
+
+    for timestamp in (datetime(2024, 5, 1, 12, 30, 15, 123456, tzinfo=timezone.utc), datetime(2024, 5, 1, 12, 30, 15)):
+        user = User(
+            id="0b8e3f5e-6c56-4a4b-9d5e-2f7a1c3b9d10",
+            email="serializer@example.com",
+            password="hashed",
+            first_name="Serializer",
+            last_name="User",
+            account_created=timestamp,
+            account_updated=timestamp
+        )
+        expected = UserSchema.model_validate(user).model_dump_json()
+        rendered = FastJSONResponse(serialize_user(user)).body
+        assert json.loads(rendered) == json.loads(expected)
+        assert "password" not in json.loads(rendered)
+
+"""
+Profile ETag unit tests
+"""
+def test_profile_etag():
+    from datetime import timedelta, timezone
+    from services.etag import make_etag, etag_matches
+
+    updated = datetime(2026, 1, 1, 12, 0, 0, 100, tzinfo=timezone.utc)
+    etag = make_etag("user-1", updated)
+    assert etag == make_etag("user-1", updated)
+    assert etag.startswith('"') and etag.endswith('"')
+    # two updates within the same second
+    assert etag != make_etag("user-1", updated + timedelta(microseconds=1))
+    assert etag != make_etag("user-2", updated)
+
+    assert etag_matches('W/"abc", "def"', '"def"')
+    assert etag_matches("*", '"def"')
+    assert not etag_matches('"abc"', '"def"')
+    assert not etag_matches(None, '"def"')
+
+def test_get_user_etag(client):
+    user_data = {
+        "email": "etag@example.com",
+        "password": "testpassword",
+        "first_name": "Etag",
+        "last_name": "User"
+    }
+    client.post("/v2/user", json=user_data)
+    verify_user("etag@example.com")
+    auth = ("etag@example.com", "testpassword")
+
+    response = client.get("/v2/user/self", auth=auth)
+    assert response.status_code == status.HTTP_200_OK
+    etag = response.headers["ETag"]
+    assert "no-store" not in response.headers["Cache-Control"]
+
+    response = client.get("/v2/user/self", auth=auth, headers={"If-None-Match": etag})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    assert response.content == b""
+    assert response.headers["ETag"] == etag
+
+    # the update moves account_updated and with it the ETag forward
+    response = client.put("/v2/user/self", json={"email": "etag@example.com", "first_name": "Changed"}, auth=auth)
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+
+    response = client.get("/v2/user/self", auth=auth, headers={"If-None-Match": etag})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["ETag"] != etag
+    assert response.json()["first_name"] == "Changed"
+
+"""
+Bulk user import unit tests
+"""
+def test_password_hasher_hash_passwords():
+    import asyncio
+    from services.hashing import PasswordHasher
+
+    hasher = PasswordHasher(pool_size=2, queue_size=0)
+    passwords = ["first", "second", "third"]
+    try:
+        hashed_passwords = asyncio.run(hasher.hash_passwords(passwords))
+    finally:
+        hasher.shutdown()
+
+    assert len(hashed_passwords) == 3
+    for password, hashed_password in zip(passwords, hashed_passwords):
+        assert bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+def test_iter_ndjson_lines_skips_oversized_lines():
+    import asyncio
+    from services.bulk_import import iter_ndjson_lines
+
+    async def collect(chunks):
+        async def source():
+            for chunk in chunks:
+                yield chunk
+        return [line async for line in iter_ndjson_lines(source(), max_line_size=8)]
+
+    assert asyncio.run(collect([b'{"a":1}\n\n{"b"', b':2}\n{"c":3}'])) == [(1, b'{"a":1}'), (3, b'{"b":2}'), (4, b'{"c":3}')]
+    assert asyncio.run(collect([b'{"a":1}\n{"too', b'long":"line"', b'}\n{"c":3}\n'])) == [(1, b'{"a":1}'), (2, None), (3, b'{"c":3}')]
+
+def test_bulk_import_users(client, db_session, monkeypatch):
+    import json
+    import app as app_module
+    from models.user import Verification
+    from models.outbox import OutboxMessage
+    from tests.conftest import TestingAsyncSessionLocal
+
+    monkeypatch.setattr(app_module.guarded_session, "session_factory", TestingAsyncSessionLocal)
+    client.post("/v2/user", json={"email": "existing@example.com", "password": "testpassword", "first_name": "Existing", "last_name": "User"})
+
+    lines = [
+        {"email": "import1@example.com", "password": "testpassword", "first_name": "Import", "last_name": "One"},
+        {"email": "existing@example.com", "password": "testpassword", "first_name": "Existing", "last_name": "User"},
+        {"email": "import2@example.com", "password": "testpassword", "first_name": "Import", "last_name": "Two"},
+        {"email": "import1@example.com", "password": "testpassword", "first_name": "Import", "last_name": "Again"},
+        {"email": "not-an-email", "password": "testpassword", "first_name": "Bad", "last_name": "Email"},
+    ]
+    body = "\n".join(json.dumps(line) for line in lines) + "\nnot json\n"
+
+    # disabled without the admin token
+    response = client.post("/v2/admin/users/import", content=body)
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+    monkeypatch.setattr(app_module, "ADMIN_TOKEN", "secret")
+    response = client.post("/v2/admin/users/import", content=body, headers={"X-Admin-Token": "wrong"})
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+    response = client.post("/v2/admin/users/import", content=body, headers={"X-Admin-Token": "secret"})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"] == "application/x-ndjson"
+    report = [json.loads(line) for line in response.text.splitlines()]
+
+    assert [result["status"] for result in report[:-1]] == ["created", "duplicate", "created", "duplicate", "invalid", "invalid"]
+    assert report[-1] == {"summary": {"created": 2, "duplicate": 2, "invalid": 2, "failed": 0}}
+
+    db_session.expire_all()
+    user = db_session.query(User).filter(User.email == "import1@example.com").first()
+    assert user.id == report[0]["id"]
+    assert user.last_name == "One"
+    assert bcrypt.checkpw("testpassword".encode('utf-8'), user.password.encode('utf-8'))
+    assert db_session.query(Verification).filter(Verification.email.in_(["import1@example.com", "import2@example.com"])).count() == 2
+    assert db_session.query(OutboxMessage).count() == 3
+
+def test_bulk_import_forgets_unknown_emails(client, monkeypatch):
+    import json
+    import app as app_module
+    from services.rate_limit import AdmissionController
+    from tests.conftest import TestingAsyncSessionLocal
+
+    admission = AdmissionController(enabled=True)
+    monkeypatch.setattr(app_module, "admission", admission)
+    monkeypatch.setattr(app_module.guarded_session, "session_factory", TestingAsyncSessionLocal)
+    monkeypatch.setattr(app_module, "ADMIN_TOKEN", "secret")
+
+    # the email was looked up before the account existed
+    admission.remember_unknown_email("imported@example.com")
+    body = json.dumps({"email": "imported@example.com", "password": "testpassword", "first_name": "Imported", "last_name": "User"}) + "\n"
+    response = client.post("/v2/admin/users/import", content=body, headers={"X-Admin-Token": "secret"})
+    assert response.status_code == status.HTTP_200_OK
+    assert not admission.is_unknown_email("imported@example.com")
+
+"""
+User export unit tests
+"""
+def test_export_cursor_round_trip():
+    from services.export import encode_cursor, decode_cursor, parse_includes, InvalidCursorError
+
+    created = datetime(2024, 1, 2, 3, 4, 5)
+    assert decode_cursor(encode_cursor(created, "user-1")) == (created, "user-1")
+    assert decode_cursor(encode_cursor(None, "user-1")) == (None, "user-1")
+    with pytest.raises(InvalidCursorError):
+        decode_cursor("not-a-cursor")
+    with pytest.raises(ValueError):
+        parse_includes("images,passwords")
+
+def test_export_users(client, monkeypatch):
+    import csv
+    import io
+    import json
+    import app as app_module
+    from tests.conftest import TestingAsyncSessionLocal
+
+    monkeypatch.setattr(app_module.guarded_session, "session_factory", TestingAsyncSessionLocal)
+    for index, name in enumerate(("One", "Two", "Three")):
+        client.post("/v2/user", json={"email": f"export{index}@example.com", "password": "testpassword", "first_name": "Export", "last_name": name})
+
+    response = client.get("/v2/admin/users/export")
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+    monkeypatch.setattr(app_module, "ADMIN_TOKEN", "secret")
+    headers = {"X-Admin-Token": "secret"}
+
+    response = client.get("/v2/admin/users/export?page_size=2&include=images,verifications", headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"] == "application/x-ndjson"
+    records = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(record["email"] for record in records) == ["export0@example.com", "export1@example.com", "export2@example.com"]
+    assert all("password" not in record for record in records)
+    assert records[0]["images"] == []
+    assert records[0]["verification"]["link_verified"] is False
+    assert "token" not in records[0]["verification"]
+
+    # resumes after the given record
+    response = client.get(f"/v2/admin/users/export?cursor={records[0]['cursor']}", headers=headers)
+    assert [json.loads(line)["id"] for line in response.text.splitlines()] == [record["id"] for record in records[1:]]
+
+    response = client.get("/v2/admin/users/export?format=csv&include=verifications", headers=headers)
+    assert response.headers["content-type"].startswith("text/csv")
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert [row["id"] for row in rows] == [record["id"] for record in records]
+    assert "password" not in rows[0]
+    assert rows[0]["verification_link_verified"] == "False"
+
+    assert client.get("/v2/admin/users/export?cursor=bad", headers=headers).status_code == status.HTTP_400_BAD_REQUEST
+    assert client.get("/v2/admin/users/export?format=xml", headers=headers).status_code == status.HTTP_400_BAD_REQUEST
+
+"""
+Email verification and verification sweeper unit tests
+"""
+def test_verify_email(client, db_session):
+    from datetime import timedelta, timezone
+    from sqlalchemy import update
+    from models.user import Verification
+    from tests.conftest import engine
+
+    client.post("/v2/user", json={"email": "verify@example.com", "password": "testpassword", "first_name": "Verify", "last_name": "User"})
+    client.post("/v2/user", json={"email": "expired@example.com", "password": "testpassword", "first_name": "Expired", "last_name": "User"})
+
+    verification = db_session.query(Verification).filter(Verification.email == "verify@example.com").first()
+    # stored in UTC
+    assert abs(verification.expiration_time - datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(minutes=3)) < timedelta(minutes=1)
+
+    response = client.get(f"/v2/user/verify?token={verification.token}")
+    assert response.status_code == status.HTTP_200_OK
+    # a second click on the same link succeeds as well
+    assert client.get(f"/v2/user/verify?token={verification.token}").status_code == status.HTTP_200_OK
+
+    db_session.expire_all()
+    assert db_session.query(User).filter(User.email == "verify@example.com").first().is_verified
+    assert db_session.query(Verification).filter(Verification.email == "verify@example.com").first().link_verified
+
+    with engine.begin() as connection:
+        connection.execute(update(Verification).where(Verification.email == "expired@example.com").values(expiration_time=datetime.now(timezone.utc) - timedelta(minutes=1)))
+    expired = db_session.query(Verification).filter(Verification.email == "expired@example.com").first()
+    db_session.expire_all()
+    assert client.get(f"/v2/user/verify?token={expired.token}").status_code == status.HTTP_400_BAD_REQUEST
+    assert client.get("/v2/user/verify?token=unknown").status_code == status.HTTP_400_BAD_REQUEST
+    assert not db_session.query(User).filter(User.email == "expired@example.com").first().is_verified
+
+def test_verification_sweeper_archives_expired_rows(client, db_session):
+    import asyncio
+    from datetime import timedelta, timezone
+    from sqlalchemy import update
+    from models.user import Verification, VerificationArchive
+    from services.verification import VerificationSweeper
+    from tests.conftest import engine, TestingAsyncSessionLocal
+
+    for index in range(3):
+        client.post("/v2/user", json={"email": f"sweep{index}@example.com", "password": "testpassword", "first_name": "Sweep", "last_name": "User"})
+    with engine.begin() as connection:
+        connection.execute(
+            update(Verification)
+            .where(Verification.email.in_(["sweep0@example.com", "sweep1@example.com"]))
+            .values(expiration_time=datetime.now(timezone.utc) - timedelta(hours=2))
+        )
+
+    sweeper = VerificationSweeper(session_factory=TestingAsyncSessionLocal, batch_size=1, archive_after=60)
+    assert asyncio.run(sweeper.sweep()) == 2
+
+    db_session.expire_all()
+    assert [verification.email for verification in db_session.query(Verification).filter(Verification.email.like("sweep%")).all()] == ["sweep2@example.com"]
+    archived = db_session.query(VerificationArchive).order_by(VerificationArchive.email).all()
+    assert [verification.email for verification in archived] == ["sweep0@example.com", "sweep1@example.com"]
+    assert archived[0].token and archived[0].archived_at is not None
+
+"""
+Rate limiting unit tests
+"""
+def test_token_buckets():
+    from services.rate_limit import TokenBuckets, parse_route_rules, basic_auth_username
+    import base64
+
+    now = [0.0]
+    buckets = TokenBuckets(max_keys=4, shards=2, clock=lambda: now[0])
+    assert buckets.take("a", rate=1, burst=2) == 0
+    assert buckets.take("a", rate=1, burst=2) == 0
+    assert buckets.take("a", rate=1, burst=2) == pytest.approx(1)
+    assert buckets.check("a", rate=1, burst=2) == pytest.approx(1)
+    now[0] = 0.5
+    assert buckets.check("a", rate=1, burst=2) == pytest.approx(0.5)
+    now[0] = 1.0
+    assert buckets.take("a", rate=1, burst=2) == 0
+
+    # bounded, the least recently used buckets are evicted
+    for index in range(100):
+        buckets.take(f"key-{index}", rate=1, burst=2)
+    assert len(buckets) <= 4
+
+    assert parse_route_rules("/v2/user=1:2,/v2/user/self=5") == [("/v2/user/self", 5.0, 5.0), ("/v2/user", 1.0, 2.0)]
+    assert basic_auth_username("Basic " + base64.b64encode(b"User@Example.com:secret").decode()) == "user@example.com"
+    assert basic_auth_username("Bearer token") is None
+    assert basic_auth_username("Basic !!!") is None
+
+def test_rate_limit_failed_authentication(client, monkeypatch):
+    import app as app_module
+    from services.rate_limit import AdmissionController
+
+    admission = AdmissionController(enabled=True, ip_rate=100, ip_burst=100, routes="/v2/user/verify=1:1", auth_failure_rate=0.01, auth_failure_burst=2)
+    monkeypatch.setattr(app_module, "admission", admission)
+
+    client.post("/v2/user", json={"email": "limited@example.com", "password": "testpassword", "first_name": "Limited", "last_name": "User"})
+    verify_user("limited@example.com")
+
+    assert client.get("/v2/user/self", auth=("limited@example.com", "wrong")).status_code == status.HTTP_401_UNAUTHORIZED
+    assert client.get("/v2/user/self", auth=("limited@example.com", "wrong")).status_code == status.HTTP_401_UNAUTHORIZED
+    response = client.get("/v2/user/self", auth=("limited@example.com", "testpassword"))
+    assert response.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+    assert int(response.headers["Retry-After"]) > 0
+    # other accounts are not affected
+    client.post("/v2/user", json={"email": "other@example.com", "password": "testpassword", "first_name": "Other", "last_name": "User"})
+    verify_user("other@example.com")
+    assert client.get("/v2/user/self", auth=("other@example.com", "testpassword")).status_code == status.HTTP_200_OK
+
+    # unknown emails are remembered, the next attempt does not reach the database
+    assert client.get("/v2/user/self", auth=("nobody@example.com", "secret")).status_code == status.HTTP_401_UNAUTHORIZED
+    assert admission.is_unknown_email("Nobody@example.com")
+    client.post("/v2/user", json={"email": "nobody@example.com", "password": "testpassword", "first_name": "Nobody", "last_name": "User"})
+    assert not admission.is_unknown_email("nobody@example.com")
+
+    # per route limit, the health check is never limited
+    assert client.get("/v2/user/verify?token=unknown").status_code == status.HTTP_400_BAD_REQUEST
+    assert client.get("/v2/user/verify?token=unknown").status_code == status.HTTP_429_TOO_MANY_REQUESTS
+    for _ in range(150):
+        assert client.get("/healthz").status_code != status.HTTP_429_TOO_MANY_REQUESTS
+
+"""
+Concurrency limiter unit tests
+"""
+def test_route_group_limiter_sheds_excess():
+    import asyncio
+    from services.concurrency import RouteGroupLimiter, LoadShedError, parse_group_limits
+
+    assert parse_group_limits("user=4:8:0.5,admin=1") == {"user": (4, 8, 0.5), "admin": (1, 0, 0.0)}
+
+    async def run():
+        limiter = RouteGroupLimiter("user", limit=1, queue_size=1, queue_timeout=0.05)
+        assert await limiter.acquire() == 0
+
+        queued = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        assert limiter.waiting == 1
+        with pytest.raises(LoadShedError) as shed:
+            await limiter.acquire()
+        assert shed.value.reason == "queue_full"
+        with pytest.raises(LoadShedError) as shed:
+            await queued
+        assert shed.value.reason == "timeout"
+
+        # a released slot goes to the next request in the queue
+        queued = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        limiter.release()
+        assert await queued >= 0
+        assert limiter.in_flight == 1 and limiter.shed == 2
+
+    asyncio.run(run())
+
+def test_concurrency_limit_spares_health_checks(client, monkeypatch):
+    import asyncio
+    import app as app_module
+    from services.concurrency import ConcurrencyLimiter
+
+    limiter = ConcurrencyLimiter(enabled=True, limits="user=1:0:0,default=1:0:0")
+    # the only slot of the user group is taken
+    limiter.groups["user"]._semaphore = asyncio.Semaphore(0)
+    monkeypatch.setattr(app_module, "concurrency_limiter", limiter)
+
+    response = client.get("/v2/user/self", auth=("shed@example.com", "testpassword"))
+    assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    assert response.headers["Retry-After"] == "1"
+    assert limiter.groups["user"].shed == 1
+
+    # the health checks and the other groups are not affected
+    assert client.get("/healthz").status_code == status.HTTP_200_OK
+    assert client.get("/debug/queries").status_code == status.HTTP_404_NOT_FOUND
+
+def test_concurrency_slot_held_while_streaming(client, monkeypatch):
+    import app as app_module
+    from services.concurrency import ConcurrencyLimiter
+
+    limiter = ConcurrencyLimiter(enabled=True, limits="admin=1:0:0")
+    monkeypatch.setattr(app_module, "concurrency_limiter", limiter)
+    monkeypatch.setattr(app_module, "ADMIN_TOKEN", "test-admin-token")
+    in_flight = []
+
+    class FakeExporter:
+        def __init__(self, **kwargs):
+            pass
+
+        async def run(self):
+            for line in (b"{}\n", b"{}\n"):
+                in_flight.append(limiter.groups["admin"].in_flight)
+                yield line
+
+    monkeypatch.setattr(app_module, "UserExporter", FakeExporter)
+
+    response = client.get("/v2/admin/users/export", headers={"X-Admin-Token": "test-admin-token"})
+    assert response.status_code == status.HTTP_200_OK
+    # the slot is held until the last line was sent
+    assert in_flight == [1, 1]
+    assert limiter.groups["admin"].in_flight == 0
+
+"""
+Request deadline unit tests
+"""
+def test_deadline_timeouts():
+    import asyncio
+    from services.deadline import timeout_for, parse_route_deadlines, start_deadline, bounded, DeadlineExceededError
+
+    routes = parse_route_deadlines("/v2/user/self/pic=30000,/v2/admin=0")
+    assert timeout_for("/v2/user/self", None, 10000, routes) == 10
+    assert timeout_for("/v2/user/self/pic", None, 10000, routes) == 30
+    assert timeout_for("/v2/admin/users/export", None, 10000, routes) is None
+    # the client header only tightens the deadline
+    assert timeout_for("/v2/user/self", "250", 10000, routes) == 0.25
+    assert timeout_for("/v2/user/self", "60000", 10000, routes) == 10
+    assert timeout_for("/v2/admin/users/export", "5000", 10000, routes) == 5
+    assert timeout_for("/v2/user/self", "soon", 10000, routes) == 10
+
+    async def run():
+        deadline = start_deadline(0.05)
+        assert await bounded(asyncio.sleep(0, result="done"), "db") == "done"
+        with pytest.raises(DeadlineExceededError):
+            await bounded(asyncio.sleep(1), "s3")
+        assert deadline.exceeded == "s3"
+
+    asyncio.run(run())
+
+def test_request_deadline_returns_504(client, monkeypatch):
+    import asyncio
+    from services import queries
+
+    async def slow_get_user_by_email(db, email):
+        await asyncio.sleep(1)
+
+    monkeypatch.setattr(queries, "get_user_by_email", slow_get_user_by_email)
+    user_data = {"email": "slow@example.com", "password": "testpassword", "first_name": "Slow", "last_name": "User"}
+
+    # the handler turns the error into a 400, the request still ends with a 504
+    response = client.post("/v2/user", json=user_data, headers={"X-Request-Timeout": "50"})
+    assert response.status_code == status.HTTP_504_GATEWAY_TIMEOUT
+
+    response = client.get("/v2/user/self", auth=("slow@example.com", "testpassword"), headers={"X-Request-Timeout": "50"})
+    assert response.status_code == status.HTTP_504_GATEWAY_TIMEOUT
+
+"""
+Circuit breaker unit tests
+"""
+def test_circuit_breaker_states():
+    from services.circuit_breaker import CircuitBreaker, CircuitOpenError
+
+    now = [0.0]
+    breaker = CircuitBreaker("db", failure_threshold=3, window=10, open_timeout=5, half_open_max_calls=1, enabled=True, clock=lambda: now[0])
+
+    # failures out of the window do not add up
+    breaker.record_failure()
+    now[0] = 11
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    assert breaker.retry_after() == 5
+    assert breaker.rejected == 1
+
+    # one probe goes through after the open timeout, a failed probe opens the circuit again
+    now[0] = 16
+    breaker.before_call()
+    assert breaker.state == "half_open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    # a successful probe closes it
+    now[0] = 21
+    with breaker.protect():
+        pass
+    assert breaker.state == "closed"
+    assert breaker.times_opened == 2
+
+def test_guarded_session_factory_counts_rejections():
+    from services.circuit_breaker import CircuitBreaker, GuardedSessionFactory, CircuitOpenError, start_request
+
+    now = [0.0]
+    breaker = CircuitBreaker("db", failure_threshold=1, open_timeout=5, half_open_max_calls=1, enabled=True, clock=lambda: now[0])
+    session_factory = GuardedSessionFactory(lambda: "session", breaker)
+    rejections = start_request()
+
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        session_factory()
+    assert breaker.rejected == 1
+    assert rejections == ["db"]
+
+    # opening a session in half open does not take the probe slot of a query
+    now[0] = 5
+    assert session_factory() == "session"
+    breaker.before_call()
+    assert breaker.state == "half_open"
+
+def test_guarded_client_counts_server_errors():
+    from botocore.exceptions import ClientError
+    from services.circuit_breaker import CircuitBreaker, GuardedClient, CircuitOpenError, is_aws_failure
+
+    class FakeS3:
+        def __init__(self):
+            self.status_code = 500
+
+        def delete_object(self, **kwargs):
+            raise ClientError({"Error": {"Code": "Error"}, "ResponseMetadata": {"HTTPStatusCode": self.status_code}}, "DeleteObject")
+
+        def generate_presigned_post(self, **kwargs):
+            return {"url": "https://bucket.s3.amazonaws.com"}
+
+    fake = FakeS3()
+    breaker = CircuitBreaker("s3", failure_threshold=2, is_failure=is_aws_failure, enabled=True)
+    s3 = GuardedClient(fake, breaker)
+
+    # a 404 is an answer of a healthy S3
+    fake.status_code = 404
+    for _ in range(3):
+        with pytest.raises(ClientError):
+            s3.delete_object(Bucket="bucket", Key="key")
+    assert breaker.state == "closed"
+
+    fake.status_code = 503
+    for _ in range(2):
+        with pytest.raises(ClientError):
+            s3.delete_object(Bucket="bucket", Key="key")
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        s3.delete_object(Bucket="bucket", Key="key")
+    # presigning never leaves the process
+    assert s3.generate_presigned_post(Bucket="bucket", Key="key")["url"]
+
+def test_open_circuit_fails_fast(client):
+    import app as app_module
+
+    user_data = {"email": "circuit@example.com", "password": "testpassword", "first_name": "Circuit", "last_name": "User"}
+    client.post("/v2/user", json=user_data)
+    verify_user("circuit@example.com")
+
+    breaker = app_module.circuit_breakers["s3"]
+    try:
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+
+        response = client.delete("/v2/user/self/pic", auth=("circuit@example.com", "testpassword"))
+        assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+        assert int(response.headers["Retry-After"]) > 0
+
+        # the routes which do not need S3 keep working
+        assert client.get("/v2/user/self", auth=("circuit@example.com", "testpassword")).status_code == status.HTTP_200_OK
+
+        response = client.get("/healthz")
+        assert response.status_code == status.HTTP_200_OK
+        assert response.headers["X-Degraded-Dependencies"] == "s3"
+    finally:
+        breaker.reset()
+
+    assert "X-Degraded-Dependencies" not in client.get("/healthz").headers